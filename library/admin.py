@@ -1,21 +1,142 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
+from django.db.models import Q
+from django.http import HttpResponseRedirect
+from django.utils import timezone
 
-from .models import User, Book, BorrowRecord, Category
+from .models import User, Book, BorrowRecord, ArchivedBorrowRecord, Category, Hold, Task
+from .forms import BookForm
+from .pagination import EstimatedCountPaginator
+from .search import get_search_backend
 
 
-class BookAdmin(admin.ModelAdmin):
+class LargeTableAdmin(admin.ModelAdmin):
+    """Admin of a table with millions of rows: no full COUNT(*) and no <select> of every related row."""
+    paginator = EstimatedCountPaginator
+    # the filtered changelist is counted once, without a second count of the whole table
+    show_full_result_count = False
+    list_per_page = 50
+
+
+class LibraryUserAdmin(UserAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    # prefix and exact matches can use the indexes, unlike the substring matches of UserAdmin
+    search_fields = ['^username', '=email']
+
+
+class BookAdminForm(BookForm):
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if self.instance.pk is None or 'base_version' not in cleaned_data:
+            return cleaned_data
+        # the book is locked until the transaction of the change view has written it, see BookAdmin.save_model()
+        current = Book.objects.select_for_update().filter(pk=self.instance.pk).first()
+        if current is None:
+            raise forms.ValidationError('The book was deleted by someone else while you edited it.')
+        # the admin cannot show the current values along with the form, see BookUpdateView
+        if current.version != cleaned_data['base_version'] and (conflicts := self.get_conflicts(current)):
+            raise forms.ValidationError(f'The book was changed by someone else while you edited it: '
+                                        f'{self.describe_conflicts(current, conflicts)}. '
+                                        f'Reload the page to edit the current values.')
+        return cleaned_data
+
+
+class BookAdmin(LargeTableAdmin):
+    form = BookAdminForm
     list_display = ['title', 'author', 'isbn', 'quantity', 'category']
     list_filter = ['category']
+    list_select_related = ['category']
+    ordering = ['title']
     search_fields = ['title', 'author', 'isbn']
 
+    def get_search_results(self, request, queryset, search_term):
+        """Search the titles and authors with the catalog search backend, and the ISBNs exactly."""
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        backend = get_search_backend()
+        matches = Q(isbn=search_term)
+        for field in ['title', 'author']:
+            matches |= Q(pk__in=backend.search(Book.objects.all(), {field: search_term}).values('pk'))
+        return queryset.filter(matches), False
+
+    def save_model(self, request, obj, form, change):
+        """Write only the changed fields, so that the stock changed by borrows and returns meanwhile is kept.
+
+        The conflicts are reported by BookAdminForm.clean(), with the book locked; a database without row locks
+        may still let a change through in between, which sends the user back to the form, see response_change().
+        """
+        if not change:
+            return super().save_model(request, obj, form, change)
+        current, conflicts = form.save_changes()
+        if conflicts:
+            request._book_conflicts = form.describe_conflicts(current, conflicts)
+
+    def response_change(self, request, obj):
+        if conflicts := getattr(request, '_book_conflicts', None):
+            self.message_user(request, f'The book was changed by someone else while you edited it: {conflicts}. '
+                                       f'It was not saved, edit the current values.', messages.ERROR)
+            return HttpResponseRedirect(request.path)
+        return super().response_change(request, obj)
+
 
-class BorrowRecordAdmin(admin.ModelAdmin):
+class LoanStatusListFilter(admin.SimpleListFilter):
+    """Filter loans by status, with outstanding and overdue loans read from the partial due date index."""
+    title = 'status'
+    parameter_name = 'status'
+
+    def lookups(self, request, model_admin):
+        return [('outstanding', 'Outstanding'), ('overdue', 'Overdue'), ('returned', 'Returned')]
+
+    def queryset(self, request, queryset):
+        if self.value() == 'outstanding':
+            return queryset.filter(return_date=None)
+        if self.value() == 'overdue':
+            return queryset.filter(return_date=None, due_date__lt=timezone.now().date())
+        if self.value() == 'returned':
+            return queryset.exclude(return_date=None)
+        return queryset
+
+
+class BorrowRecordAdmin(LargeTableAdmin):
     list_display = ['user', 'book', 'borrow_date', 'due_date', 'return_date']
-    list_filter = ['borrow_date', 'due_date', 'return_date']
+    list_filter = [LoanStatusListFilter]
+    list_select_related = ['user', 'book']
+    # drills down on the borrow date index, in its order
+    date_hierarchy = 'borrow_date'
+    ordering = ['-borrow_date', '-id']
+    autocomplete_fields = ['user', 'book']
+
+
+class ArchivedBorrowRecordAdmin(LargeTableAdmin):
+    list_display = ['user', 'book', 'borrow_date', 'due_date', 'return_date', 'fine']
+    list_select_related = ['user', 'book']
+    date_hierarchy = 'borrow_date'
+    ordering = ['-borrow_date', '-id']
+    raw_id_fields = ['user', 'book']
+
+
+class HoldAdmin(LargeTableAdmin):
+    list_display = ['user', 'book', 'status', 'created_at', 'ready_until']
+    list_filter = ['status']
+    list_select_related = ['user', 'book']
+    autocomplete_fields = ['user', 'book']
+
+
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ['name', 'status', 'attempts', 'created_at', 'run_at']
+    list_filter = ['status', 'name']
+    ordering = ['run_at', 'id']
+    readonly_fields = ['created_at', 'started_at', 'last_error']
 
 
-admin.site.register(User, UserAdmin)
+admin.site.register(User, LibraryUserAdmin)
 admin.site.register(Category)
 admin.site.register(Book, BookAdmin)
 admin.site.register(BorrowRecord, BorrowRecordAdmin)
+admin.site.register(ArchivedBorrowRecord, ArchivedBorrowRecordAdmin)
+admin.site.register(Hold, HoldAdmin)
+admin.site.register(Task, TaskAdmin)
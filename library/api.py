@@ -0,0 +1,235 @@
+"""JSON API over the catalog and circulation.
+
+Responses are built from values() projections rather than model instances, paginated with cursor tokens
+and gzip-compressed. Clients authenticate with the session, like the HTML views. List endpoints accept a
+``fields`` parameter with a comma-separated subset of fields to return, ``limit`` for the page size and
+``cursor`` for the next or previous page.
+"""
+import json
+from collections import defaultdict
+from functools import wraps
+
+from django.forms import modelform_factory
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import require_http_methods
+
+from .forms import BookSearchForm, BorrowRecordSearchForm
+from .models import Book, Category, BorrowRecord
+from .pagination import CursorPaginator, InvalidCursor
+
+BOOK_FIELDS = ['id', 'title', 'author', 'isbn', 'publisher', 'pub_date', 'quantity', 'category', 'description',
+               'updated_at']
+CATEGORY_FIELDS = ['id', 'name']
+BORROW_RECORD_FIELDS = ['id', 'user', 'user__username', 'book', 'book__title', 'borrow_date', 'due_date',
+                        'return_date']
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+MAX_BATCH_SIZE = 100
+
+
+class APIError(Exception):
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def api_view(methods, login_required=False, permission_required=None):
+    """Decorate a JSON API view: check the method and authentication, compress and report errors as JSON."""
+
+    def decorator(view):
+        @gzip_page
+        @require_http_methods(methods)
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            try:
+                if login_required:
+                    check_permission(request)
+                if permission_required:
+                    check_permission(request, permission_required)
+                return view(request, *args, **kwargs)
+            except APIError as e:
+                return JsonResponse({'error': str(e)}, status=e.status)
+
+        return wrapper
+
+    return decorator
+
+
+def check_permission(request, perm=None):
+    """Raise APIError if the user is not authenticated or does not have the permission."""
+    if not request.user.is_authenticated:
+        raise APIError('Authentication required.', 401)
+    if perm and not request.user.has_perm(perm):
+        raise APIError('Permission denied.', 403)
+
+
+def get_fields(request, allowed):
+    """Return the fields selected with the fields parameter, all allowed fields by default."""
+    if not (value := request.GET.get('fields')):
+        return allowed
+    fields = value.split(',')
+    if unknown := [field for field in fields if field not in allowed]:
+        raise APIError(f"Unknown fields: {', '.join(unknown)}")
+    return ['id', *(field for field in fields if field != 'id')]
+
+
+def get_json_data(request):
+    try:
+        data = json.loads(request.body or '{}')
+    except ValueError:
+        raise APIError('Invalid JSON.')
+    if not isinstance(data, dict):
+        raise APIError('Expected a JSON object.')
+    return data
+
+
+def get_ids(data, key):
+    """Return the list of ids under the key of the JSON data, for the batch endpoints."""
+    ids = data.get(key)
+    if not isinstance(ids, list) or not ids or not all(type(i) is int for i in ids):
+        raise APIError(f'Expected a non-empty list of ids in {key}.')
+    if len(ids) > MAX_BATCH_SIZE:
+        raise APIError(f'At most {MAX_BATCH_SIZE} ids are allowed in {key}.')
+    return ids
+
+
+def paginate(request, queryset, fields):
+    """Return a JSON response with a page of the queryset projected to the fields."""
+    try:
+        limit = min(int(request.GET.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+    except ValueError:
+        raise APIError('Invalid limit.')
+    if limit < 1:
+        raise APIError('Invalid limit.')
+
+    ordering = [{'pk': 'id', '-pk': '-id'}.get(field, field) for field in queryset.query.order_by or ['id']]
+    if not {'id', '-id'} & set(ordering):
+        ordering.append('id')
+    extra = [name for name in (field.lstrip('-') for field in ordering) if name not in fields]
+    paginator = CursorPaginator(queryset.values(*fields, *extra), limit, ordering)
+    try:
+        page = paginator.page(request.GET.get('cursor'))
+    except InvalidCursor as e:
+        raise APIError(str(e))
+
+    results = page.object_list
+    if extra:
+        results = [{field: row[field] for field in fields} for row in results]
+    return JsonResponse({'results': results, 'next': page.next_cursor, 'previous': page.previous_cursor})
+
+
+def create(request, model, fields):
+    """Create an object of the model from the JSON request body, return it as a JSON response."""
+    form_class = modelform_factory(model, fields='__all__')
+    form = form_class(data=get_json_data(request))
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors.get_json_data()}, status=400)
+    obj = form.save()
+    return JsonResponse(model.objects.filter(pk=obj.pk).values(*fields).get(), status=201)
+
+
+@api_view(['GET', 'POST'])
+def books(request):
+    if request.method == 'POST':
+        check_permission(request, 'library.add_book')
+        return create(request, Book, BOOK_FIELDS)
+    form = BookSearchForm(data=request.GET)
+    return paginate(request, form.filter(Book.objects.order_by('pk')), get_fields(request, BOOK_FIELDS))
+
+
+@api_view(['GET'])
+def book_detail(request, pk):
+    fields = get_fields(request, BOOK_FIELDS)
+    return JsonResponse(get_object_or_404(Book.objects.values(*fields), pk=pk))
+
+
+@api_view(['GET', 'POST'])
+def categories(request):
+    if request.method == 'POST':
+        check_permission(request, 'library.add_category')
+        return create(request, Category, CATEGORY_FIELDS)
+    return paginate(request, Category.objects.order_by('pk'), get_fields(request, CATEGORY_FIELDS))
+
+
+@api_view(['GET'], login_required=True)
+def borrow_records(request):
+    """List the borrow records of the user, or of all users filtered like the librarian listing.
+
+    The archived records are listed instead with ``archived=1``.
+    """
+    form = BorrowRecordSearchForm(data=request.GET)
+    records = form.get_model().objects.order_by('-borrow_date', '-pk')
+    if request.user.has_perm('library.view_borrowrecord'):
+        records = form.filter(records)
+    else:
+        records = records.filter(user=request.user)
+    return paginate(request, records, get_fields(request, BORROW_RECORD_FIELDS))
+
+
+def borrow_record_response(record_id, status=200):
+    return JsonResponse(BorrowRecord.objects.filter(pk=record_id).values(*BORROW_RECORD_FIELDS).get(), status=status)
+
+
+@api_view(['POST'], login_required=True)
+def borrow_book(request, pk):
+    record = BorrowRecord.objects.borrow(request.user, pk)
+    if record is None:
+        get_object_or_404(Book, pk=pk)
+        raise APIError('Out of stock.', 409)
+    return borrow_record_response(record.pk, status=201)
+
+
+@api_view(['POST'], login_required=True)
+def renew_book(request, pk):
+    record = get_object_or_404(BorrowRecord, pk=pk, user=request.user)
+    record.renew()
+    return borrow_record_response(record.pk)
+
+
+@api_view(['POST'], login_required=True)
+def return_book(request, pk):
+    record = get_object_or_404(BorrowRecord, pk=pk, user=request.user)
+    record.return_book()
+    return borrow_record_response(record.pk)
+
+
+def batch_response(key, ids, records, errors):
+    """Return a JSON response with the record of each id, or its error message if the operation failed.
+
+    errors maps ids without a record to the error message.
+    """
+    rows = BorrowRecord.objects.filter(pk__in=[record.pk for record in records if record is not None])
+    rows = {row['id']: row for row in rows.values(*BORROW_RECORD_FIELDS)}
+    results = [{key: i, 'record': rows[record.pk]} if record is not None else {key: i, 'error': errors[i]}
+               for i, record in zip(ids, records)]
+    return JsonResponse({'results': results})
+
+
+@api_view(['POST'], login_required=True)
+def borrow_books(request):
+    """Borrow the books listed in the books field, in one transaction."""
+    book_ids = get_ids(get_json_data(request), 'books')
+    records = BorrowRecord.objects.borrow_many(request.user, book_ids)
+    failed = {book_id for book_id, record in zip(book_ids, records) if record is None}
+    existing = set(Book.objects.filter(pk__in=failed).values_list('pk', flat=True)) if failed else set()
+    errors = {book_id: 'Out of stock.' if book_id in existing else 'Not found.' for book_id in failed}
+    return batch_response('book', book_ids, records, errors)
+
+
+@api_view(['POST'], login_required=True)
+def renew_books(request):
+    """Renew the borrow records listed in the records field, in one transaction."""
+    record_ids = get_ids(get_json_data(request), 'records')
+    records = BorrowRecord.objects.renew_many(request.user, record_ids)
+    return batch_response('record', record_ids, records, defaultdict(lambda: 'Not found or already returned.'))
+
+
+@api_view(['POST'], login_required=True)
+def return_books(request):
+    """Return the borrow records listed in the records field, in one transaction."""
+    record_ids = get_ids(get_json_data(request), 'records')
+    records = BorrowRecord.objects.return_many(request.user, record_ids)
+    return batch_response('record', record_ids, records, defaultdict(lambda: 'Not found or already returned.'))
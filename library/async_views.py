@@ -0,0 +1,135 @@
+"""Async versions of the catalog and borrow record views.
+
+Under ASGI every sync view runs in a thread-sensitive sync_to_async() wrapper, so requests to sync views
+are served one at a time. These views do their database work with the async ORM API instead. They are
+routed in place of the sync views when ``LIBRARY_ASYNC_VIEWS`` is true, which library_management.asgi
+sets; under WSGI they would only add an event loop to every request.
+
+Django 4.2 has no async API for the session-backed user and messages, so they are loaded in a thread
+once per request before anything else touches them. Templates are rendered in a thread by the handler.
+"""
+from calendar import timegm
+from functools import wraps
+from urllib.parse import urlencode
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.views import redirect_to_login
+from django.core.paginator import Paginator, InvalidPage
+from django.db.models import Sum
+from django.http import Http404, HttpResponseNotAllowed
+from django.template.response import TemplateResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from . import cache as catalog_cache
+from .forms import BookSearchForm
+from .models import Book
+from .pagination import CursorPaginator, InvalidCursor
+from .views import book_validators, get_borrow_history, SearchBookView, BookDetailView
+
+
+def _load_user(request):
+    # evaluating the lazy user caches it on the request, so that async code can use it
+    request.user.is_authenticated
+
+
+load_user = sync_to_async(_load_user)
+
+
+@sync_to_async
+def load_validators(request, pk=None):
+    """Load the user of the request and return the validators of the book page, see book_validators()."""
+    _load_user(request)
+    return book_validators(request, pk)
+
+
+def book_page(view):
+    """Async counterpart of the condition() and cache_catalog_page() decorators of the sync catalog views."""
+    view = catalog_cache.cache_catalog_page(view)
+
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return HttpResponseNotAllowed(['GET', 'HEAD'])
+        etag, last_modified = await load_validators(request, kwargs.get('pk'))
+        etag = quote_etag(etag) if etag else None
+        last_modified = timegm(last_modified.utctimetuple()) if last_modified else None
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = await view(request, *args, **kwargs)
+        if last_modified and not response.has_header('Last-Modified'):
+            response.headers['Last-Modified'] = http_date(last_modified)
+        if etag:
+            response.headers.setdefault('ETag', etag)
+        return response
+
+    return wrapper
+
+
+async def paginate(request, queryset, per_page):
+    """Return the paginator and the page of the request, like CursorPaginationMixin."""
+    if 'page' in request.GET:
+        paginator = Paginator(queryset, per_page)
+        # count with the async API, so that the paginator does not count synchronously
+        paginator.count = await queryset.acount()
+        page_number = request.GET['page']
+        try:
+            page = paginator.page(paginator.num_pages if page_number == 'last' else page_number)
+        except InvalidPage as e:
+            raise Http404(f'Invalid page ({page_number}): {e}')
+        page.object_list = [obj async for obj in page.object_list]
+    else:
+        paginator = CursorPaginator(queryset, per_page)
+        try:
+            page = await paginator.apage(request.GET.get('cursor'))
+        except InvalidCursor as e:
+            raise Http404(str(e))
+    return paginator, page
+
+
+@book_page
+async def book_list(request):
+    form = BookSearchForm(data=request.GET)
+    if form['category'].data:
+        # validating a category looks it up in the database
+        await sync_to_async(form.is_valid)()
+    books = form.filter(Book.objects.select_related('stats').defer('description').order_by('pk'))
+    paginator, page = await paginate(request, books, SearchBookView.paginate_by)
+
+    query_params = request.GET.copy()
+    for key in ('page', 'cursor'):
+        query_params.pop(key, None)
+    context = {
+        'form': form,
+        'paginator': paginator,
+        'page_obj': page,
+        'is_paginated': page.has_other_pages(),
+        'object_list': page.object_list,
+        'book_list': page.object_list,
+        'querystring': urlencode(query_params),
+        'cursor_pagination': isinstance(paginator, CursorPaginator),
+    }
+    return TemplateResponse(request, 'library/book_list.html', context)
+
+
+@book_page
+async def book_detail(request, pk):
+    async def get_book():
+        try:
+            return await BookDetailView.queryset.aget(pk=pk)
+        except Book.DoesNotExist:
+            raise Http404('No book found matching the query')
+
+    book = await catalog_cache.aget_or_set(['book', pk], get_book)
+    return TemplateResponse(request, 'library/book_detail.html', {'object': book, 'book': book})
+
+
+async def borrow_records(request):
+    await load_user(request)
+    if not request.user.is_authenticated:
+        return redirect_to_login(request.get_full_path())
+    records, fines = get_borrow_history(request)
+    fines = await fines.aaggregate(total=Sum('fine'))
+    context = {'borrow_record_list': [record async for record in records], 'total_fine': fines['total'],
+               'archived': request.GET.get('archived') == '1'}
+    return TemplateResponse(request, 'library/borrow_record_list.html', context)
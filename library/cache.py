@@ -0,0 +1,119 @@
+"""Versioned caching of the catalog views.
+
+Cached catalog entries are keyed by a catalog version number, which is bumped whenever a book or
+category changes or stock is borrowed or returned. Bumping the version invalidates every entry at once
+without having to find them. Entries also expire after ``LIBRARY_CATALOG_CACHE_TIMEOUT`` seconds, which
+bounds how stale they can get if a change slips past the version (e.g. a direct database update).
+"""
+import asyncio
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+VERSION_KEY = 'library:catalog-version'
+
+
+def get_timeout():
+    return getattr(settings, 'LIBRARY_CATALOG_CACHE_TIMEOUT', 60)
+
+
+def get_catalog_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # start from the current time, so that a lost version never reuses keys of old entries
+        cache.add(VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+async def aget_catalog_version():
+    version = await cache.aget(VERSION_KEY)
+    if version is None:
+        await cache.aadd(VERSION_KEY, int(time.time() * 1000), None)
+        version = await cache.aget(VERSION_KEY)
+    return version
+
+
+def _bump():
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        get_catalog_version()
+
+
+def bump_catalog_version():
+    """Invalidate all cached catalog entries.
+
+    The version is bumped both now and when the current transaction commits, so that nothing read
+    before the commit is cached under the new version.
+    """
+    _bump()
+    transaction.on_commit(_bump)
+
+
+def make_key(*parts):
+    return ':'.join(['library:catalog', str(get_catalog_version()), *map(str, parts)])
+
+
+async def amake_key(*parts):
+    return ':'.join(['library:catalog', str(await aget_catalog_version()), *map(str, parts)])
+
+
+def get_or_set(key_parts, default):
+    """Return the cached value for the key parts, computing and caching it with default() on a miss."""
+    return cache.get_or_set(make_key(*key_parts), default, get_timeout())
+
+
+async def aget_or_set(key_parts, default):
+    """Async version of get_or_set(), default is a coroutine function."""
+    key = await amake_key(*key_parts)
+    value = await cache.aget(key)
+    if value is None:
+        value = await default()
+        await cache.aadd(key, value, get_timeout())
+    return value
+
+
+def _store_page(key, response):
+    if response.status_code == 200:
+        if hasattr(response, 'render') and callable(response.render):
+            response.add_post_render_callback(lambda r: cache.set(key, r, get_timeout()))
+        else:
+            cache.set(key, response, get_timeout())
+
+
+def cache_catalog_page(view):
+    """Cache successful GET responses of a catalog view for anonymous users.
+
+    Async views must be called with the user of the request already loaded, see library.async_views.
+    """
+
+    def get_key(request):
+        return hashlib.md5(request.get_full_path().encode()).hexdigest()
+
+    if asyncio.iscoroutinefunction(view):
+        async def wrapper(request, *args, **kwargs):
+            if request.method != 'GET' or request.user.is_authenticated:
+                return await view(request, *args, **kwargs)
+            key = await amake_key('page', get_key(request))
+            response = await cache.aget(key)
+            if response is None:
+                response = await view(request, *args, **kwargs)
+                _store_page(key, response)
+            return response
+    else:
+        def wrapper(request, *args, **kwargs):
+            if request.method != 'GET' or request.user.is_authenticated:
+                return view(request, *args, **kwargs)
+            key = make_key('page', get_key(request))
+            response = cache.get(key)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                _store_page(key, response)
+            return response
+
+    return wraps(view)(wrapper)
@@ -0,0 +1,54 @@
+"""Streaming export of borrow records.
+
+Rows are read with a chunked server-side iterator as plain tuples and written out one line at a time, so
+memory stays flat and the first bytes are produced right away whatever the number of records.
+"""
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+FIELDS = {
+    'id': 'id',
+    'username': 'user__username',
+    'isbn': 'book__isbn',
+    'title': 'book__title',
+    'borrow_date': 'borrow_date',
+    'due_date': 'due_date',
+    'return_date': 'return_date',
+}
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/jsonl',
+}
+
+
+class Echo:
+    """File-like object returning what is written to it, for streaming csv.writer output."""
+
+    def write(self, value):
+        return value
+
+
+def iter_rows(records, chunk_size=2000):
+    """Iterate over the borrow records as tuples of the exported fields."""
+    return records.order_by('pk').values_list(*FIELDS.values()).iterator(chunk_size=chunk_size)
+
+
+def export_csv(records, chunk_size=2000):
+    writer = csv.writer(Echo())
+    yield writer.writerow(FIELDS)
+    for row in iter_rows(records, chunk_size):
+        yield writer.writerow(row)
+
+
+def export_jsonl(records, chunk_size=2000):
+    for row in iter_rows(records, chunk_size):
+        yield json.dumps(dict(zip(FIELDS, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+def export(records, file_format, chunk_size=2000):
+    """Return an iterator of text lines exporting the borrow records in the given format."""
+    if file_format == 'csv':
+        return export_csv(records, chunk_size)
+    return export_jsonl(records, chunk_size)
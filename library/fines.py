@@ -0,0 +1,36 @@
+"""Fine policy for overdue loans.
+
+The policy is configured with the ``LIBRARY_FINE_POLICY`` setting, a dict with the keys ``DAILY_RATE``
+(fine per overdue day), ``GRACE_DAYS`` (overdue days without a fine) and ``MAX_FINE`` (upper bound of
+the fine of one loan, None for no bound).
+"""
+from decimal import Decimal
+
+from django.conf import settings
+
+DEFAULT_POLICY = {
+    'DAILY_RATE': '0.50',
+    'GRACE_DAYS': 0,
+    'MAX_FINE': '20.00',
+}
+
+
+class FinePolicy:
+
+    def __init__(self, daily_rate, grace_days=0, max_fine=None):
+        self.daily_rate = Decimal(daily_rate)
+        self.grace_days = int(grace_days)
+        self.max_fine = Decimal(max_fine) if max_fine is not None else None
+
+    def compute(self, due_date, as_of):
+        """Return the number of overdue days and the fine of a loan due on due_date as of the given date."""
+        days_overdue = max((as_of - due_date).days, 0)
+        fine = self.daily_rate * max(days_overdue - self.grace_days, 0)
+        if self.max_fine is not None:
+            fine = min(fine, self.max_fine)
+        return days_overdue, fine
+
+
+def get_fine_policy():
+    options = {**DEFAULT_POLICY, **getattr(settings, 'LIBRARY_FINE_POLICY', {})}
+    return FinePolicy(options['DAILY_RATE'], options['GRACE_DAYS'], options['MAX_FINE'])
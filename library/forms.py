@@ -1,7 +1,12 @@
+import datetime
+
 from django import forms
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm
+from django.forms.models import model_to_dict
+from django.utils import timezone
 
-from .models import User, Category
+from .models import User, Category, Book, BorrowRecord, ArchivedBorrowRecord
+from .search import get_search_backend
 
 
 class UserRegisterForm(UserCreationForm):
@@ -20,13 +25,128 @@ class UserProfileForm(UserChangeForm):
         fields = ['first_name', 'last_name', 'email']
 
 
+class BookForm(forms.ModelForm):
+    """Edit a book, remembering the version and the values it was displayed with.
+
+    Each field sends back the value it was displayed with in a hidden input, so that changed_data holds
+    the fields the user changed, rather than those changed in the database since.
+    """
+    # the version of the book the form was displayed with
+    base_version = forms.IntegerField(widget=forms.HiddenInput)
+
+    class Meta:
+        model = Book
+        fields = '__all__'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.initial.setdefault('base_version', self.instance.version)
+        for name, field in self.fields.items():
+            field.show_hidden_initial = name != 'base_version'
+
+    @property
+    def changed_data(self):
+        return [name for name in super().changed_data if name != 'base_version']
+
+    def save_changes(self):
+        """Write the fields changed by the user, unless they were also changed since the form was displayed.
+
+        Other changes since, like the stock changed by borrows and returns, are kept: the fields are written
+        again at the new version of the book. Returns the current book and the conflicting fields, if any.
+        """
+        version = self.cleaned_data['base_version']
+        while not self.instance.compare_and_swap(version, self.changed_data):
+            current = Book.objects.get(pk=self.instance.pk)
+            if conflicts := self.get_conflicts(current):
+                return current, conflicts
+            version = current.version
+        return self.instance, []
+
+    def describe_conflicts(self, current, conflicts):
+        return ', '.join(f'{self.fields[name].label} is now {getattr(current, name)}' for name in conflicts)
+
+    def get_conflicts(self, current):
+        """Return the fields changed by the user that were also changed in the current book since."""
+        values = model_to_dict(current, fields=self.changed_data)
+        conflicts = []
+        for name in self.changed_data:
+            field = self.fields[name]
+            displayed = field.hidden_widget().value_from_datadict(self.data, self.files, self.add_initial_prefix(name))
+            if field.has_changed(values.get(name), displayed):
+                conflicts.append(name)
+        return conflicts
+
+    def rebase(self, current):
+        """Return the form with the changes entered by the user, as if it had been displayed for the current book."""
+        data = self.data.copy()
+        data['base_version'] = current.version
+        displayed = type(self)(instance=current)
+        changed = self.changed_data
+        for name, field in displayed.fields.items():
+            if field.show_hidden_initial:
+                value = field.hidden_widget().format_value(displayed[name].value())
+                data[self.add_initial_prefix(name)] = '' if value is None else value
+                if name not in changed:
+                    data[name] = data[self.add_initial_prefix(name)]
+        return type(self)(data=data, files=self.files, instance=current)
+
+
 class BookSearchForm(forms.Form):
     title = forms.CharField(max_length=200, required=False)
     author = forms.CharField(max_length=100, required=False)
     isbn = forms.CharField(max_length=13, required=False)
     category = forms.ModelChoiceField(queryset=Category.objects.all(), required=False)
 
+    def filter(self, books):
+        """Filter the books by the valid search conditions, ranked by relevance if text is searched."""
+        if self.is_valid():
+            if category := self.cleaned_data.get('category'):
+                books = books.filter(category=category)
+            terms = {field: self.cleaned_data[field] for field in ['title', 'author', 'isbn']
+                     if self.cleaned_data.get(field)}
+            if terms:
+                books = get_search_backend().search(books, terms)
+        return books
+
 
 class BorrowRecordSearchForm(forms.Form):
     username = forms.CharField(max_length=150, required=False)
     isbn = forms.CharField(max_length=13, required=False)
+    archived = forms.BooleanField(required=False, label='Archived records')
+
+    def get_model(self):
+        """Return the model of the borrow records searched, archived or live ones."""
+        return ArchivedBorrowRecord if self.is_valid() and self.cleaned_data.get('archived') else BorrowRecord
+
+    def filter(self, records):
+        """Filter the borrow records by the valid search conditions."""
+        if self.is_valid():
+            if username := self.cleaned_data.get('username'):
+                records = records.filter(user__username=username)
+            if isbn := self.cleaned_data.get('isbn'):
+                records = records.filter(book__isbn=isbn)
+        return records
+
+
+class CirculationReportForm(forms.Form):
+    start = forms.DateField(required=False)
+    end = forms.DateField(required=False)
+
+    max_days = 366
+    default_days = 30
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start, end = cleaned_data.get('start'), cleaned_data.get('end')
+        if start and end and not start <= end < start + datetime.timedelta(days=self.max_days):
+            raise forms.ValidationError(f'The period must be from 1 to {self.max_days} days long.')
+        return cleaned_data
+
+    def get_period(self):
+        """Return the first and last day of the valid period, the last 30 days by default."""
+        data = self.cleaned_data if self.is_valid() else {}
+        end = data.get('end') or timezone.now().date()
+        start = data.get('start') or end - datetime.timedelta(days=self.default_days - 1)
+        if start > end or (end - start).days >= self.max_days:
+            start = end - datetime.timedelta(days=self.default_days - 1)
+        return start, end
@@ -0,0 +1,35 @@
+import datetime
+import time
+
+from django.core.management import BaseCommand
+from django.utils import timezone
+
+from library.models import ArchivedBorrowRecord, get_archive_age
+
+
+class Command(BaseCommand):
+    help = 'Move borrow records returned before a cutoff date to the archive table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--before', type=datetime.date.fromisoformat,
+                            help='Archive records returned before this date (YYYY-MM-DD), '
+                                 'LIBRARY_ARCHIVE_AFTER_DAYS days ago by default')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Number of records archived at a time')
+
+    def handle(self, *args, **options):
+        before = options['before'] or timezone.now().date() - get_archive_age()
+        batch_size = options['batch_size']
+        start = time.perf_counter()
+
+        # each batch is a transaction of its own, so that the borrow record table is never locked for long
+        archived = 0
+        while True:
+            count = ArchivedBorrowRecord.objects.archive(before, batch_size)
+            archived += count
+            if count:
+                self.stdout.write(f'{archived} records archived')
+            if count < batch_size:
+                break
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f'Archived {archived} records returned before {before} in {elapsed:.1f}s')
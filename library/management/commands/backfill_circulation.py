@@ -0,0 +1,40 @@
+import datetime
+import time
+
+from django.core.management import BaseCommand
+from django.db.models import Min
+from django.utils import timezone
+
+from library.models import BorrowRecord, ArchivedBorrowRecord, DailyCirculation
+
+
+class Command(BaseCommand):
+    help = 'Compute the daily circulation rollups of a period from the borrow records, archived ones included'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=datetime.date.fromisoformat,
+                            help='First day (YYYY-MM-DD), the day of the first loan by default')
+        parser.add_argument('--until', type=datetime.date.fromisoformat, help='Last day (YYYY-MM-DD), today by default')
+        parser.add_argument('--chunk-days', type=int, default=31, help='Number of days computed at a time')
+
+    def handle(self, *args, **options):
+        until = options['until'] or timezone.now().date()
+        since = options['since']
+        if since is None:
+            firsts = [model.objects.aggregate(first=Min('borrow_date'))['first']
+                      for model in (BorrowRecord, ArchivedBorrowRecord)]
+            since = min(filter(None, firsts), default=until)
+        start = time.perf_counter()
+
+        # each chunk of days is read through the date indexes and written in a transaction of its own
+        day = since
+        count = 0
+        while day <= until:
+            dates = [day + datetime.timedelta(days=offset) for offset in range(options['chunk_days'])]
+            dates = [date for date in dates if date <= until]
+            DailyCirculation.objects.refresh(dates)
+            count += len(dates)
+            day = dates[-1] + datetime.timedelta(days=1)
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f'Backfilled the circulation of {count} days from {since} to {until} in {elapsed:.1f}s')
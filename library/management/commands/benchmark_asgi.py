@@ -0,0 +1,121 @@
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.test import Client, AsyncClient, override_settings
+from django.urls import reverse
+
+from library.models import User
+
+
+class Command(BaseCommand):
+    help = 'Compare requests per second and latency of a page served through the WSGI and the ASGI handler'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interface', choices=['wsgi', 'asgi', 'both'], default='both',
+                            help='Handler to benchmark; both runs each one in a child process')
+        parser.add_argument('--path', help='Path of the page, the book list by default')
+        parser.add_argument('--requests', type=int, default=2000, help='Total number of requests')
+        parser.add_argument('--concurrency', type=int, default=50, help='Number of concurrent clients')
+        parser.add_argument('--user', help='Username to log the clients in as; anonymous pages may be cached')
+
+    def handle(self, *args, **options):
+        if options['interface'] == 'both':
+            for interface in ('wsgi', 'asgi'):
+                self.run_child(interface, options)
+            return
+
+        path = options['path'] or reverse('library:book-list')
+        user = None
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+            if user is None:
+                raise CommandError(f"User {options['user']} does not exist")
+        # the test clients send requests to the testserver host
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            if options['interface'] == 'wsgi':
+                latencies, statuses, elapsed = self.run_wsgi(path, user, options)
+            else:
+                latencies, statuses, elapsed = asyncio.run(self.run_asgi(path, user, options))
+
+        views = 'async' if getattr(settings, 'LIBRARY_ASYNC_VIEWS', False) else 'sync'
+        p50, p99 = (statistics.quantiles(latencies, n=100)[i] for i in (49, 98))
+        self.stdout.write(
+            f"{options['interface'].upper()} ({views} views) {path}: {len(latencies)} requests, "
+            f"{options['concurrency']} concurrent, {len(latencies) / elapsed:.1f} requests/s, "
+            f"p50 {p50 * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms"
+        )
+        if errors := sum(count for status, count in statuses.items() if status >= 400):
+            self.stderr.write(f'{errors} responses with error status: {statuses}')
+
+    def run_child(self, interface, options):
+        """Run the benchmark of one interface in a new process, with the views that interface is served with."""
+        arguments = [sys.executable, '-m', 'django', 'benchmark_asgi', '--interface', interface,
+                     '--requests', str(options['requests']), '--concurrency', str(options['concurrency'])]
+        for name in ('path', 'user'):
+            if options[name]:
+                arguments += [f'--{name}', options[name]]
+        env = {**os.environ, 'LIBRARY_ASYNC_VIEWS': '1' if interface == 'asgi' else ''}
+        env.setdefault('DJANGO_SETTINGS_MODULE', settings.SETTINGS_MODULE)
+        result = subprocess.run(arguments, env=env, capture_output=True, text=True)
+        self.stdout.write(result.stdout, ending='')
+        self.stderr.write(result.stderr, ending='')
+        if result.returncode:
+            raise CommandError(f'The {interface} benchmark failed')
+
+    def run_wsgi(self, path, user, options):
+        """Send the requests from a pool of threads, like a threaded WSGI server."""
+        local = threading.local()
+        statuses = {}
+
+        def get_client():
+            if not hasattr(local, 'client'):
+                local.client = Client()
+                if user is not None:
+                    local.client.force_login(user)
+            return local.client
+
+        def send(_):
+            client = get_client()
+            start = time.perf_counter()
+            response = client.get(path)
+            return time.perf_counter() - start, response.status_code
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options['concurrency']) as executor:
+            latencies = []
+            for latency, status in executor.map(send, range(options['requests'])):
+                latencies.append(latency)
+                statuses[status] = statuses.get(status, 0) + 1
+        return latencies, statuses, time.perf_counter() - start
+
+    async def run_asgi(self, path, user, options):
+        """Send the requests from concurrent tasks on one event loop, like an ASGI server."""
+        clients = [AsyncClient() for _ in range(options['concurrency'])]
+        if user is not None:
+            for client in clients:
+                await sync_to_async(client.force_login)(user)
+        latencies = []
+        statuses = {}
+        remaining = options['requests']
+
+        async def worker(client):
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                start = time.perf_counter()
+                response = await client.get(path)
+                latencies.append(time.perf_counter() - start)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for client in clients))
+        return latencies, statuses, time.perf_counter() - start
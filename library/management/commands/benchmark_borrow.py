@@ -0,0 +1,70 @@
+import threading
+import time
+import uuid
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, OperationalError
+
+from library.models import User, Book, BorrowRecord
+
+
+class Command(BaseCommand):
+    help = 'Stress the borrow path with concurrent borrows of one hot book'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help='Number of concurrent borrowers')
+        parser.add_argument('--attempts', type=int, default=200, help='Borrow attempts per thread')
+        parser.add_argument('--stock', type=int, default=1000, help='Initial quantity of the hot book')
+
+    def handle(self, *args, **options):
+        threads, attempts, stock = options['threads'], options['attempts'], options['stock']
+        suffix = uuid.uuid4().hex[:8]
+        user = User.objects.create_user(username=f'benchmark-{suffix}')
+        book = Book.objects.create(title='Benchmark Book', author='Benchmark', isbn=suffix, quantity=stock)
+
+        lock = threading.Lock()
+        counts = {'borrowed': 0, 'out_of_stock': 0, 'errors': 0}
+
+        def borrower():
+            borrowed = out_of_stock = errors = 0
+            try:
+                for _ in range(attempts):
+                    try:
+                        if BorrowRecord.objects.borrow(user, book.pk) is None:
+                            out_of_stock += 1
+                        else:
+                            borrowed += 1
+                    except OperationalError:
+                        errors += 1
+            finally:
+                connection.close()
+            with lock:
+                counts['borrowed'] += borrowed
+                counts['out_of_stock'] += out_of_stock
+                counts['errors'] += errors
+
+        workers = [threading.Thread(target=borrower) for _ in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        book.refresh_from_db()
+        records = BorrowRecord.objects.filter(book=book).count()
+        oversold = max(records - stock, 0)
+        lost = stock - book.quantity - records
+        try:
+            self.stdout.write(
+                f"{threads} threads x {attempts} attempts on a book with {stock} copies in {elapsed:.2f}s: "
+                f"{counts['borrowed']} borrowed, {counts['out_of_stock']} out of stock, {counts['errors']} errors, "
+                f"{counts['borrowed'] / elapsed:.1f} borrows/s"
+            )
+            self.stdout.write(f'{records} borrow records, {book.quantity} copies left, '
+                              f'{oversold} oversold, {lost} lost updates')
+            if oversold or lost or records != counts['borrowed']:
+                raise CommandError('Stock is inconsistent with borrow records')
+        finally:
+            book.delete()
+            user.delete()
@@ -0,0 +1,191 @@
+import json
+import math
+import random
+import time
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from library.models import User, Book, BorrowRecord, BookStats
+
+ENDPOINTS = ['search', 'book-list', 'book-detail', 'popular-books', 'borrow', 'return', 'borrow-records',
+             'admin-borrow-records', 'api-books']
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of sorted values."""
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+class Command(BaseCommand):
+    help = ('Measure latency percentiles and throughput of the main library endpoints through the URL patterns, '
+            'on the current data (e.g. generated with seed_library)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Number of timed requests per endpoint')
+        parser.add_argument('--warmup', type=int, default=10, help='Number of untimed requests per endpoint')
+        parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=ENDPOINTS,
+                            help='Endpoints to measure, all by default')
+        parser.add_argument('--output', help='Write the results to this JSON file, to be used as a baseline')
+        parser.add_argument('--baseline', help='Compare the results with a JSON file written by --output')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Fail if the p95 latency of an endpoint grew by more than this fraction of the '
+                                 'baseline')
+
+    def handle(self, *args, **options):
+        if not Book.objects.filter(quantity__gt=0).exists():
+            raise CommandError('There are no books in stock, seed the database first')
+        librarians = Group.objects.filter(name='Librarian').first()
+        if librarians is None:
+            raise CommandError('The Librarian group does not exist, run loadgroupperms first')
+
+        suffix = random.randrange(10 ** 8)
+        patron = User.objects.create_user(username=f'benchmark-patron-{suffix}')
+        librarian = User.objects.create_user(username=f'benchmark-librarian-{suffix}')
+        librarian.groups.add(librarians)
+        self.clients = {}
+        for user in (patron, librarian):
+            self.clients[user] = Client()
+            self.clients[user].force_login(user)
+        self.patron, self.librarian = patron, librarian
+        self.count = options['requests'] + options['warmup']
+
+        results = {}
+        try:
+            # the test clients send requests to the testserver host
+            with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+                for name in options['endpoints']:
+                    results[name] = self.measure(name, options['warmup'])
+        finally:
+            self.clean_up()
+
+        self.stdout.write(f"{'endpoint':<22}{'requests':>9}{'errors':>8}{'req/s':>9}"
+                          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+        for name, result in results.items():
+            self.stdout.write(f"{name:<22}{result['requests']:>9}{result['errors']:>8}{result['throughput']:>9.1f}"
+                              f"{result['p50_ms']:>9.1f}{result['p95_ms']:>9.1f}{result['p99_ms']:>9.1f}")
+
+        if options['output']:
+            report = {
+                'created_at': timezone.now().isoformat(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'books': Book.objects.count(),
+                'borrow_records': BorrowRecord.objects.count(),
+                'endpoints': results,
+            }
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Wrote the results to {options['output']}")
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['tolerance'])
+
+    def measure(self, name, warmup):
+        requests = list(getattr(self, 'requests_' + name.replace('-', '_'))())
+        latencies = []
+        errors = 0
+        start = None
+        for i, (user, method, url, data) in enumerate(requests):
+            if i == warmup:
+                start = time.perf_counter()
+                latencies = []
+                errors = 0
+            request_start = time.perf_counter()
+            response = getattr(self.clients[user], method)(url, data)
+            latencies.append(time.perf_counter() - request_start)
+            errors += response.status_code >= 400
+        elapsed = time.perf_counter() - start if start is not None else sum(latencies)
+        latencies.sort()
+        return {
+            'requests': len(latencies),
+            'errors': errors,
+            'throughput': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        }
+
+    def compare(self, results, path, tolerance):
+        with open(path) as f:
+            baseline = json.load(f)['endpoints']
+        regressions = []
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            before, after = baseline[name]['p95_ms'], result['p95_ms']
+            change = (after - before) / before if before else 0.0
+            self.stdout.write(f'{name}: p95 {before:.1f} ms -> {after:.1f} ms ({change:+.0%})')
+            if change > tolerance:
+                regressions.append(name)
+        if regressions:
+            raise CommandError(f"p95 latency regressed by more than {tolerance:.0%}: {', '.join(regressions)}")
+
+    def sample_books(self, **filters):
+        """Return the ids of self.count random books, picked by seeking from random primary keys."""
+        books = Book.objects.filter(**filters).order_by('pk').values_list('pk', flat=True)
+        first, last = books.first(), books.last()
+        ids = []
+        for _ in range(self.count):
+            ids.append(books.filter(pk__gte=random.randint(first, last)).first())
+        return ids
+
+    def requests_search(self):
+        ids = self.sample_books()
+        titles = Book.objects.in_bulk(ids)
+        for book_id in ids:
+            word = random.choice(titles[book_id].title.split()) if book_id in titles else ''
+            yield self.patron, 'get', reverse('library:book-list'), {'title': word}
+
+    def requests_book_list(self):
+        for _ in range(self.count):
+            yield self.patron, 'get', reverse('library:book-list'), {}
+
+    def requests_book_detail(self):
+        for book_id in self.sample_books():
+            yield self.patron, 'get', reverse('library:book-detail', args=(book_id,)), {}
+
+    def requests_popular_books(self):
+        for _ in range(self.count):
+            yield self.patron, 'get', reverse('library:popular-books'), {}
+
+    def requests_borrow(self):
+        for book_id in self.sample_books(quantity__gt=0):
+            yield self.patron, 'post', reverse('library:borrow-book', args=(book_id,)), {}
+
+    def requests_return(self):
+        records = list(BorrowRecord.objects.filter(user=self.patron, return_date=None).values_list('pk', flat=True))
+        if len(records) < self.count:
+            books = self.sample_books(quantity__gt=0)[:self.count - len(records)]
+            records += [record.pk for record in BorrowRecord.objects.borrow_many(self.patron, books) if record]
+        for record_id in records[:self.count]:
+            yield self.patron, 'post', reverse('library:return-book', args=(record_id,)), {}
+
+    def requests_borrow_records(self):
+        for _ in range(self.count):
+            yield self.patron, 'get', reverse('library:borrow-records'), {}
+
+    def requests_admin_borrow_records(self):
+        ids = self.sample_books()
+        isbns = dict(Book.objects.filter(pk__in=ids).values_list('pk', 'isbn'))
+        for i, book_id in enumerate(ids):
+            data = {'isbn': isbns[book_id]} if i % 2 and book_id in isbns else {}
+            yield self.librarian, 'get', reverse('library:admin-borrow-records'), data
+
+    def requests_api_books(self):
+        for _ in range(self.count):
+            yield self.patron, 'get', reverse('library:api-books'), {'fields': 'title,author,quantity'}
+
+    def clean_up(self):
+        """Return the books borrowed by the benchmark, then delete its users and their records."""
+        records = list(BorrowRecord.objects.filter(user=self.patron, return_date=None).values_list('pk', flat=True))
+        BorrowRecord.objects.return_many(self.patron, records)
+        book_ids = list(BorrowRecord.objects.filter(user=self.patron).values_list('book_id', flat=True).distinct())
+        self.patron.delete()
+        self.librarian.delete()
+        BookStats.objects.rebuild(book_ids)
@@ -0,0 +1,97 @@
+import time
+
+from django.core.management import BaseCommand, call_command
+from django.db import connection, transaction
+from django.utils import timezone
+
+from library.models import Book, BorrowRecord
+
+# the indexes of the circulation access paths, measured against the queries below; the indexes added since
+# serve other queries and are kept
+BENCHMARKED_INDEXES = {
+    Book: ['book_title_idx', 'book_author_idx'],
+    BorrowRecord: ['borrow_user_date_idx', 'borrow_date_idx', 'borrow_outstanding_due_idx'],
+}
+
+
+class Command(BaseCommand):
+    help = 'Compare query plans and latencies of the circulation queries with and without their indexes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', action='store_true', help='Seed the database with random data first')
+        parser.add_argument('--users', type=int, default=10000, help='Number of users to seed')
+        parser.add_argument('--books', type=int, default=100000, help='Number of books to seed')
+        parser.add_argument('--records', type=int, default=1000000,
+                            help='Number of borrow records to seed, e.g. 10000000')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Number of rows inserted at a time')
+        parser.add_argument('--repeat', type=int, default=5, help='Number of runs of each query')
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            call_command('seed_library', users=options['users'], books=options['books'], records=options['records'],
+                         batch_size=options['batch_size'], skip_rebuild=True, stdout=self.stdout)
+
+        queries = self.get_queries()
+        indexes = [(model, index) for model, names in BENCHMARKED_INDEXES.items()
+                   for index in model._meta.indexes if index.name in names]
+        if connection.features.can_rollback_ddl:
+            with transaction.atomic():
+                # measure without the indexes, then roll the DROP INDEX statements back
+                self.drop_indexes(indexes)
+                before = self.measure(queries, options['repeat'])
+                transaction.set_rollback(True)
+        else:
+            # e.g. MySQL commits each DROP INDEX, so the indexes are created again
+            self.drop_indexes(indexes)
+            try:
+                before = self.measure(queries, options['repeat'])
+            finally:
+                self.create_indexes(indexes)
+        after = self.measure(queries, options['repeat'])
+
+        for name in queries:
+            self.stdout.write(f'== {name}')
+            for label, results in (('before', before), ('after', after)):
+                plan, latency = results[name]
+                self.stdout.write(f'{label}: {latency * 1000:.2f} ms')
+                self.stdout.write('    ' + plan.replace('\n', '\n    '))
+
+    def drop_indexes(self, indexes):
+        # the schema editor of SQLite cannot run in a transaction, so the statements are executed directly
+        sql = connection.schema_editor().sql_delete_index
+        with connection.cursor() as cursor:
+            for model, index in indexes:
+                cursor.execute(sql % {
+                    'table': connection.ops.quote_name(model._meta.db_table),
+                    'name': connection.ops.quote_name(index.name),
+                })
+
+    def create_indexes(self, indexes):
+        with connection.schema_editor() as editor:
+            for model, index in indexes:
+                editor.add_index(model, index)
+
+    def get_queries(self):
+        today = timezone.now().date()
+        user_id = BorrowRecord.objects.values_list('user_id', flat=True).order_by('-pk').first()
+        author = Book.objects.values_list('author', flat=True).order_by('-pk').first()
+        return {
+            'borrow history of a user': BorrowRecord.objects.filter(user_id=user_id).order_by('-borrow_date')[:50],
+            'latest borrow records': BorrowRecord.objects.order_by('-borrow_date', '-pk')[:50],
+            'overdue loans':
+                BorrowRecord.objects.filter(return_date=None, due_date__lt=today).order_by('due_date')[:100],
+            'books by author': Book.objects.filter(author=author),
+            'books by title': Book.objects.order_by('title')[:20],
+        }
+
+    def measure(self, queries, repeat):
+        results = {}
+        for name, queryset in queries.items():
+            plan = queryset.explain()
+            latencies = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                list(queryset.all())
+                latencies.append(time.perf_counter() - start)
+            results[name] = (plan, min(latencies))
+        return results
@@ -0,0 +1,34 @@
+import datetime
+import time
+
+from django.core.management import BaseCommand
+from django.utils import timezone
+
+from library.models import Hold
+
+
+class Command(BaseCommand):
+    help = 'Expire holds not picked up in time and hand their copies to the next holders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', type=datetime.date.fromisoformat,
+                            help='Expire holds ready until before this date (YYYY-MM-DD), today by default')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of holds expired at a time')
+
+    def handle(self, *args, **options):
+        as_of = options['date'] or timezone.now().date()
+        batch_size = options['batch_size']
+        start = time.perf_counter()
+
+        # each batch is a transaction of its own, so that holds are never locked for the whole run
+        expired = 0
+        while True:
+            count = Hold.objects.expire(as_of, batch_size)
+            expired += count
+            if count:
+                self.stdout.write(f'{expired} holds expired')
+            if count < batch_size:
+                break
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f'Expired {expired} holds as of {as_of} in {elapsed:.1f}s')
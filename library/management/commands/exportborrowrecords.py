@@ -0,0 +1,30 @@
+from django.core.management import BaseCommand, CommandError
+
+from library import export
+from library.forms import BorrowRecordSearchForm
+
+
+class Command(BaseCommand):
+    help = 'Export borrow records as CSV or JSON Lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=list(export.FORMATS), default='csv', help='Output format')
+        parser.add_argument('--username', help='Only export records of this user')
+        parser.add_argument('--isbn', help='Only export records of the book with this ISBN')
+        parser.add_argument('--archived', action='store_true', help='Export the archived records instead')
+        parser.add_argument('--output', '-o', help='Output file, stdout by default')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Number of rows fetched at a time')
+
+    def handle(self, *args, **options):
+        form = BorrowRecordSearchForm(data={'username': options['username'], 'isbn': options['isbn'],
+                                            'archived': options['archived']})
+        if not form.is_valid():
+            raise CommandError(form.errors.as_text())
+        records = form.filter(form.get_model().objects.all())
+        lines = export.export(records, options['format'], options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as f:
+                f.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,115 @@
+import contextlib
+import csv
+import datetime
+import json
+import sys
+import time
+from pathlib import Path
+
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+
+from library.cache import bump_catalog_version
+from library.models import Book, Category, Hold
+from library.search import get_search_backend, SEARCH_FIELDS
+
+# the stock of an existing book is changed by its loans, so it is only overwritten with --update-quantity
+UPDATE_FIELDS = ['title', 'author', 'publisher', 'pub_date', 'category', 'description', 'updated_at']
+
+
+class Command(BaseCommand):
+    help = 'Import books from CSV or JSON Lines files, updating existing books with the same ISBN'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', help='CSV (.csv) or JSON Lines (.jsonl) files, - for stdin')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='File format, guessed from the extension by default')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of books written at a time')
+        parser.add_argument('--update-quantity', action='store_true',
+                            help='Overwrite the quantity of existing books, which is only set for new books by default')
+
+    def handle(self, *args, **options):
+        self.batch_size = options['batch_size']
+        self.update_fields = [*UPDATE_FIELDS, 'quantity'] if options['update_quantity'] else UPDATE_FIELDS
+        self.categories = dict(Category.objects.values_list('name', 'id'))
+        self.imported = self.skipped = 0
+        self.start = time.perf_counter()
+
+        try:
+            for path in options['files']:
+                file_format = options['format'] or Path(path).suffix.lstrip('.').lower()
+                if file_format not in ('csv', 'jsonl'):
+                    raise CommandError(f'Cannot guess the format of {path}, use --format')
+                # stdin is left open for the caller
+                opened = contextlib.nullcontext(sys.stdin) if path == '-' else open(path, newline='', encoding='utf-8')
+                with opened as f:
+                    rows = (csv.DictReader(f) if file_format == 'csv'
+                            else (json.loads(line) for line in f if line.strip()))
+                    self.import_rows(rows)
+        finally:
+            # bulk_create() sends no post_save signals, so the cached catalog is invalidated once for all the batches
+            if self.imported:
+                bump_catalog_version()
+
+        elapsed = time.perf_counter() - self.start
+        self.stdout.write(f'Imported {self.imported} books in {elapsed:.1f}s ({self.imported / elapsed:.0f} rows/s), '
+                          f'skipped {self.skipped} invalid rows')
+
+    def import_rows(self, rows):
+        batch = {}
+        for row in rows:
+            try:
+                book = self.build_book(row)
+            except (ValueError, TypeError) as e:
+                self.skipped += 1
+                self.stderr.write(f'Skipped {row}: {e}')
+                continue
+            # the last row wins if an ISBN appears twice in a batch
+            batch[book.isbn] = book
+            if len(batch) == self.batch_size:
+                self.write_batch(batch)
+                batch = {}
+        self.write_batch(batch)
+
+    def build_book(self, row):
+        values = {key: str(value).strip() if value is not None else '' for key, value in row.items() if key}
+        for field in ('title', 'author', 'isbn'):
+            if not values.get(field):
+                raise ValueError(f'{field} is required')
+        pub_date = values.get('pub_date')
+        return Book(
+            title=values['title'],
+            author=values['author'],
+            isbn=values['isbn'],
+            publisher=values.get('publisher', ''),
+            pub_date=datetime.date.fromisoformat(pub_date) if pub_date else None,
+            quantity=int(values.get('quantity') or 1),
+            category_id=self.get_category_id(values.get('category')),
+            description=values.get('description', ''),
+        )
+
+    def get_category_id(self, name):
+        if not name:
+            return None
+        if name not in self.categories:
+            self.categories[name] = Category.objects.get_or_create(name=name)[0].id
+        return self.categories[name]
+
+    def write_batch(self, batch):
+        if not batch:
+            return
+        with transaction.atomic():
+            existing = list(Book.objects.filter(isbn__in=batch).values_list('pk', flat=True))
+            Book.objects.bulk_create(batch.values(), update_conflicts=True, unique_fields=['isbn'],
+                                     update_fields=self.update_fields)
+            # the updated books fail the compare-and-swap of the edits opened before the import
+            Book.objects.filter(pk__in=existing).update(version=F('version') + 1)
+            if 'quantity' in self.update_fields:
+                # the copies added to existing books go to the users waiting for them before the shelf
+                Hold.objects.fill(existing)
+            # bulk_create() sends no post_save signals, so index the batch explicitly
+            get_search_backend().index(list(Book.objects.filter(isbn__in=batch).only(*SEARCH_FIELDS)))
+        self.imported += len(batch)
+        elapsed = time.perf_counter() - self.start
+        self.stdout.write(f'{self.imported} books imported ({self.imported / elapsed:.0f} rows/s)')
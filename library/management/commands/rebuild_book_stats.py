@@ -0,0 +1,22 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from library.models import Book, BookStats
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the circulation counters of all books from their borrow records'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of books processed at a time')
+
+    def handle(self, *args, **options):
+        book_ids = Book.objects.order_by('pk').values_list('pk', flat=True)
+        count = 0
+        last_id = 0
+        while batch := list(book_ids.filter(pk__gt=last_id)[:options['batch_size']]):
+            with transaction.atomic():
+                BookStats.objects.rebuild(batch)
+            count += len(batch)
+            last_id = batch[-1]
+        self.stdout.write(f'Rebuilt the stats of {count} books')
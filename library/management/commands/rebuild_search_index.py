@@ -0,0 +1,17 @@
+from django.core.management import BaseCommand
+
+from library.models import Book
+from library.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index of the book catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of books indexed at a time')
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        # each batch is committed on its own by rebuild()
+        count = backend.rebuild(Book.objects.order_by('pk'), batch_size=options['batch_size'])
+        self.stdout.write(f'Indexed {count} books with {type(backend).__name__}')
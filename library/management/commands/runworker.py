@@ -0,0 +1,33 @@
+import signal
+
+from django.core.management import BaseCommand
+
+from library.models import Task
+from library.tasks import Worker
+
+
+class Command(BaseCommand):
+    help = 'Run the queued background tasks in a pool of threads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, help='Number of tasks run at the same time (LIBRARY_TASKS)')
+        parser.add_argument('--burst', action='store_true', help='Stop once the queue is empty')
+        parser.add_argument('--metrics', action='store_true', help='Print the queue depth and latency, then exit')
+
+    def handle(self, *args, **options):
+        if options['metrics']:
+            metrics = Task.objects.metrics()
+            self.stdout.write(' '.join(f'{key}={value}' for key, value in metrics.items()))
+            return
+
+        worker = Worker(threads=options['threads'], burst=options['burst'])
+        # finish the running tasks on SIGTERM, like on Ctrl-C
+        previous = signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+        try:
+            self.stdout.write(f'Running tasks with {worker.threads} threads')
+            worker.run()
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+        stats = worker.stats()
+        self.stdout.write(f"Ran {stats['processed']} tasks, {stats['failed']} failed, "
+                          f"queue wait p50 {stats['wait_p50_ms']} ms, p95 {stats['wait_p95_ms']} ms")
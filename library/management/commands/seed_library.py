@@ -0,0 +1,166 @@
+import datetime
+import random
+import time
+from contextlib import contextmanager
+
+from django.core.management import BaseCommand, call_command
+from django.db import connection, transaction
+from django.utils import timezone
+
+from library.models import User, Category, Book, BorrowRecord
+
+WORDS = ['Python', 'Django', 'Data', 'Web', 'Systems', 'Design', 'History', 'Modern', 'Art', 'Science', 'Guide',
+         'Introduction', 'Advanced', 'Practical', 'Theory', 'World', 'Network', 'Algorithms', 'Music', 'Economics',
+         'Garden', 'Ocean', 'Mountain', 'City', 'Night', 'Light', 'Secret', 'Story', 'Journey', 'Language']
+CATEGORIES = ['Programming', 'Fiction', 'History', 'Science', 'Art', 'Business', 'Travel', 'Children', 'Poetry',
+              'Philosophy', 'Cooking', 'Health', 'Music', 'Mathematics', 'Engineering', 'Law', 'Politics', 'Sports']
+PUBLISHERS = ['Pearson', "O'Reilly", 'Penguin', 'HarperCollins', 'Springer', 'Wiley', 'Macmillan', 'Hachette']
+
+
+class Command(BaseCommand):
+    help = 'Bulk-generate users, categories, books and borrow histories for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000, help='Number of users')
+        parser.add_argument('--categories', type=int, default=len(CATEGORIES), help='Number of categories')
+        parser.add_argument('--books', type=int, default=100000, help='Number of books, e.g. 1000000')
+        parser.add_argument('--records', type=int, default=1000000, help='Number of borrow records, e.g. 20000000')
+        parser.add_argument('--years', type=int, default=3, help='Number of years of borrow history')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Number of rows inserted at a time')
+        parser.add_argument('--random-seed', type=int, help='Seed of the random generator, for repeatable data')
+        parser.add_argument('--defer-indexes', action='store_true',
+                            help='Drop the secondary indexes while inserting and create them again afterwards')
+        parser.add_argument('--skip-rebuild', action='store_true',
+                            help='Do not rebuild the book stats and the search index of the new data')
+
+    def handle(self, *args, **options):
+        random.seed(options['random_seed'])
+        start = time.perf_counter()
+        batch_size = options['batch_size']
+        models = [Book, BorrowRecord]
+        if options['defer_indexes']:
+            self.drop_indexes(models)
+        try:
+            with self.fast_inserts():
+                users = self.seed_users(options['users'], batch_size)
+                categories = self.seed_categories(options['categories'], batch_size)
+                books = self.seed_books(options['books'], categories, batch_size)
+                self.seed_records(options['records'], users, books, options['years'], batch_size)
+        finally:
+            if options['defer_indexes']:
+                self.create_indexes(models)
+        if not options['skip_rebuild']:
+            call_command('rebuild_book_stats', batch_size=batch_size, stdout=self.stdout)
+            call_command('rebuild_search_index', batch_size=batch_size, stdout=self.stdout)
+        self.stdout.write(f'Seeded the library in {time.perf_counter() - start:.1f}s')
+
+    def seed_users(self, count, batch_size):
+        first = self.next_id(User)
+        now = timezone.now()
+        self.insert(User, ['id', 'username', 'password', 'first_name', 'last_name', 'email', 'is_superuser',
+                           'is_staff', 'is_active', 'date_joined'],
+                    ((first + i, f'user{first + i}', '!', '', '', '', False, False, True, now) for i in range(count)),
+                    batch_size)
+        return range(first, first + count)
+
+    def seed_categories(self, count, batch_size):
+        first = self.next_id(Category)
+        names = (CATEGORIES[i % len(CATEGORIES)] + (f' {i // len(CATEGORIES) + 1}' if i >= len(CATEGORIES) else '')
+                 for i in range(count))
+        self.insert(Category, ['id', 'name'], ((first + i, name) for i, name in enumerate(names)), batch_size)
+        return range(first, first + count)
+
+    def seed_books(self, count, categories, batch_size):
+        first = self.next_id(Book)
+        now = timezone.now()
+        today = now.date()
+
+        def rows():
+            for book_id in range(first, first + count):
+                title = ' '.join(random.sample(WORDS, random.randint(2, 5)))
+                pub_date = today - datetime.timedelta(days=random.randrange(50 * 365))
+                category = random.choice(categories) if categories and random.random() < 0.9 else None
+                yield (book_id, title, f'Author {random.randrange(count // 10 + 1)}', f'B{book_id}',
+                       random.choice(PUBLISHERS), pub_date, random.randint(0, 10), category, '', now, 1)
+
+        self.insert(Book, ['id', 'title', 'author', 'isbn', 'publisher', 'pub_date', 'quantity', 'category_id',
+                           'description', 'updated_at', 'version'], rows(), batch_size)
+        return range(first, first + count)
+
+    def seed_records(self, count, users, books, years, batch_size):
+        today = timezone.now().date()
+
+        def pick(ids):
+            # skewed towards the first ids, so that a few books and users account for most loans
+            return ids[int(len(ids) * random.random() ** 3)]
+
+        def rows():
+            for _ in range(count):
+                borrow_date = today - datetime.timedelta(days=random.randrange(years * 365))
+                due_date = borrow_date + datetime.timedelta(days=14)
+                returned = borrow_date + datetime.timedelta(days=random.randrange(30))
+                yield (pick(users), pick(books), borrow_date, due_date,
+                       returned if returned < today and random.random() < 0.95 else None)
+
+        if users and books:
+            self.insert(BorrowRecord, ['user_id', 'book_id', 'borrow_date', 'due_date', 'return_date'], rows(),
+                        batch_size)
+
+    def next_id(self, model):
+        return (model.objects.order_by('-pk').values_list('pk', flat=True).first() or 0) + 1
+
+    def insert(self, model, columns, rows, batch_size):
+        """Insert rows with plain executemany, bypassing model instances for speed."""
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            connection.ops.quote_name(model._meta.db_table),
+            ', '.join(connection.ops.quote_name(c) for c in columns),
+            ', '.join(['%s'] * len(columns)),
+        )
+        start = time.perf_counter()
+        count = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                count += self.insert_batch(sql, batch)
+                batch = []
+        count += self.insert_batch(sql, batch)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f'Seeded {count} rows into {model._meta.db_table} in {elapsed:.1f}s')
+
+    def insert_batch(self, sql, batch):
+        if batch:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.executemany(sql, batch)
+        return len(batch)
+
+    @contextmanager
+    def fast_inserts(self):
+        """Skip the fsync of every batch on SQLite while inserting; a crash while seeding may corrupt the database."""
+        if connection.vendor != 'sqlite' or connection.in_atomic_block:
+            yield
+            return
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            synchronous = cursor.fetchone()[0]
+            cursor.execute('PRAGMA synchronous = OFF')
+        try:
+            yield
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute(f'PRAGMA synchronous = {int(synchronous)}')
+
+    def drop_indexes(self, models):
+        with connection.schema_editor() as editor:
+            for model in models:
+                for index in model._meta.indexes:
+                    editor.remove_index(model, index)
+
+    def create_indexes(self, models):
+        start = time.perf_counter()
+        with connection.schema_editor() as editor:
+            for model in models:
+                for index in model._meta.indexes:
+                    editor.add_index(model, index)
+        self.stdout.write(f'Created the indexes in {time.perf_counter() - start:.1f}s')
+
@@ -0,0 +1,75 @@
+import datetime
+import time
+
+from django.core.mail import EmailMessage, get_connection
+from django.core.management import BaseCommand
+from django.db.models import F, Q
+from django.template.loader import get_template
+from django.utils import timezone
+
+from library.models import BorrowRecord, DueReminder, get_reminder_settings
+
+
+class Command(BaseCommand):
+    help = 'Email the users whose loans are due within a few days, once per due date'
+
+    def add_arguments(self, parser):
+        days, rate = get_reminder_settings()
+        parser.add_argument('--date', type=datetime.date.fromisoformat,
+                            help='Remind of loans due from this date (YYYY-MM-DD), today by default')
+        parser.add_argument('--days', type=int, default=days,
+                            help='Remind of loans due within this number of days (LIBRARY_REMINDER_DAYS)')
+        parser.add_argument('--rate', type=float, default=rate,
+                            help='Send at most this number of messages per second, 0 for no limit '
+                                 '(LIBRARY_REMINDER_RATE)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of loans processed at a time')
+
+    def handle(self, *args, **options):
+        as_of = options['date'] or timezone.now().date()
+        batch_size = options['batch_size']
+        rate = options['rate']
+        until = as_of + datetime.timedelta(days=options['days'])
+        # the templates are compiled once and only rendered for each message
+        subject_template = get_template('library/email/due_reminder_subject.txt')
+        body_template = get_template('library/email/due_reminder.txt')
+        start = time.perf_counter()
+
+        # walk the outstanding loans due soon in (due_date, pk) order, which the partial index on due_date
+        # serves, skipping the loans already reminded of their due date so that re-runs send nothing twice
+        loans = (BorrowRecord.objects.filter(return_date=None, due_date__gte=as_of, due_date__lte=until)
+                 .exclude(reminder__due_date=F('due_date')).exclude(user__email='')
+                 .select_related('user', 'book')
+                 .only('due_date', 'user__username', 'user__first_name', 'user__email', 'book__title')
+                 .order_by('due_date', 'pk'))
+        sent = 0
+        last = None
+        # a single connection (e.g. one SMTP session) is reused for all the messages
+        with get_connection() as connection:
+            while True:
+                batch = loans
+                if last is not None:
+                    batch = batch.filter(Q(due_date__gt=last.due_date) | Q(due_date=last.due_date, pk__gt=last.pk))
+                batch = list(batch[:batch_size])
+                if not batch:
+                    break
+                reminded = []
+                try:
+                    for record in batch:
+                        context = {'record': record}
+                        message = EmailMessage(subject_template.render(context).strip(),
+                                               body_template.render(context), to=[record.user.email],
+                                               connection=connection)
+                        message.send()
+                        reminded.append(record)
+                        sent += 1
+                        if rate > 0:
+                            # sleep until the average rate since the start is back under the limit
+                            time.sleep(max(0.0, sent / rate - (time.perf_counter() - start)))
+                finally:
+                    # the messages sent before a failure are recorded, so that a re-run does not send them again
+                    DueReminder.objects.record(reminded, timezone.now())
+                last = batch[-1]
+                self.stdout.write(f'{sent} reminders sent')
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f'Sent {sent} due date reminders as of {as_of} in {elapsed:.1f}s')
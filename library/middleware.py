@@ -0,0 +1,204 @@
+"""Per-request performance instrumentation.
+
+PerformanceMiddleware times the SQL queries, the template rendering and the whole request of a sample
+of the requests. The timings are sent in a ``Server-Timing`` header, which browser developer tools show,
+and logged to the ``library.performance`` logger at the DEBUG level. Requests slower than the threshold
+are logged as warnings with their SQL queries. It is configured with the ``LIBRARY_PERFORMANCE`` setting::
+
+    LIBRARY_PERFORMANCE = {
+        'SAMPLE_RATE': 1.0,  # fraction of requests instrumented
+        'SLOW_REQUEST_MS': 500,  # requests taking longer have their SQL logged
+        'SERVER_TIMING': True,  # add the Server-Timing header
+    }
+
+The timings of the current request are held in a context variable, which is copied into the threads
+running the sync code of async requests (sync_to_async). The queries are timed by a database execute
+wrapper installed on every connection when it is created, in the thread using it, and the templates by
+the TimedDjangoTemplates backend set in the TEMPLATES setting.
+
+ReplicaPinningMiddleware gives each request its own primary pinning, see library.routers.
+"""
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.template.backends.django import DjangoTemplates, Template
+
+from .routers import get_read_replicas, has_written, pinning
+
+logger = logging.getLogger('library.performance')
+
+_timings = ContextVar('library_request_timings', default=None)
+
+
+def get_performance_settings():
+    options = {'SAMPLE_RATE': 1.0, 'SLOW_REQUEST_MS': 500, 'SERVER_TIMING': True}
+    options.update(getattr(settings, 'LIBRARY_PERFORMANCE', {}))
+    return options
+
+
+class RequestTimings:
+    """Timings of a request, with the SQL queries it executed."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.total = 0.0
+        self.template = 0.0
+        self.sql = 0.0
+        self.queries = []
+
+    def execute(self, execute, sql, params, many, context):
+        """Database execute wrapper timing every query."""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.sql += duration
+            self.queries.append((context['connection'].alias, sql, params, duration))
+
+    @contextmanager
+    def recording(self):
+        token = _timings.set(self)
+        try:
+            yield
+        finally:
+            _timings.reset(token)
+            self.total = time.perf_counter() - self.start
+
+    def server_timing(self):
+        return (f'sql;dur={self.sql * 1000:.1f};desc="{len(self.queries)} queries", '
+                f'template;dur={self.template * 1000:.1f}, total;dur={self.total * 1000:.1f}')
+
+
+def time_query(execute, sql, params, many, context):
+    """Database execute wrapper timing the queries of the recorded request, if any."""
+    timings = _timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    return timings.execute(execute, sql, params, many, context)
+
+
+class TimedTemplate(Template):
+
+    def render(self, context=None, request=None):
+        timings = _timings.get()
+        if timings is None:
+            return super().render(context, request)
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            timings.template += time.perf_counter() - start
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """Django template backend timing the rendering of the templates of the recorded request."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name).template, self)
+
+
+class PerformanceMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        options = get_performance_settings()
+        if random.random() >= options['SAMPLE_RATE']:
+            return self.get_response(request)
+        timings = RequestTimings()
+        with timings.recording():
+            response = self.get_response(request)
+        self.report(request, response, timings, options)
+        return response
+
+    async def __acall__(self, request):
+        options = get_performance_settings()
+        if random.random() >= options['SAMPLE_RATE']:
+            return await self.get_response(request)
+        timings = RequestTimings()
+        with timings.recording():
+            response = await self.get_response(request)
+        self.report(request, response, timings, options)
+        return response
+
+    def report(self, request, response, timings, options):
+        if options['SERVER_TIMING']:
+            header = timings.server_timing()
+            if response.has_header('Server-Timing'):
+                header = f"{response['Server-Timing']}, {header}"
+            response['Server-Timing'] = header
+        data = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'total_ms': round(timings.total * 1000, 1),
+            'sql_count': len(timings.queries),
+            'sql_ms': round(timings.sql * 1000, 1),
+            'template_ms': round(timings.template * 1000, 1),
+        }
+        message = ' '.join(f'{key}={value}' for key, value in data.items())
+        if timings.total * 1000 >= options['SLOW_REQUEST_MS']:
+            queries = '\n'.join(f'  [{alias}] {duration * 1000:.1f} ms: {sql} {params!r}'
+                                for alias, sql, params, duration in timings.queries)
+            logger.warning('slow request %s\n%s', message, queries, extra={'performance': data})
+        else:
+            logger.debug('request %s', message, extra={'performance': data})
+
+
+class ReplicaPinningMiddleware:
+    """Keep the reads of a client on the primary database for a while after it wrote something.
+
+    A request writing to the database sets a cookie holding the time until which the following requests
+    of the client read from the primary, which hides the replica lag from the client's own writes.
+    """
+    sync_capable = True
+    async_capable = True
+    cookie_name = 'library_primary'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with pinning(self.is_sticky(request)):
+            response = self.get_response(request)
+            self.stick(request, response)
+        return response
+
+    async def __acall__(self, request):
+        with pinning(self.is_sticky(request)):
+            response = await self.get_response(request)
+            self.stick(request, response)
+        return response
+
+    def is_sticky(self, request):
+        try:
+            return float(request.COOKIES[self.cookie_name]) > time.time()
+        except (KeyError, ValueError):
+            return False
+
+    def stick(self, request, response):
+        if not has_written() or not get_read_replicas():
+            return
+        seconds = getattr(settings, 'LIBRARY_REPLICA_PIN_SECONDS', 5)
+        response.set_cookie(self.cookie_name, f'{time.time() + seconds:.1f}', max_age=seconds, httponly=True,
+                            samesite='Lax')
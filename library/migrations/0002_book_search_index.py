@@ -0,0 +1,26 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    from library.search import get_search_backend
+
+    # the catalog is read and indexed in batches rather than loaded at once
+    books = apps.get_model('library', 'Book').objects.using(schema_editor.connection.alias).order_by('pk')
+    get_search_backend().rebuild(books, connection=schema_editor.connection)
+
+
+def drop_search_index(apps, schema_editor):
+    from library.search import get_search_backend
+
+    get_search_backend().drop_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0003_circulation_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OverdueLoan',
+            fields=[
+                ('record', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='overdue', serialize=False, to='library.borrowrecord')),
+                ('days_overdue', models.PositiveIntegerField()),
+                ('fine', models.DecimalField(decimal_places=2, max_digits=8)),
+                ('computed_on', models.DateField()),
+            ],
+        ),
+    ]
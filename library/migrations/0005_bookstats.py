@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:18
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Max, Q
+
+
+def backfill_book_stats(apps, schema_editor):
+    BorrowRecord = apps.get_model('library', 'BorrowRecord')
+    BookStats = apps.get_model('library', 'BookStats')
+    rows = (BorrowRecord.objects.order_by().values('book_id')
+            .annotate(total=Count('id'), active=Count('id', filter=Q(return_date=None)), last=Max('borrow_date')))
+    BookStats.objects.bulk_create(
+        (BookStats(book_id=row['book_id'], total_loans=row['total'], active_loans=row['active'],
+                   last_borrowed=row['last']) for row in rows.iterator()),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0004_overdueloan'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookStats',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='library.book')),
+                ('total_loans', models.IntegerField(default=0)),
+                ('active_loans', models.IntegerField(default=0)),
+                ('last_borrowed', models.DateField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-total_loans', 'book'], name='bookstats_total_loans_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_book_stats, migrations.RunPython.noop),
+    ]
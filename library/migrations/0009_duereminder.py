@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0008_archivedborrowrecord'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DueReminder',
+            fields=[
+                ('record', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='reminder', serialize=False, to='library.borrowrecord')),
+                ('due_date', models.DateField()),
+                ('sent_at', models.DateTimeField()),
+            ],
+        ),
+    ]
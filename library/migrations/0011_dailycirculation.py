@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0010_task'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyCirculation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('loans', models.IntegerField(default=0)),
+                ('returns', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedborrowrecord',
+            index=models.Index(fields=['return_date'], name='archived_return_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='borrowrecord',
+            index=models.Index(condition=models.Q(('return_date__isnull', False)), fields=['return_date'], name='borrow_return_date_idx'),
+        ),
+        migrations.AddField(
+            model_name='dailycirculation',
+            name='category',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='library.category'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailycirculation',
+            constraint=models.UniqueConstraint(fields=('date', 'category'), name='circulation_unique_day'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailycirculation',
+            constraint=models.UniqueConstraint(condition=models.Q(('category', None)), fields=('date',), name='circulation_unique_day_none'),
+        ),
+    ]
@@ -1,14 +1,28 @@
 import datetime
+from collections import Counter
 
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.db import models
-from django.db.models import ForeignKey
+from django.db import models, transaction, IntegrityError
+from django.db.models import ForeignKey, F, Q, Count, Max, Sum, Case, When, Value, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save
 from django.utils import timezone
 
+from .cache import bump_catalog_version
+from .fines import get_fine_policy
+
 
 class User(AbstractUser):
     def is_admin(self):
-        return self.groups.filter(name='Librarian').exists()
+        # memoized on the instance, which lives for a single request as request.user
+        if not hasattr(self, '_is_admin'):
+            self._is_admin = self.groups.filter(name='Librarian').exists()
+        return self._is_admin
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self.__dict__.pop('_is_admin', None)
 
 
 class Category(models.Model):
@@ -27,10 +41,175 @@ class Book(models.Model):
     quantity = models.PositiveIntegerField(default=1)
     category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True)
     description = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # incremented by every edit and every stock change, see compare_and_swap()
+    version = models.PositiveIntegerField(default=1, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['title'], name='book_title_idx'),
+            models.Index(fields=['author'], name='book_author_idx'),
+            models.Index(fields=['updated_at'], name='book_updated_at_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        # an edit saved outside compare_and_swap() must still fail the swaps of the forms opened before it
+        edited = not self._state.adding
+        if edited:
+            self.version = F('version') + 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+        super().save(*args, **kwargs)
+        if edited:
+            self.refresh_from_db(fields=['version'])
+
+    def compare_and_swap(self, version, fields):
+        """Write the given fields of the book, unless its version is no longer the one they were read at.
+
+        The UPDATE only matches the row at that version, so no row lock is held while the book is edited,
+        and only the given fields are written, so the stock changed by borrows and returns since is kept.
+        Returns whether the book was written.
+        """
+        if not fields:
+            return True
+        values = {name: getattr(self, name) for name in fields}
+        now = timezone.now()
+        with transaction.atomic():
+            updated = (Book.objects.filter(pk=self.pk, version=version)
+                       .update(version=F('version') + 1, updated_at=now, **values))
+            if not updated:
+                return False
+            self.version, self.updated_at = version + 1, now
+            # the copies added by an edit go to the users waiting for the book before the shelf
+            if 'quantity' in fields and (handed := Hold.objects.fill([self.pk])):
+                self.quantity -= handed[self.pk]
+                self.version += 1
+        # the UPDATE skips save(), so let the search index and the catalog cache know about it
+        post_save.send(sender=Book, instance=self, created=False, update_fields=frozenset(fields), raw=False,
+                       using=self._state.db)
+        return True
+
+
+LOAN_PERIOD = datetime.timedelta(days=14)
+
+
+def _by_key(values, field='pk'):
+    """Return an expression mapping each key of values to its value, to update many rows in one UPDATE."""
+    return Case(*(When(**{field: key}, then=Value(value)) for key, value in values.items()), default=Value(0))
+
+
+class BorrowRecordManager(models.Manager):
+
+    def borrow(self, user, book_id):
+        """Borrow a copy of the book for the user.
+
+        The stock is decremented by a single conditional UPDATE, so concurrent borrows of the same book
+        can never oversell it. Returns the new borrow record, or None if the book is out of stock.
+        """
+        with transaction.atomic():
+            # a ready hold means that a copy was set aside for the user when it was returned
+            fulfilled = (Hold.objects.filter(user=user, book_id=book_id, status=Hold.Status.READY)
+                         .update(status=Hold.Status.FULFILLED))
+            if not fulfilled:
+                updated = (Book.objects.filter(pk=book_id, quantity__gt=0)
+                           .update(quantity=F('quantity') - 1, version=F('version') + 1, updated_at=timezone.now()))
+                if not updated:
+                    return None
+            record = self.create(user=user, book_id=book_id)
+            BookStats.objects.increment(book_id, total_loans=1, active_loans=1, last_borrowed=record.borrow_date)
+            DailyCirculation.objects.refresh_later([record.borrow_date])
+            bump_catalog_version()
+            return record
+
+    def borrow_many(self, user, book_ids):
+        """Borrow a copy of each of the books for the user in one transaction.
+
+        The books are locked and their stock is decremented with a single UPDATE, and the records are
+        inserted with a single INSERT. Books held for the user are borrowed from the copies set aside for
+        the holds. Returns a list with the new borrow record for each book id, or None if the book is out
+        of stock or does not exist.
+        """
+        with transaction.atomic():
+            holds = Hold.objects.filter(user=user, book_id__in=book_ids, status=Hold.Status.READY)
+            reserved = set(holds.select_for_update().values_list('book_id', flat=True))
+            if reserved:
+                holds.update(status=Hold.Status.FULFILLED)
+            stock = dict(Book.objects.select_for_update().filter(pk__in=book_ids).values_list('pk', 'quantity'))
+            today = timezone.now().date()
+            records = []
+            taken = Counter()
+            for book_id in book_ids:
+                if book_id in reserved:
+                    reserved.remove(book_id)
+                elif stock.get(book_id, 0) > 0:
+                    stock[book_id] -= 1
+                    taken[book_id] += 1
+                else:
+                    records.append(None)
+                    continue
+                records.append(BorrowRecord(user=user, book_id=book_id, due_date=today + LOAN_PERIOD))
+
+            borrowed = Counter(record.book_id for record in records if record is not None)
+            if taken:
+                Book.objects.filter(pk__in=taken).update(quantity=F('quantity') - _by_key(taken),
+                                                         version=F('version') + 1, updated_at=timezone.now())
+            if borrowed:
+                created = self.bulk_create([record for record in records if record is not None])
+                BookStats.objects.increment_many(total_loans=borrowed, active_loans=borrowed, last_borrowed=today)
+                DailyCirculation.objects.refresh_later({record.borrow_date for record in created})
+                bump_catalog_version()
+            return records
+
+    def renew_many(self, user, record_ids):
+        """Renew the outstanding borrow records of the user in one transaction.
+
+        Returns a list with the renewed record for each record id, or None if the user has no such
+        outstanding record.
+        """
+        with transaction.atomic():
+            records = self.select_for_update().filter(pk__in=record_ids, user=user, return_date=None).in_bulk()
+            today = timezone.now().date()
+            overdue = [record for record in records.values() if today > record.due_date]
+            for record in records.values():
+                record.due_date += LOAN_PERIOD
+            self.bulk_update(records.values(), ['due_date'])
+            if overdue:
+                OverdueLoan.objects.refresh(overdue, today)
+            return [records.get(record_id) for record_id in record_ids]
+
+    def return_many(self, user, record_ids):
+        """Return the outstanding borrow records of the user in one transaction.
+
+        The records are closed and the copies are released with one UPDATE each, see HoldManager.release().
+        Returns a list with the returned record for each record id, or None if the user has no such
+        outstanding record.
+        """
+        return_date = timezone.now().date()
+        while True:
+            with transaction.atomic():
+                records = self.select_for_update().filter(pk__in=record_ids, user=user, return_date=None).in_bulk()
+                closed = self.filter(pk__in=records, return_date=None).update(return_date=return_date)
+                if closed != len(records):
+                    # select_for_update() does not lock on SQLite, and a concurrent return closed some of the
+                    # records since they were read: read them again, only the return closing a record puts its
+                    # copy back
+                    transaction.set_rollback(True)
+                    continue
+                if records:
+                    returned = Counter(record.book_id for record in records.values())
+                    Hold.objects.release(returned)
+                    BookStats.objects.increment_many(active_loans={book_id: -n for book_id, n in returned.items()})
+                    DailyCirculation.objects.refresh_later([return_date])
+                    if overdue := [record for record in records.values() if return_date > record.due_date]:
+                        OverdueLoan.objects.settle(overdue, return_date)
+                    for record in records.values():
+                        record.return_date = return_date
+                    bump_catalog_version()
+                return [records.get(record_id) for record_id in record_ids]
+
 
 class BorrowRecord(models.Model):
     user = ForeignKey(User, on_delete=models.CASCADE)
@@ -39,24 +218,574 @@ class BorrowRecord(models.Model):
     due_date = models.DateField()
     return_date = models.DateField(null=True, blank=True)
 
+    objects = BorrowRecordManager()
+
+    class Meta:
+        indexes = [
+            # a user's borrow history, newest first
+            models.Index(fields=['user', '-borrow_date'], name='borrow_user_date_idx'),
+            # all borrow records, newest first (with the primary key as the cursor tie-breaker)
+            models.Index(fields=['-borrow_date', '-id'], name='borrow_date_idx'),
+            # outstanding loans by due date, e.g. overdue loans
+            models.Index(fields=['due_date'], condition=Q(return_date=None), name='borrow_outstanding_due_idx'),
+            # the returns of a day, e.g. for the daily circulation rollups
+            models.Index(fields=['return_date'], condition=Q(return_date__isnull=False),
+                         name='borrow_return_date_idx'),
+        ]
+
     def save(self, *args, **kwargs):
         if not self.due_date:
-            self.due_date = timezone.now().date() + datetime.timedelta(days=14)
+            self.due_date = timezone.now().date() + LOAN_PERIOD
         super().save(*args, **kwargs)
 
     def renew(self):
         if self.return_date is not None:
             return
-        self.due_date += datetime.timedelta(days=14)
-        self.save()
+        today = timezone.now().date()
+        overdue = today > self.due_date
+        self.due_date += LOAN_PERIOD
+        with transaction.atomic():
+            self.save()
+            if overdue:
+                OverdueLoan.objects.refresh([self], today)
 
     def return_book(self):
         if self.return_date is not None:
             return
-        self.return_date = timezone.now().date()
-        self.book.quantity += 1
-        self.book.save()
-        self.save()
+        return_date = timezone.now().date()
+        with transaction.atomic():
+            # only the request that actually closes the record puts the copy back
+            updated = BorrowRecord.objects.filter(pk=self.pk, return_date=None).update(return_date=return_date)
+            if updated:
+                Hold.objects.release({self.book_id: 1})
+                BookStats.objects.increment(self.book_id, active_loans=-1)
+                DailyCirculation.objects.refresh_later([return_date])
+                bump_catalog_version()
+                if return_date > self.due_date:
+                    OverdueLoan.objects.settle([self], return_date)
+        self.return_date = return_date
+
+    def __str__(self):
+        return f'{self.user.username} borrowed {self.book.title}'
+
+
+class OverdueLoanManager(models.Manager):
+
+    def settle(self, records, as_of, policy=None):
+        """Compute the fines of the borrow records as of the given date and save them."""
+        policy = policy or get_fine_policy()
+        overdue_loans = []
+        for record in records:
+            days_overdue, fine = policy.compute(record.due_date, as_of)
+            overdue_loans.append(OverdueLoan(record=record, days_overdue=days_overdue, fine=fine, computed_on=as_of))
+        return self.bulk_create(overdue_loans, update_conflicts=True, unique_fields=['record'],
+                                update_fields=['days_overdue', 'fine', 'computed_on'])
+
+    def refresh(self, records, as_of):
+        """Recompute the fines of overdue borrow records as of the given date, e.g. after they were renewed.
+
+        The records no longer overdue lose their fines, instead of keeping them until process_overdues runs.
+        """
+        overdue = [record for record in records if as_of > record.due_date]
+        if not_overdue := [record.pk for record in records if as_of <= record.due_date]:
+            self.filter(record__in=not_overdue).delete()
+        if overdue:
+            self.settle(overdue, as_of)
+
+
+class OverdueLoan(models.Model):
+    """Summary of an overdue loan and its fine, maintained by the process_overdues command."""
+    record = models.OneToOneField(BorrowRecord, on_delete=models.CASCADE, primary_key=True, related_name='overdue')
+    days_overdue = models.PositiveIntegerField()
+    fine = models.DecimalField(max_digits=8, decimal_places=2)
+    computed_on = models.DateField()
+
+    objects = OverdueLoanManager()
+
+    def __str__(self):
+        return f'{self.record} is {self.days_overdue} days overdue'
+
+
+def get_reminder_settings():
+    """Return the days before the due date that reminders are sent and the messages sent per second at most."""
+    return getattr(settings, 'LIBRARY_REMINDER_DAYS', 3), getattr(settings, 'LIBRARY_REMINDER_RATE', 10)
+
+
+class DueReminderManager(models.Manager):
+
+    def record(self, records, sent_at):
+        """Save that the borrow records were reminded of their current due dates."""
+        reminders = [DueReminder(record=record, due_date=record.due_date, sent_at=sent_at) for record in records]
+        return self.bulk_create(reminders, update_conflicts=True, unique_fields=['record'],
+                                update_fields=['due_date', 'sent_at'])
+
+
+class DueReminder(models.Model):
+    """The last due date reminder sent for a loan, maintained by the send_due_reminders command.
+
+    A renewed loan has a new due date, so it is reminded again.
+    """
+    record = models.OneToOneField(BorrowRecord, on_delete=models.CASCADE, primary_key=True, related_name='reminder')
+    due_date = models.DateField()
+    sent_at = models.DateTimeField()
+
+    objects = DueReminderManager()
+
+    def __str__(self):
+        return f'{self.record} was reminded of {self.due_date}'
+
+
+def get_archive_age():
+    return datetime.timedelta(days=getattr(settings, 'LIBRARY_ARCHIVE_AFTER_DAYS', 365))
+
+
+class ArchivedBorrowRecordManager(models.Manager):
+
+    def archive(self, returned_before, batch_size=10000):
+        """Move a batch of borrow records returned before the given date to the archive.
+
+        The records keep their ids, and their fines are copied from their overdue loans. Returns the
+        number of records archived, less than batch_size if there are no more to archive.
+        """
+        with transaction.atomic():
+            rows = list(BorrowRecord.objects.filter(return_date__lt=returned_before).order_by('pk')
+                        .values('pk', 'user_id', 'book_id', 'borrow_date', 'due_date', 'return_date',
+                                'overdue__fine')[:batch_size])
+            if rows:
+                self.bulk_create([
+                    ArchivedBorrowRecord(id=row['pk'], user_id=row['user_id'], book_id=row['book_id'],
+                                         borrow_date=row['borrow_date'], due_date=row['due_date'],
+                                         return_date=row['return_date'], fine=row['overdue__fine'])
+                    for row in rows
+                ], ignore_conflicts=True)
+                BorrowRecord.objects.filter(pk__in=[row['pk'] for row in rows]).delete()
+        return len(rows)
+
+
+class ArchivedBorrowRecord(models.Model):
+    """A borrow record returned long ago, moved out of the borrow record table by the archive_loans command."""
+    id = models.BigIntegerField(primary_key=True)
+    user = ForeignKey(User, on_delete=models.CASCADE)
+    book = ForeignKey(Book, on_delete=models.CASCADE)
+    borrow_date = models.DateField()
+    due_date = models.DateField()
+    return_date = models.DateField()
+    fine = models.DecimalField(max_digits=8, decimal_places=2, null=True, blank=True)
+
+    objects = ArchivedBorrowRecordManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-borrow_date'], name='archived_user_date_idx'),
+            models.Index(fields=['-borrow_date', '-id'], name='archived_date_idx'),
+            models.Index(fields=['return_date'], name='archived_return_date_idx'),
+        ]
 
     def __str__(self):
         return f'{self.user.username} borrowed {self.book.title}'
+
+
+class BookStatsManager(models.Manager):
+
+    def increment(self, book_id, total_loans=0, active_loans=0, last_borrowed=None):
+        """Atomically add to the counters of a book, creating its stats row if missing."""
+        values = {'total_loans': F('total_loans') + total_loans, 'active_loans': F('active_loans') + active_loans}
+        if last_borrowed is not None:
+            values['last_borrowed'] = last_borrowed
+        if not self.filter(book_id=book_id).update(**values):
+            self.bulk_create([BookStats(book_id=book_id)], ignore_conflicts=True)
+            self.filter(book_id=book_id).update(**values)
+
+    def increment_many(self, total_loans=None, active_loans=None, last_borrowed=None):
+        """Add to the counters of many books at once, total_loans and active_loans map book ids to increments."""
+        total_loans, active_loans = total_loans or {}, active_loans or {}
+        book_ids = {*total_loans, *active_loans}
+        self.bulk_create([BookStats(book_id=book_id) for book_id in book_ids], ignore_conflicts=True)
+        values = {}
+        if total_loans:
+            values['total_loans'] = F('total_loans') + _by_key(total_loans, 'book_id')
+        if active_loans:
+            values['active_loans'] = F('active_loans') + _by_key(active_loans, 'book_id')
+        if last_borrowed is not None:
+            values['last_borrowed'] = last_borrowed
+        self.filter(book_id__in=book_ids).update(**values)
+
+    def rebuild(self, book_ids):
+        """Recompute the counters of the given books from their borrow records, archived ones included."""
+        rows = (BorrowRecord.objects.filter(book_id__in=book_ids).order_by().values('book_id')
+                .annotate(total=Count('id'), active=Count('id', filter=Q(return_date=None)), last=Max('borrow_date')))
+        archived_rows = (ArchivedBorrowRecord.objects.filter(book_id__in=book_ids).order_by().values('book_id')
+                         .annotate(total=Count('id'), last=Max('borrow_date')))
+        stats = {book_id: BookStats(book_id=book_id) for book_id in book_ids}
+        for row in archived_rows:
+            stats[row['book_id']] = BookStats(book_id=row['book_id'], total_loans=row['total'],
+                                              last_borrowed=row['last'])
+        for row in rows:
+            archived = stats[row['book_id']]
+            stats[row['book_id']] = BookStats(book_id=row['book_id'], total_loans=archived.total_loans + row['total'],
+                                              active_loans=row['active'],
+                                              last_borrowed=max(filter(None, [archived.last_borrowed, row['last']])))
+        self.bulk_create(stats.values(), update_conflicts=True, unique_fields=['book'],
+                         update_fields=['total_loans', 'active_loans', 'last_borrowed'])
+
+
+class BookStats(models.Model):
+    """Circulation counters of a book, updated on every borrow and return."""
+    book = models.OneToOneField(Book, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    total_loans = models.IntegerField(default=0)
+    active_loans = models.IntegerField(default=0)
+    last_borrowed = models.DateField(null=True, blank=True)
+
+    objects = BookStatsManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-total_loans', 'book'], name='bookstats_total_loans_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.book} borrowed {self.total_loans} times'
+
+
+class DailyCirculationManager(models.Manager):
+
+    def refresh(self, dates):
+        """Recompute the rollups of the given days from the borrow records, archived ones included.
+
+        Only the records borrowed or returned on these days are read, through the date indexes. Refreshes
+        run one at a time: each locks the opening balance row before reading the records, so that a refresh
+        that read earlier can never commit its counts over those of a later one.
+        """
+        dates = sorted(set(dates))
+        CirculationDay.objects.get_or_create(date=CirculationDay.OPENING_BALANCE_DATE)
+        with transaction.atomic():
+            CirculationDay.objects.select_for_update().get(date=CirculationDay.OPENING_BALANCE_DATE)
+            counts = {}
+            for model in (BorrowRecord, ArchivedBorrowRecord):
+                for field, counter in (('borrow_date', 'loans'), ('return_date', 'returns')):
+                    rows = (model.objects.filter(**{f'{field}__in': dates}).order_by()
+                            .values_list(field, 'book__category').annotate(count=Count('pk')))
+                    for date, category_id, count in rows:
+                        rollup = counts.setdefault((date, category_id),
+                                                   DailyCirculation(date=date, category_id=category_id))
+                        setattr(rollup, counter, getattr(rollup, counter) + count)
+            self.filter(date__in=dates).delete()
+            self.bulk_create(counts.values())
+
+            totals = {date: CirculationDay(date=date) for date in dates}
+            for rollup in counts.values():
+                totals[rollup.date].loans += rollup.loans
+                totals[rollup.date].returns += rollup.returns
+            CirculationDay.objects.update_balances(totals.values())
+
+    def refresh_later(self, dates):
+        """Queue the refresh of the rollups of the given days, in the current transaction."""
+        Task.objects.enqueue('refresh_daily_circulation', dates=sorted({date.isoformat() for date in dates}))
+
+    def report(self, start, end):
+        """Return the daily loans, returns and active loans from start to end, and the loans by category.
+
+        Only the rollups of the period are read, plus the balance of the last day before it, so the cost
+        does not depend on the length of the history.
+        """
+        before = (CirculationDay.objects.filter(date__lt=start).order_by('-date')
+                  .values_list('active_loans', flat=True).first())
+        active = before or 0
+        totals = CirculationDay.objects.filter(date__range=(start, end)).in_bulk(field_name='date')
+        days = []
+        for offset in range((end - start).days + 1):
+            date = start + datetime.timedelta(days=offset)
+            day = totals.get(date) or CirculationDay(date=date, active_loans=active)
+            active = day.active_loans
+            days.append({'date': date, 'loans': day.loans, 'returns': day.returns, 'active_loans': active})
+        categories = list(self.filter(date__range=(start, end)).order_by().values('category', 'category__name')
+                          .annotate(loans=Sum('loans'), returns=Sum('returns'))
+                          .filter(loans__gt=0).order_by('-loans', 'category__name'))
+        return days, categories
+
+
+class DailyCirculation(models.Model):
+    """Loans and returns of the books of a category on a day, refreshed by a background task."""
+    date = models.DateField()
+    category = ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True)
+    loans = models.IntegerField(default=0)
+    returns = models.IntegerField(default=0)
+
+    objects = DailyCirculationManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'category'], name='circulation_unique_day'),
+            models.UniqueConstraint(fields=['date'], condition=Q(category=None), name='circulation_unique_day_none'),
+        ]
+
+    def __str__(self):
+        return f'{self.date} {self.category}: {self.loans} loans, {self.returns} returns'
+
+
+class CirculationDayManager(models.Manager):
+
+    def update_balances(self, days):
+        """Save the loans and returns of the given days, and carry their changes over the running balances.
+
+        Must run in a refresh transaction. The days after each refreshed one are shifted by the change of
+        its net loans, with one UPDATE per gap between the refreshed days.
+        """
+        days = sorted(days, key=lambda day: day.date)
+        existing = self.filter(date__in=[day.date for day in days]).in_bulk(field_name='date')
+        shift = 0
+        previous = previous_active = None
+        for day in days:
+            if shift and previous is not None and day.date > previous + datetime.timedelta(days=1):
+                self.filter(date__gt=previous, date__lt=day.date).update(active_loans=F('active_loans') + shift)
+            net = day.loans - day.returns
+            if old := existing.get(day.date):
+                day.active_loans = old.active_loans + shift + net - (old.loans - old.returns)
+                shift += net - (old.loans - old.returns)
+            else:
+                # the last day before, unless it is the previous refreshed day, which is not saved yet
+                before = self.filter(date__lt=day.date).order_by('-date')
+                if previous is not None:
+                    before = before.filter(date__gt=previous)
+                before = before.values_list('active_loans', flat=True).first()
+                if before is None:
+                    before = previous_active if previous is not None else 0
+                day.active_loans = before + net
+                shift += net
+            previous, previous_active = day.date, day.active_loans
+        self.bulk_create(days, update_conflicts=True, unique_fields=['date'],
+                         update_fields=['loans', 'returns', 'active_loans'])
+        if shift and previous is not None:
+            self.filter(date__gt=previous).update(active_loans=F('active_loans') + shift)
+
+
+class CirculationDay(models.Model):
+    """Loans and returns of all books on a day, and the loans still out at the end of the day."""
+    # the row before any day, locked by every refresh of the rollups
+    OPENING_BALANCE_DATE = datetime.date.min
+
+    date = models.DateField(unique=True)
+    loans = models.IntegerField(default=0)
+    returns = models.IntegerField(default=0)
+    active_loans = models.IntegerField(default=0)
+
+    objects = CirculationDayManager()
+
+    def __str__(self):
+        return f'{self.date}: {self.loans} loans, {self.returns} returns, {self.active_loans} active'
+
+
+def get_hold_pickup_period():
+    return datetime.timedelta(days=getattr(settings, 'LIBRARY_HOLD_PICKUP_DAYS', 7))
+
+
+class HoldManager(models.Manager):
+
+    def place(self, user, book_id):
+        """Put the user in the hold queue of the book, return the hold or None if the user already holds it."""
+        if self.filter(user=user, book_id=book_id, status__in=Hold.ACTIVE_STATUSES).exists():
+            return None
+        try:
+            with transaction.atomic():
+                return self.create(user=user, book_id=book_id)
+        except IntegrityError:
+            # placed concurrently
+            return None
+
+    def with_position(self):
+        """Annotate the holds with their position in the queue of their book (1 for the head)."""
+        earlier = Q(created_at__lt=OuterRef('created_at')) | Q(created_at=OuterRef('created_at'), pk__lt=OuterRef('pk'))
+        ahead = (Hold.objects.filter(earlier, book=OuterRef('book'), status=Hold.Status.WAITING).order_by()
+                 .values('book').annotate(count=Count('pk')).values('count'))
+        return self.annotate(position=Coalesce(Subquery(ahead), 0) + 1)
+
+    def release(self, copies):
+        """Hand copies of books to the heads of their hold queues, and put the rest back in stock.
+
+        copies maps book ids to numbers of copies. The head of each queue is looked up with the partial
+        index on waiting holds, so the cost does not depend on the length of the queues, only on the number
+        of books with a queue. The heads are marked ready to be picked up until the end of the pickup period.
+        """
+        stock = Counter(copies) - self._ready_heads(copies)
+        if stock:
+            Book.objects.filter(pk__in=stock).update(quantity=F('quantity') + _by_key(stock), version=F('version') + 1,
+                                                     updated_at=timezone.now())
+
+    def fill(self, book_ids):
+        """Hand the copies in stock of the books to the heads of their hold queues, e.g. after an edit added copies.
+
+        Returns a Counter of the copies taken out of stock by book id.
+        """
+        stock = dict(Book.objects.filter(pk__in=book_ids, quantity__gt=0).values_list('pk', 'quantity'))
+        handed = self._ready_heads(stock)
+        if handed:
+            Book.objects.filter(pk__in=handed).update(quantity=F('quantity') - _by_key(handed),
+                                                      version=F('version') + 1, updated_at=timezone.now())
+        return handed
+
+    def _ready_heads(self, copies):
+        """Mark the heads of the hold queues of the books ready for the copies, return a Counter of the copies used."""
+        queued = (self.filter(book_id__in=copies, status=Hold.Status.WAITING).order_by()
+                  .values_list('book_id', flat=True).distinct())
+        heads = []
+        used = Counter()
+        for book_id in queued:
+            head = list(self.select_for_update().filter(book_id=book_id, status=Hold.Status.WAITING)
+                        .order_by('created_at', 'pk').values_list('pk', flat=True)[:copies[book_id]])
+            heads += head
+            used[book_id] = len(head)
+        if heads:
+            ready_until = timezone.now().date() + get_hold_pickup_period()
+            self.filter(pk__in=heads).update(status=Hold.Status.READY, ready_until=ready_until)
+        return +used
+
+    def expire(self, as_of, batch_size=1000):
+        """Expire a batch of ready holds not picked up before the given date and release their copies.
+
+        Returns the number of holds expired, less than batch_size if there are no more to expire.
+        """
+        with transaction.atomic():
+            holds = list(self.select_for_update().filter(status=Hold.Status.READY, ready_until__lt=as_of)
+                         .order_by('ready_until', 'pk').values_list('pk', 'book_id')[:batch_size])
+            if holds:
+                self.filter(pk__in=[pk for pk, _ in holds]).update(status=Hold.Status.EXPIRED)
+                self.release(Counter(book_id for _, book_id in holds))
+                bump_catalog_version()
+        return len(holds)
+
+
+class Hold(models.Model):
+    """A place in the FIFO hold queue of a book, for a user waiting for a copy to be returned."""
+
+    class Status(models.TextChoices):
+        WAITING = 'waiting'
+        READY = 'ready'
+        FULFILLED = 'fulfilled'
+        CANCELLED = 'cancelled'
+        EXPIRED = 'expired'
+
+    ACTIVE_STATUSES = [Status.WAITING, Status.READY]
+
+    user = ForeignKey(User, on_delete=models.CASCADE)
+    book = ForeignKey(Book, on_delete=models.CASCADE)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.WAITING)
+    created_at = models.DateTimeField(auto_now_add=True)
+    ready_until = models.DateField(null=True, blank=True)
+
+    objects = HoldManager()
+
+    class Meta:
+        indexes = [
+            # the queue of a book, its head first
+            models.Index(fields=['book', 'created_at', 'id'], condition=Q(status='waiting'), name='hold_queue_idx'),
+            # a user's holds, newest first
+            models.Index(fields=['user', '-created_at'], name='hold_user_idx'),
+            # ready holds by pickup deadline, for expiry
+            models.Index(fields=['ready_until', 'id'], condition=Q(status='ready'), name='hold_ready_until_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'book'], condition=Q(status__in=['waiting', 'ready']),
+                                    name='hold_unique_active'),
+        ]
+
+    def cancel(self):
+        """Leave the queue, or give up the copy set aside for a ready hold."""
+        with transaction.atomic():
+            status = (Hold.objects.select_for_update().filter(pk=self.pk, status__in=Hold.ACTIVE_STATUSES)
+                      .values_list('status', flat=True).first())
+            if status is None:
+                return
+            Hold.objects.filter(pk=self.pk).update(status=Hold.Status.CANCELLED)
+            if status == Hold.Status.READY:
+                Hold.objects.release({self.book_id: 1})
+                bump_catalog_version()
+        self.status = Hold.Status.CANCELLED
+
+    def __str__(self):
+        return f'{self.user.username} holds {self.book.title}'
+
+
+class TaskManager(models.Manager):
+
+    def enqueue(self, name, **kwargs):
+        """Queue a call of the task registered under the name, in the current transaction.
+
+        Work rolled back queues nothing, and the worker does not see the task before the data it needs is
+        committed. Unlike a task queued after the commit, it cannot be lost once the work is committed.
+        """
+        return self.create(name=name, kwargs=kwargs)
+
+    def claim(self):
+        """Mark the next task due as running and return it, or return None if no task is due.
+
+        A task is claimed with a conditional UPDATE, so two workers never run the same task.
+        """
+        while True:
+            candidates = list(self.filter(status=Task.Status.QUEUED, run_at__lte=timezone.now())
+                              .order_by('run_at', 'pk').values_list('pk', flat=True)[:10])
+            if not candidates:
+                return None
+            for pk in candidates:
+                claimed = (self.filter(pk=pk, status=Task.Status.QUEUED)
+                           .update(status=Task.Status.RUNNING, started_at=timezone.now(), attempts=F('attempts') + 1))
+                if claimed:
+                    return self.get(pk=pk)
+
+    def coalesce(self, task):
+        """Delete the queued calls identical to a claimed task, and return how many were deleted.
+
+        They were committed before the task runs, so its run covers the data they were queued for.
+        """
+        return (self.filter(name=task.name, kwargs=task.kwargs, status=Task.Status.QUEUED).exclude(pk=task.pk)
+                .delete()[0])
+
+    def requeue_stale(self, started_before):
+        """Queue again the running tasks started before the given time, whose worker presumably died."""
+        return (self.filter(status=Task.Status.RUNNING, started_at__lt=started_before)
+                .update(status=Task.Status.QUEUED, run_at=timezone.now()))
+
+    def metrics(self):
+        """Return the queue depth by status, and the age in seconds of the oldest task due."""
+        now = timezone.now()
+        counts = dict(self.order_by().values_list('status').annotate(count=Count('pk')))
+        due = self.filter(status=Task.Status.QUEUED, run_at__lte=now)
+        oldest = due.order_by('run_at').values_list('run_at', flat=True).first()
+        return {
+            'due': due.count(),
+            'delayed': self.filter(status=Task.Status.QUEUED, run_at__gt=now).count(),
+            'running': counts.get(Task.Status.RUNNING, 0),
+            'failed': counts.get(Task.Status.FAILED, 0),
+            'oldest_due_seconds': (now - oldest).total_seconds() if oldest else 0.0,
+        }
+
+
+class Task(models.Model):
+    """A deferred call of a function registered with library.tasks.task, run by the runworker command.
+
+    Tasks are deleted once they succeed. Failed tasks are kept with their last error.
+    """
+
+    class Status(models.TextChoices):
+        QUEUED = 'queued'
+        RUNNING = 'running'
+        FAILED = 'failed'
+
+    name = models.CharField(max_length=100)
+    kwargs = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    run_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    objects = TaskManager()
+
+    class Meta:
+        indexes = [
+            # the queue, in the order tasks are due
+            models.Index(fields=['run_at', 'id'], condition=Q(status='queued'), name='task_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.name}({self.kwargs})'
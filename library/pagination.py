@@ -0,0 +1,235 @@
+"""Keyset (seek) pagination.
+
+Offset pagination pays for an ``OFFSET n`` scan and a full ``COUNT(*)`` on every page. A cursor
+paginator instead remembers the ordering values of the first and last row of a page in an opaque token
+and seeks past them with a WHERE clause, so every page costs the same and no count is needed.
+
+Where offset pagination stays (e.g. the admin), EstimatedCountPaginator replaces the ``COUNT(*)`` of
+whole tables with the row count estimated by the database statistics.
+"""
+import base64
+import binascii
+import json
+import math
+from functools import partial
+from urllib.parse import urlencode
+
+from django.core.paginator import InvalidPage, Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError, connections
+from django.db.models import Q
+from django.http import Http404
+from django.utils.functional import cached_property
+
+
+class InvalidCursor(InvalidPage):
+    pass
+
+
+class CursorPaginator:
+    """Paginate a queryset by seeking past cursor tokens built from its ordering columns.
+
+    The ordering must be unique, so the primary key is appended to it if missing. Ordering columns must
+    not be NULL. ``count`` and ``num_pages`` are optional: they run a COUNT query only when accessed.
+    """
+
+    def __init__(self, object_list, per_page, ordering=None):
+        self.object_list = object_list
+        self.per_page = int(per_page)
+        ordering = list(ordering or object_list.query.order_by)
+        if not {'pk', '-pk', 'id', '-id'} & set(ordering):
+            ordering.append('-pk' if ordering and ordering[0].startswith('-') else 'pk')
+        self.ordering = ordering
+
+    @cached_property
+    def count(self):
+        return self.object_list.count()
+
+    @property
+    def num_pages(self):
+        return max(1, math.ceil(self.count / self.per_page))
+
+    def encode_cursor(self, obj, direction, number):
+        # rows of values() querysets are dicts
+        get = obj.__getitem__ if isinstance(obj, dict) else partial(getattr, obj)
+        values = [get(field.lstrip('-')) for field in self.ordering]
+        data = json.dumps({'v': values, 'd': direction, 'n': number}, cls=DjangoJSONEncoder)
+        return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            values, direction, number = data['v'], data['d'], int(data['n'])
+        except (binascii.Error, ValueError, TypeError, KeyError):
+            raise InvalidCursor('Invalid cursor')
+        if len(values) != len(self.ordering) or direction not in ('next', 'previous') or number < 1:
+            raise InvalidCursor('Invalid cursor')
+        return values, direction, number
+
+    def seek_filter(self, values, reverse):
+        """Return a filter selecting the rows after the given ordering values (before them if reverse)."""
+        condition = Q()
+        equal = Q()
+        for field, value in zip(self.ordering, values):
+            descending = field.startswith('-')
+            name = field.lstrip('-')
+            lookup = 'lt' if descending != reverse else 'gt'
+            condition |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+        return condition
+
+    def _seek(self, cursor):
+        """Return the query of the page selected by the cursor token and a function building the page from its rows.
+
+        The query fetches one row more than a page, to tell whether there is a page past it.
+        """
+        if cursor:
+            values, direction, number = self.decode_cursor(cursor)
+        else:
+            values, direction, number = None, 'next', 1
+
+        if direction == 'next':
+            queryset = self.object_list
+            if values is not None:
+                queryset = queryset.filter(self.seek_filter(values, False))
+            queryset = queryset.order_by(*self.ordering)
+        else:
+            reversed_ordering = [f[1:] if f.startswith('-') else '-' + f for f in self.ordering]
+            queryset = self.object_list.filter(self.seek_filter(values, True)).order_by(*reversed_ordering)
+
+        def make_page(items):
+            has_more = len(items) > self.per_page
+            if direction == 'next':
+                return CursorPage(items[:self.per_page], number, self, has_previous=values is not None,
+                                  has_next=has_more)
+            return CursorPage(items[:self.per_page][::-1], number if has_more else 1, self,
+                              has_previous=has_more, has_next=True)
+
+        return queryset[:self.per_page + 1], make_page
+
+    def page(self, cursor=None):
+        """Return the page selected by the cursor token, or the first page if it is empty."""
+        queryset, make_page = self._seek(cursor)
+        return make_page(list(queryset))
+
+    async def apage(self, cursor=None):
+        """Async version of page()."""
+        queryset, make_page = self._seek(cursor)
+        return make_page([obj async for obj in queryset])
+
+
+class CursorPage:
+    """A page of a CursorPaginator, compatible with the parts of Django's Page used by templates."""
+
+    def __init__(self, object_list, number, paginator, has_previous, has_next):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self._has_previous = has_previous
+        self._has_next = has_next and bool(object_list)
+
+    def __repr__(self):
+        return f'<Page {self.number}>'
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous and bool(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    @cached_property
+    def next_cursor(self):
+        if not self.has_next():
+            return None
+        return self.paginator.encode_cursor(self.object_list[-1], 'next', self.number + 1)
+
+    @cached_property
+    def previous_cursor(self):
+        if not self.has_previous():
+            return None
+        return self.paginator.encode_cursor(self.object_list[0], 'previous', self.number - 1)
+
+
+class CursorPaginationMixin:
+    """ListView mixin paginating with cursor tokens.
+
+    Requests with a ``page`` parameter still get Django's offset pagination, so old links keep working.
+    The ``querystring`` context variable holds the current query without the pagination parameters.
+    """
+    cursor_kwarg = 'cursor'
+
+    def paginate_queryset(self, queryset, page_size):
+        if self.page_kwarg in self.kwargs or self.page_kwarg in self.request.GET:
+            return super().paginate_queryset(queryset, page_size)
+        paginator = CursorPaginator(queryset, page_size)
+        try:
+            page = paginator.page(self.request.GET.get(self.cursor_kwarg))
+        except InvalidCursor as e:
+            raise Http404(str(e))
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_context_data(self, **kwargs):
+        query_params = self.request.GET.copy()
+        for key in (self.page_kwarg, self.cursor_kwarg):
+            if key in query_params:
+                del query_params[key]
+        kwargs['querystring'] = urlencode(query_params)
+        context = super().get_context_data(**kwargs)
+        context['cursor_pagination'] = isinstance(context.get('paginator'), CursorPaginator)
+        return context
+
+
+def estimate_count(model, using='default'):
+    """Return the number of rows of the model's table estimated from the database statistics, or None.
+
+    The statistics are kept by ANALYZE (autovacuum on PostgreSQL), and are missing before it first ran.
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    queries = {
+        'postgresql': 'SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+        'mysql': 'SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() '
+                 'AND table_name = %s',
+        # the first number of each index statistic is the number of rows of the table
+        'sqlite': 'SELECT stat FROM sqlite_stat1 WHERE tbl = %s',
+    }
+    if connection.vendor not in queries:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(queries[connection.vendor], [table])
+            row = cursor.fetchone()
+    except DatabaseError:
+        # e.g. sqlite_stat1 does not exist before the first ANALYZE
+        return None
+    if row is None or row[0] is None:
+        return None
+    estimate = int(float(str(row[0]).split()[0]))
+    return estimate if estimate >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator counting unfiltered querysets of large tables from the database statistics.
+
+    Filtered querysets, and tables estimated below ``estimate_threshold`` rows, are counted exactly. The
+    estimate may be off by a few percent, so the last page may be short or empty.
+    """
+    estimate_threshold = 100000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if hasattr(queryset, 'query') and not queryset.query.where and not queryset.query.distinct:
+            estimate = estimate_count(queryset.model, queryset.db)
+            if estimate is not None and estimate >= self.estimate_threshold:
+                return estimate
+        return super().count
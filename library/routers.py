@@ -0,0 +1,71 @@
+"""Read/write splitting between the primary database and its read replicas.
+
+ReplicaRouter sends writes to the ``default`` database and spreads reads over the aliases listed in the
+``LIBRARY_READ_REPLICAS`` setting. Reads stay on the primary when:
+
+* they run inside a transaction on the primary, which must see its own uncommitted writes;
+* the current request or task already wrote something, see ``pin_primary()``;
+* the client wrote something in the last ``LIBRARY_REPLICA_PIN_SECONDS`` seconds, so that a user reads
+  their own borrow or return although the replicas lag behind, see
+  ``library.middleware.ReplicaPinningMiddleware``.
+
+Without replicas every query goes to ``default``. To try it locally with two SQLite files, copy
+``db.sqlite3`` and point the ``LIBRARY_REPLICA_DATABASE`` environment variable to the copy.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+_pinned = ContextVar('library_pinned_to_primary', default=False)
+_written = ContextVar('library_written_to_primary', default=False)
+
+
+def get_read_replicas():
+    return getattr(settings, 'LIBRARY_READ_REPLICAS', [])
+
+
+def pin_primary():
+    """Send the following reads of the current request or task to the primary database."""
+    _pinned.set(True)
+
+
+def is_pinned():
+    return _pinned.get()
+
+
+def has_written():
+    """Return whether the current request or task wrote to the primary database."""
+    return _written.get()
+
+
+@contextmanager
+def pinning(pinned=False):
+    """Scope the primary pinning of a request or task, starting pinned or not."""
+    pinned_token = _pinned.set(pinned)
+    written_token = _written.set(False)
+    try:
+        yield
+    finally:
+        _written.reset(written_token)
+        _pinned.reset(pinned_token)
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        replicas = get_read_replicas()
+        if not replicas or is_pinned() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        _written.set(True)
+        pin_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same data as the primary
+        return True
@@ -0,0 +1,142 @@
+"""Full-text search over the book catalog.
+
+Searching with ``icontains`` turns into a leading-wildcard LIKE that scans the whole book table, so the
+catalog search goes through a search backend instead. The backend is chosen with the
+``LIBRARY_SEARCH_BACKEND`` setting (a dotted path); by default SQLite databases use an FTS5 index and
+other databases fall back to plain ``icontains`` filtering.
+"""
+from django.conf import settings
+from django.db import connection as default_connection, transaction
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+SEARCH_FIELDS = ['title', 'author', 'isbn']
+
+
+class SearchBackend:
+    """Interface of book search backends.
+
+    The methods writing to the index use the given connection, or the default one if it is None
+    (e.g. migrations pass the connection of their schema editor).
+    """
+
+    def create_index(self, connection):
+        """Create the index structures on the given connection."""
+
+    def drop_index(self, connection):
+        """Drop the index structures from the given connection."""
+
+    def clear(self, connection=None):
+        """Remove all books from the index."""
+
+    def index(self, books, connection=None):
+        """Add or update the given books in the index."""
+
+    def remove(self, book_ids, connection=None):
+        """Remove the books with the given ids from the index."""
+
+    def rebuild(self, queryset, batch_size=1000, connection=None):
+        """Rebuild the whole index from the given books, return the number of books indexed.
+
+        Each batch is committed on its own, so that rebuilding a large catalog holds no long write
+        transaction; books missing from the index until then are not found by searches.
+        """
+        connection = connection or default_connection
+        with transaction.atomic(using=connection.alias):
+            self.create_index(connection)
+            self.clear(connection)
+        count = 0
+        batch = []
+        for book in queryset.only(*SEARCH_FIELDS).iterator(chunk_size=batch_size):
+            batch.append(book)
+            if len(batch) == batch_size:
+                with transaction.atomic(using=connection.alias):
+                    self.index(batch, connection)
+                count += len(batch)
+                batch = []
+        with transaction.atomic(using=connection.alias):
+            self.index(batch, connection)
+        return count + len(batch)
+
+    def search(self, queryset, terms):
+        """Filter books by the given terms (a dict of field name to text), ordered by relevance."""
+        raise NotImplementedError
+
+
+class LikeSearchBackend(SearchBackend):
+    """Search backend without an index, matching case-insensitive substrings."""
+
+    def search(self, queryset, terms):
+        for field, text in terms.items():
+            queryset = queryset.filter(**{f'{field}__icontains': text})
+        return queryset
+
+
+class SQLiteFTS5SearchBackend(SearchBackend):
+    """Search backend using an SQLite FTS5 table with the trigram tokenizer.
+
+    The trigram tokenizer matches arbitrary substrings, so results are the same as with ``icontains``,
+    and they are ranked with bm25. Terms shorter than three characters cannot use the index and are
+    matched with ``icontains`` instead.
+    """
+    table = 'library_book_fts'
+    min_term_length = 3
+
+    def create_index(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} '
+                f"USING fts5({', '.join(SEARCH_FIELDS)}, tokenize='trigram')"
+            )
+
+    def drop_index(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {self.table}')
+
+    def clear(self, connection=None):
+        with (connection or default_connection).cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+
+    def index(self, books, connection=None):
+        if not books:
+            return
+        with (connection or default_connection).cursor() as cursor:
+            cursor.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (rowid, {', '.join(SEARCH_FIELDS)}) VALUES (%s, %s, %s, %s)",
+                [(book.pk, *(getattr(book, field) for field in SEARCH_FIELDS)) for book in books],
+            )
+
+    def remove(self, book_ids, connection=None):
+        if not book_ids:
+            return
+        with (connection or default_connection).cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {self.table} WHERE rowid = %s', [(pk,) for pk in book_ids])
+
+    def search(self, queryset, terms):
+        phrases = []
+        for field, text in terms.items():
+            if len(text) < self.min_term_length:
+                queryset = queryset.filter(**{f'{field}__icontains': text})
+            else:
+                phrases.append('{} : "{}"'.format(field, text.replace('"', '""')))
+        if not phrases:
+            return queryset
+
+        query = ' AND '.join(phrases)
+        book_table = queryset.model._meta.db_table
+        return queryset.filter(
+            pk__in=RawSQL(f'SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s', [query])
+        ).annotate(
+            rank=RawSQL(
+                f'SELECT rank FROM {self.table} WHERE {self.table} MATCH %s AND rowid = {book_table}.id', [query]
+            )
+        ).order_by('rank', 'pk')
+
+
+def get_search_backend():
+    """Return an instance of the configured search backend."""
+    if path := getattr(settings, 'LIBRARY_SEARCH_BACKEND', None):
+        return import_string(path)()
+    if default_connection.vendor == 'sqlite':
+        return SQLiteFTS5SearchBackend()
+    return LikeSearchBackend()
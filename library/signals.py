@@ -0,0 +1,41 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from .cache import bump_catalog_version
+from .middleware import time_query
+from .models import User, Category, Book
+from .search import get_search_backend, SEARCH_FIELDS
+
+
+@receiver(post_save, sender=Book)
+def index_book(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not set(update_fields) & set(SEARCH_FIELDS):
+        return
+    get_search_backend().index([instance])
+
+
+@receiver(post_delete, sender=Book)
+def remove_book_from_index(sender, instance, **kwargs):
+    get_search_backend().remove([instance.pk])
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_catalog_cache(sender, **kwargs):
+    bump_catalog_version()
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def clear_cached_role(sender, instance, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear') and isinstance(instance, User):
+        instance.__dict__.pop('_is_admin', None)
+
+
+@receiver(connection_created)
+def install_query_timing(sender, connection, **kwargs):
+    # a connection is only used by the thread that created it, e.g. the sync_to_async thread of an async request
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
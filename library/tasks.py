@@ -0,0 +1,185 @@
+"""Background tasks.
+
+Work that a request does not need to wait for is deferred to a database-backed queue and run by the
+``runworker`` command. Tasks are functions registered with the ``task`` decorator and queued by name
+with ``Task.objects.enqueue()`` (or ``function.delay()``), in the current transaction::
+
+    @task(max_attempts=5)
+    def send_receipt(record_id):
+        ...
+
+    send_receipt.delay(record_id=record.pk)
+
+Arguments must be JSON serializable. A task raising an exception is retried with an exponential
+backoff until it has run ``max_attempts`` times, then it is marked as failed. As tasks may run more than
+once, they should be idempotent. The identical calls of a task registered with ``coalesce=True`` that are
+queued when one of them starts are run only once. The worker is configured with the ``LIBRARY_TASKS`` setting::
+
+    LIBRARY_TASKS = {
+        'THREADS': 4,  # tasks run at the same time by a worker
+        'POLL_INTERVAL': 1.0,  # seconds between polls of an empty queue
+        'MAX_ATTEMPTS': 3,  # default runs of a failing task
+        'RETRY_DELAY': 10,  # seconds before the first retry, doubled for each further one
+        'STALE_AFTER': 600,  # seconds after which a running task is presumed lost and queued again
+    }
+"""
+import datetime
+import logging
+import threading
+import time
+import traceback
+from collections import deque
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.utils import timezone
+
+from .models import DailyCirculation, Task
+
+logger = logging.getLogger('library.tasks')
+
+# name of each task to its function, maximum number of runs, and whether identical calls are coalesced
+registry = {}
+
+
+def get_task_settings():
+    options = {'THREADS': 4, 'POLL_INTERVAL': 1.0, 'MAX_ATTEMPTS': 3, 'RETRY_DELAY': 10, 'STALE_AFTER': 600}
+    options.update(getattr(settings, 'LIBRARY_TASKS', {}))
+    return options
+
+
+def task(func=None, *, name=None, max_attempts=None, coalesce=False):
+    """Register a function as a task, under its name unless another is given."""
+    def register(func):
+        task_name = name or func.__name__
+        if task_name in registry:
+            raise ValueError(f'A task named {task_name} is already registered')
+        registry[task_name] = (func, max_attempts, coalesce)
+        func.delay = lambda **kwargs: Task.objects.enqueue(task_name, **kwargs)
+        return func
+
+    return register(func) if func is not None else register
+
+
+def run_task(task, options=None):
+    """Run a claimed task; delete it if it succeeds, queue it again or mark it as failed if it raises.
+
+    Returns whether the task succeeded.
+    """
+    options = options or get_task_settings()
+    wait = (task.started_at - task.run_at).total_seconds()
+    start = time.perf_counter()
+    func, max_attempts, coalesce = registry.get(task.name, (None, None, False))
+    try:
+        if func is None:
+            raise LookupError(f'Unknown task {task.name}')
+        if coalesce:
+            Task.objects.coalesce(task)
+        func(**task.kwargs)
+    except Exception:
+        retry = func is not None and task.attempts < (max_attempts or options['MAX_ATTEMPTS'])
+        update = {'last_error': traceback.format_exc()}
+        if retry:
+            delay = options['RETRY_DELAY'] * 2 ** (task.attempts - 1)
+            update.update(status=Task.Status.QUEUED, run_at=timezone.now() + datetime.timedelta(seconds=delay))
+        else:
+            update['status'] = Task.Status.FAILED
+        Task.objects.filter(pk=task.pk).update(**update)
+        succeeded = False
+        status = 'retry' if retry else 'failed'
+    else:
+        Task.objects.filter(pk=task.pk).delete()
+        succeeded = True
+        status = 'done'
+    data = {
+        'task': task.name,
+        'id': task.pk,
+        'status': status,
+        'attempt': task.attempts,
+        'wait_ms': round(wait * 1000, 1),
+        'run_ms': round((time.perf_counter() - start) * 1000, 1),
+    }
+    message = ' '.join(f'{key}={value}' for key, value in data.items())
+    if succeeded:
+        logger.debug('task %s', message, extra={'task': data})
+    else:
+        logger.warning('task %s\n%s', message, update['last_error'], extra={'task': data})
+    return succeeded
+
+
+def run_next(options=None):
+    """Claim the next task due and run it in the current thread; return it, or None if none is due."""
+    task = Task.objects.claim()
+    if task is not None:
+        run_task(task, options)
+    return task
+
+
+class Worker:
+    """Run queued tasks in a pool of threads, each with its own database connection."""
+
+    def __init__(self, threads=None, burst=False, options=None):
+        self.options = options or get_task_settings()
+        self.threads = threads or self.options['THREADS']
+        self.burst = burst
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        # the wait in the queue of the latest tasks
+        self.waits = deque(maxlen=10000)
+
+    def run(self):
+        """Run tasks until stop() is called, or until the queue is empty in burst mode."""
+        stale_after = datetime.timedelta(seconds=self.options['STALE_AFTER'])
+        Task.objects.requeue_stale(timezone.now() - stale_after)
+        threads = [threading.Thread(target=self.loop, name=f'library-worker-{i}') for i in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            self.stop()
+            for thread in threads:
+                thread.join()
+
+    def stop(self):
+        """Let the running tasks finish, then stop."""
+        self.stopping.set()
+
+    def loop(self):
+        try:
+            while not self.stopping.is_set():
+                close_old_connections()
+                task = Task.objects.claim()
+                if task is None:
+                    if self.burst:
+                        break
+                    self.stopping.wait(self.options['POLL_INTERVAL'])
+                    continue
+                succeeded = run_task(task, self.options)
+                with self.lock:
+                    self.processed += 1
+                    self.failed += not succeeded
+                    self.waits.append((task.started_at - task.run_at).total_seconds())
+        finally:
+            connections.close_all()
+
+    def stats(self):
+        """Return the number of tasks run and failed by the worker, and their p50 and p95 wait in the queue."""
+        with self.lock:
+            waits = sorted(self.waits)
+        return {
+            'processed': self.processed,
+            'failed': self.failed,
+            'wait_p50_ms': round(waits[len(waits) // 2] * 1000, 1) if waits else 0.0,
+            'wait_p95_ms': round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+        }
+
+
+@task(coalesce=True)
+def refresh_daily_circulation(dates):
+    """Recompute the circulation rollups of the days (ISO dates) on which books were borrowed or returned."""
+    DailyCirculation.objects.refresh([datetime.date.fromisoformat(date) for date in dates])
@@ -1,14 +1,45 @@
+import datetime
+import gzip
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 from urllib.parse import quote
 
-from django.contrib.auth.models import Group
-from django.core.management import call_command
-from django.test import TestCase
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import AnonymousUser, Group
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
+from django.db import connection, connections, transaction
+from django.db.models import F, QuerySet
+from django.http import Http404, HttpResponse
+from django.test import (AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 
-from .models import User, Book, BorrowRecord
-
-
+from . import async_views, urls
+from .fines import FinePolicy
+from .forms import BookForm
+from .management.commands.benchmark_endpoints import Command as BenchmarkEndpoints
+from .management.commands.benchmark_indexes import Command as BenchmarkIndexes
+from .middleware import ReplicaPinningMiddleware
+from .pagination import EstimatedCountPaginator, estimate_count
+from .models import (User, Category, Book, BorrowRecord, ArchivedBorrowRecord, OverdueLoan, DueReminder, BookStats,
+                     Hold, Task, DailyCirculation, CirculationDay)
+from .routers import ReplicaRouter, is_pinned, pinning
+from .search import get_search_backend
+from .tasks import run_next, task
+
+
+# hashing the password takes about as long as the slow request threshold
+@override_settings(LIBRARY_PERFORMANCE={'SLOW_REQUEST_MS': 60000})
 class UserRegisterTest(TestCase):
 
     def setUp(self):
@@ -45,13 +76,74 @@ class UserRegisterTest(TestCase):
 
 
 def create_test_users():
-    call_command('loadgroupperms')
+    call_command('loadgroupperms', stdout=StringIO())
     User.objects.create_user(username='testuser', password='testpassword123')
     User.objects.create_user(username='testuser2', password='testpassword456')
     admin_user = User.objects.create_user(username='testadmin', password='testpassword789')
     admin_user.groups.add(Group.objects.get(name='Librarian'))
 
 
+def run_tasks():
+    """Run the queued background tasks in the test thread."""
+    while run_next():
+        pass
+
+
+def get_form_data(form, **changes):
+    """Return the data a browser would post for the displayed form, with the given changes."""
+    data = {}
+    for name, field in form.fields.items():
+        value = field.hidden_widget().format_value(form[name].value())
+        data[name] = '' if value is None else value
+        if field.show_hidden_initial:
+            initial = form.add_initial_prefix(name)
+            data[initial] = form.data.get(initial, data[name])
+    data.update(changes)
+    return data
+
+
+class QueryBudgetMixin:
+    """Test case mixin for asserting an upper bound on the number of queries."""
+
+    @contextmanager
+    def assertMaxNumQueries(self, num, using='default'):
+        with CaptureQueriesContext(connections[using]) as context:
+            yield context
+        executed = len(context)
+        if executed > num:
+            queries = '\n'.join(f'{i}. {query["sql"]}' for i, query in enumerate(context.captured_queries, start=1))
+            self.fail(f'{executed} queries executed, at most {num} expected\nCaptured queries were:\n{queries}')
+
+
+class UserRoleTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_users()
+
+    def test_is_admin_cached(self):
+        user = User.objects.get(username='testadmin')
+        with self.assertNumQueries(1):
+            self.assertTrue(user.is_admin())
+            self.assertTrue(user.is_admin())
+
+    def test_group_change(self):
+        user = User.objects.get(username='testuser')
+        self.assertFalse(user.is_admin())
+        user.groups.add(Group.objects.get(name='Librarian'))
+        self.assertTrue(user.is_admin())
+        user.groups.clear()
+        self.assertFalse(user.is_admin())
+
+    def test_refresh_from_db(self):
+        user = User.objects.get(username='testuser')
+        self.assertFalse(user.is_admin())
+        Group.objects.get(name='Librarian').user_set.add(user)
+        user.refresh_from_db()
+        self.assertTrue(user.is_admin())
+
+
+@override_settings(LIBRARY_PERFORMANCE={'SLOW_REQUEST_MS': 60000})
 class UserLoginTest(TestCase):
 
     @classmethod
@@ -115,6 +207,10 @@ class SearchBookViewTest(TestCase):
         for i in range(25):
             Book.objects.create(title=f'Book {i}', author=f'Author {i}', isbn=str(i))
 
+    def setUp(self):
+        # anonymous pages are cached, but these tests inspect the response context
+        cache.clear()
+
     def test_search_by_title(self):
         response = self.client.get(reverse('library:book-list'), {'title': 'django'})
         self.assertEqual(200, response.status_code)
@@ -157,6 +253,131 @@ class SearchBookViewTest(TestCase):
         self.assertEqual(5, len(response.context['book_list']))
         self.assertIn('title=Book', response.context['querystring'])
 
+    def test_cursor_pagination(self):
+        response = self.client.get(reverse('library:book-list'))
+        page_obj = response.context['page_obj']
+        self.assertTrue(response.context['cursor_pagination'])
+        self.assertFalse(page_obj.has_previous())
+        self.assertTrue(page_obj.has_next())
+        self.assertContains(response, f'cursor={page_obj.next_cursor}')
+        first_page = list(response.context['book_list'])
+
+        response = self.client.get(reverse('library:book-list'), {'cursor': page_obj.next_cursor})
+        self.assertEqual(200, response.status_code)
+        page_obj = response.context['page_obj']
+        self.assertEqual(2, page_obj.number)
+        self.assertEqual(7, len(response.context['book_list']))
+        self.assertFalse(page_obj.has_next())
+        self.assertTrue(page_obj.has_previous())
+        self.assertFalse(set(first_page) & set(response.context['book_list']))
+
+        response = self.client.get(reverse('library:book-list'), {'cursor': page_obj.previous_cursor})
+        self.assertEqual(1, response.context['page_obj'].number)
+        self.assertEqual(first_page, list(response.context['book_list']))
+
+    def test_cursor_pagination_with_search(self):
+        response = self.client.get(reverse('library:book-list'), {'title': 'Book'})
+        cursor = response.context['page_obj'].next_cursor
+        response = self.client.get(reverse('library:book-list'), {'title': 'Book', 'cursor': cursor})
+        self.assertEqual(5, len(response.context['book_list']))
+        self.assertEqual('title=Book', response.context['querystring'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('library:book-list'), {'cursor': 'invalid'})
+        self.assertEqual(404, response.status_code)
+
+
+class BookListQueryCountTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_users()
+
+    def assertConstantQueries(self, num, username, password):
+        self.client.login(username=username, password=password)
+        for page_size in (1, 20):
+            Book.objects.all().delete()
+            for i in range(page_size):
+                Book.objects.create(title=f'Book {i}', author=f'Author {i}', isbn=str(i))
+            with self.assertNumQueries(num):
+                response = self.client.get(reverse('library:book-list'))
+            self.assertEqual(page_size, len(response.context['book_list']))
+
+    def test_admin(self):
+        self.assertConstantQueries(6, 'testadmin', 'testpassword789')
+
+    def test_user(self):
+        self.assertConstantQueries(6, 'testuser', 'testpassword123')
+
+
+class BookSearchIndexTest(TestCase):
+    fixtures = ['books.json']
+
+    def search(self, **terms):
+        return get_search_backend().search(Book.objects.all(), terms)
+
+    def test_create(self):
+        book = Book.objects.create(title='Fluent Python', author='Luciano Ramalho', isbn='9781492056355')
+        self.assertQuerySetEqual(self.search(title='fluent'), [book])
+        self.assertQuerySetEqual(self.search(author='ramalho'), [book])
+        self.assertQuerySetEqual(self.search(isbn='2056'), [book])
+
+    def test_update(self):
+        Book.objects.filter(pk=1).update(title='Stale Title')
+        book = Book.objects.get(pk=1)
+        book.title = 'Django for Professionals'
+        book.save()
+        self.assertQuerySetEqual(self.search(title='professionals'), [book])
+        self.assertFalse(self.search(title='beginners').exists())
+
+    def test_delete(self):
+        Book.objects.get(pk=1).delete()
+        self.assertFalse(self.search(title='django').exists())
+
+    def test_rank(self):
+        Book.objects.create(title='Python Cookbook: Recipes for Mastering Python 3', author='David Beazley', isbn='1')
+        Book.objects.create(title='Python', author='Unknown', isbn='2')
+        books = self.search(title='python')
+        self.assertEqual(3, len(books))
+        self.assertEqual('Python', books[0].title)
+
+    def test_short_term(self):
+        self.assertQuerySetEqual(self.search(title='go'), ['Django for Beginners'], transform=lambda b: b.title)
+
+    def test_quotes(self):
+        self.assertFalse(self.search(title='"django"').exists())
+
+    @override_settings(LIBRARY_SEARCH_BACKEND='library.search.LikeSearchBackend')
+    def test_like_backend(self):
+        self.assertQuerySetEqual(self.search(title='crash', author='matthes'), ['Python Crash Course'],
+                                 transform=lambda b: b.title)
+
+    def test_rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM library_book_fts')
+        self.assertFalse(self.search(title='django').exists())
+        out = StringIO()
+        call_command('rebuild_search_index', stdout=out)
+        self.assertIn('Indexed 2 books', out.getvalue())
+        self.assertQuerySetEqual(self.search(title='django'), ['Django for Beginners'], transform=lambda b: b.title)
+
+    def test_rebuild_batches(self):
+        backend = get_search_backend()
+        indexed = []
+        index = type(backend).index
+
+        def record_index(backend, books, connection=None):
+            indexed.append(([book.pk for book in books], connection))
+            index(backend, books, connection)
+
+        with mock.patch.object(type(backend), 'index', record_index):
+            count = backend.rebuild(Book.objects.order_by('pk'), batch_size=1, connection=connections['default'])
+        self.assertEqual(2, count)
+        # the batches are written on the given connection
+        self.assertEqual([([1], connections['default']), ([2], connections['default']), ([], connections['default'])],
+                         indexed)
+        self.assertQuerySetEqual(self.search(author='matthes'), ['Python Crash Course'], transform=lambda b: b.title)
+
 
 class BookDetailViewTest(TestCase):
     fixtures = ['books.json']
@@ -178,6 +399,157 @@ class BookDetailViewTest(TestCase):
         self.assertEqual(404, response.status_code)
 
 
+class CatalogCacheTest(TestCase):
+    fixtures = ['books.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_users()
+
+    def setUp(self):
+        cache.clear()
+
+    def test_anonymous_page(self):
+        url = reverse('library:book-list')
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertContains(response, 'Django for Beginners')
+
+        response = self.client.get(url, {'title': 'python'})
+        self.assertIsNotNone(response.context)
+
+        self.client.login(username='testuser', password='testpassword123')
+        response = self.client.get(url)
+        self.assertIsNotNone(response.context)
+
+    def test_book_change(self):
+        url = reverse('library:book-detail', args=(1,))
+        self.client.get(url)
+        book = Book.objects.get(pk=1)
+        book.title = 'Django for Professionals'
+        book.save()
+        self.assertContains(self.client.get(url), 'Django for Professionals')
+
+    def test_category_change(self):
+        url = reverse('library:book-detail', args=(1,))
+        self.client.get(url)
+        Category.objects.filter(pk=1).update(name='Web Development')
+        self.assertContains(self.client.get(url), 'Programming')
+        Category.objects.get(pk=1).save()
+        self.assertContains(self.client.get(url), 'Web Development')
+
+    def test_stock_change(self):
+        url = reverse('library:book-detail', args=(1,))
+        self.client.login(username='testuser', password='testpassword123')
+        self.assertContains(self.client.get(url), 'Quantity: 5')
+        self.client.post(reverse('library:borrow-book', args=(1,)))
+        self.assertContains(self.client.get(url), 'Quantity: 4')
+        BorrowRecord.objects.get().return_book()
+        self.assertContains(self.client.get(url), 'Quantity: 5')
+
+    def test_book_object_cached(self):
+        url = reverse('library:book-detail', args=(1,))
+        self.client.login(username='testuser', password='testpassword123')
+        self.client.get(url)
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertContains(response, 'Django for Beginners')
+
+    def test_timeout(self):
+        url = reverse('library:book-detail', args=(1,))
+        with override_settings(LIBRARY_CATALOG_CACHE_TIMEOUT=0):
+            self.client.get(url)
+            Book.objects.filter(pk=1).update(quantity=2)
+            self.assertContains(self.client.get(url), 'Quantity: 2')
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'library_test_cache'),
+    }})
+    def test_file_cache(self):
+        cache.clear()
+        url = reverse('library:book-detail', args=(1,))
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            self.client.get(url)
+        Book.objects.filter(pk=1).update(quantity=2)
+        Book.objects.get(pk=1).save()
+        self.assertContains(self.client.get(url), 'Quantity: 2')
+        cache.clear()
+
+
+class ConditionalGetTest(QueryBudgetMixin, TestCase):
+    fixtures = ['books.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_users()
+
+    def assertNotModified(self, url, response):
+        with self.assertMaxNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+
+    def test_book_detail(self):
+        url = reverse('library:book-detail', args=(1,))
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertIn('Last-Modified', response)
+        self.assertNotModified(url, response)
+
+        response2 = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(304, response2.status_code)
+
+        book = Book.objects.get(pk=1)
+        book.description = 'Updated'
+        book.save()
+        response2 = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(200, response2.status_code)
+        self.assertNotEqual(response['ETag'], response2['ETag'])
+
+    def test_book_list(self):
+        url = reverse('library:book-list')
+        response = self.client.get(url, {'title': 'python'})
+        self.assertNotModified(url + '?title=python', response)
+
+        response2 = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(200, response2.status_code)
+
+        Book.objects.get(pk=1).delete()
+        response2 = self.client.get(url, {'title': 'python'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(200, response2.status_code)
+
+    def test_stock_change(self):
+        url = reverse('library:book-detail', args=(1,))
+        response = self.client.get(url)
+        user = User.objects.get(username='testuser')
+        BorrowRecord.objects.borrow(user, 1)
+        response2 = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(200, response2.status_code)
+
+    def test_user(self):
+        url = reverse('library:book-detail', args=(1,))
+        response = self.client.get(url)
+        self.client.login(username='testuser', password='testpassword123')
+        response2 = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(200, response2.status_code)
+        self.assertNotEqual(response['ETag'], response2['ETag'])
+
+    def test_pending_messages(self):
+        Book.objects.filter(pk=1).update(quantity=0)
+        self.client.login(username='testuser', password='testpassword123')
+        url = reverse('library:book-list')
+        response = self.client.get(url)
+        self.client.post(reverse('library:borrow-book', args=(1,)))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertContains(response, 'is out of stock')
+
+    def test_not_found(self):
+        response = self.client.get(reverse('library:book-detail', args=(9999,)), HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(404, response.status_code)
+
+
 class BookCreateViewTest(TestCase):
 
     @classmethod
@@ -234,13 +606,92 @@ class BookUpdateViewTest(TestCase):
             'title': 'Django for Beginners (5th Edition)',
             'author': 'William S. Vincent',
             'isbn': '9781735467269',
-            'quantity': 10
+            'quantity': 10,
+            'base_version': 1,
         }
         response = self.client.post(reverse('library:edit-book', args=(1,)), data)
         self.assertRedirects(response, reverse('library:book-list'))
         book = Book.objects.get(pk=1)
         self.assertEqual(data['title'], book.title)
         self.assertEqual(data['quantity'], book.quantity)
+        self.assertEqual(2, book.version)
+
+    def test_get_version(self):
+        response = self.client.get(reverse('library:edit-book', args=(1,)))
+        self.assertContains(response, '<input type="hidden" name="base_version" value="1"', html=False)
+        self.assertContains(response, 'name="initial-quantity"')
+
+    def test_keep_concurrent_changes(self):
+        url = reverse('library:edit-book', args=(1,))
+        form = self.client.get(url).context['form']
+        quantity = Book.objects.get(pk=1).quantity
+        user = User.objects.get(username='testuser')
+        BorrowRecord.objects.borrow(user, 1)
+        response = self.client.post(url, get_form_data(form, title='Django for Beginners, Fifth Edition'))
+        self.assertRedirects(response, reverse('library:book-list'))
+        book = Book.objects.get(pk=1)
+        # the edit did not write back the stock it was displayed with
+        self.assertEqual(('Django for Beginners, Fifth Edition', quantity - 1, 3),
+                         (book.title, book.quantity, book.version))
+        books = get_search_backend().search(Book.objects.all(), {'title': 'Fifth'})
+        self.assertEqual([1], [book.pk for book in books])
+
+    def test_conflict(self):
+        url = reverse('library:edit-book', args=(1,))
+        form = self.client.get(url).context['form']
+        Book.objects.filter(pk=1).update(quantity=20, version=F('version') + 1)
+        response = self.client.post(url, get_form_data(form, quantity=7, description='Updated'))
+        self.assertEqual(200, response.status_code)
+        self.assertContains(response, 'The book was changed by someone else while you edited it: Quantity is now 20.')
+        book = Book.objects.get(pk=1)
+        self.assertEqual((20, 2), (book.quantity, book.version))
+        self.assertNotEqual('Updated', book.description)
+
+        # saving again overwrites the concurrent change
+        response = self.client.post(url, get_form_data(response.context['form']))
+        self.assertRedirects(response, reverse('library:book-list'))
+        book = Book.objects.get(pk=1)
+        self.assertEqual((7, 'Updated', 3), (book.quantity, book.description, book.version))
+
+    def test_conflict_keeps_other_concurrent_changes(self):
+        url = reverse('library:edit-book', args=(1,))
+        form = self.client.get(url).context['form']
+        Book.objects.filter(pk=1).update(title='Renamed', version=F('version') + 1)
+        response = self.client.post(url, get_form_data(form, title='Mine'))
+        self.assertContains(response, 'Title is now Renamed')
+        user = User.objects.get(username='testuser')
+        BorrowRecord.objects.borrow(user, 1)
+        quantity = Book.objects.get(pk=1).quantity
+        # the borrow since the conflict is no conflict, and its stock change is kept
+        response = self.client.post(url, get_form_data(response.context['form']))
+        self.assertRedirects(response, reverse('library:book-list'))
+        self.assertEqual(('Mine', quantity), Book.objects.values_list('title', 'quantity').get(pk=1))
+
+    def test_unchanged(self):
+        url = reverse('library:edit-book', args=(1,))
+        form = self.client.get(url).context['form']
+        response = self.client.post(url, get_form_data(form))
+        self.assertRedirects(response, reverse('library:book-list'))
+        self.assertEqual(1, Book.objects.get(pk=1).version)
+
+    def test_save_bumps_version(self):
+        url = reverse('library:edit-book', args=(1,))
+        form = self.client.get(url).context['form']
+        book = Book.objects.get(pk=1)
+        book.title = 'Saved elsewhere'
+        book.save()
+        self.assertEqual(2, book.version)
+        book.save(update_fields=['description'])
+        self.assertEqual(3, Book.objects.get(pk=1).version)
+        response = self.client.post(url, get_form_data(form, title='Mine'))
+        self.assertContains(response, 'Title is now Saved elsewhere')
+
+    def test_circulation_bumps_version(self):
+        user = User.objects.get(username='testuser')
+        record = BorrowRecord.objects.borrow(user, 1)
+        BorrowRecord.objects.borrow_many(user, [1])
+        record.return_book()
+        self.assertEqual(4, Book.objects.get(pk=1).version)
 
     def test_not_found(self):
         response = self.client.get(reverse('library:edit-book', args=(9999,)))
@@ -388,6 +839,227 @@ class BorrowRecordViewTest(TestCase):
         self.assertIsNone(self.borrow_record.return_date)
 
 
+class BatchCirculationTest(QueryBudgetMixin, TestCase):
+    fixtures = ['books.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_users()
+        cls.user = User.objects.get(username='testuser')
+        cls.other_record = BorrowRecord.objects.create(user_id=2, book_id=1)
+
+    def setUp(self):
+        self.client.login(username='testuser', password='testpassword123')
+
+    def test_borrow_many(self):
+        Book.objects.filter(pk=2).update(quantity=1)
+        with self.assertMaxNumQueries(9):
+            records = BorrowRecord.objects.borrow_many(self.user, [1, 2, 2, 9999, 1])
+        self.assertEqual([1, 2, None, None, 1], [record and record.book_id for record in records])
+        self.assertTrue(all(record.pk for record in records if record))
+        self.assertEqual(timezone.now().date() + datetime.timedelta(days=14), records[0].due_date)
+        self.assertEqual([3, 0], [book.quantity for book in Book.objects.order_by('pk')])
+        self.assertEqual(2, BookStats.objects.get(book_id=1).active_loans)
+        self.assertEqual(1, BookStats.objects.get(book_id=2).total_loans)
+
+    def test_renew_many(self):
+        records = BorrowRecord.objects.borrow_many(self.user, [1, 2])
+        with self.assertMaxNumQueries(4):
+            renewed = BorrowRecord.objects.renew_many(self.user, [records[0].pk, self.other_record.pk])
+        self.assertEqual([records[0], None], renewed)
+        self.assertEqual(timezone.now().date() + datetime.timedelta(days=28),
+                         BorrowRecord.objects.get(pk=records[0].pk).due_date)
+        self.assertEqual(records[1].due_date, BorrowRecord.objects.get(pk=records[1].pk).due_date)
+
+    def test_renew_overdue(self):
+        today = timezone.now().date()
+        records = BorrowRecord.objects.borrow_many(self.user, [1, 1, 2])
+        for record, days in zip(records, (3, 20, 2)):
+            record.due_date = today - datetime.timedelta(days=days)
+        BorrowRecord.objects.bulk_update(records, ['due_date'])
+        OverdueLoan.objects.settle(records, today)
+
+        BorrowRecord.objects.renew_many(self.user, [record.pk for record in records[:2]])
+        # the fine of a renewed loan that is no longer overdue is dropped, the others are recomputed
+        self.assertFalse(OverdueLoan.objects.filter(record_id=records[0].pk).exists())
+        self.assertEqual(6, OverdueLoan.objects.get(record_id=records[1].pk).days_overdue)
+        records[2].renew()
+        self.assertFalse(OverdueLoan.objects.filter(record_id=records[2].pk).exists())
+
+    def test_return_many(self):
+        records = BorrowRecord.objects.borrow_many(self.user, [1, 1, 2])
+        BorrowRecord.objects.filter(pk=records[0].pk).update(due_date=timezone.now().date() - datetime.timedelta(days=3))
+        record_ids = [record.pk for record in records] + [self.other_record.pk]
+        returned = BorrowRecord.objects.return_many(self.user, record_ids)
+        self.assertEqual(record_ids[:3], [record.pk for record in returned[:3]])
+        self.assertIsNone(returned[3])
+        self.assertEqual([None] * 3, BorrowRecord.objects.return_many(self.user, record_ids[:3]))
+        self.assertEqual([5, 3], [book.quantity for book in Book.objects.order_by('pk')])
+        self.assertEqual({1: 0, 2: 0}, dict(BookStats.objects.values_list('book_id', 'active_loans')))
+        self.assertEqual(3, OverdueLoan.objects.get(record_id=records[0].pk).days_overdue)
+        self.assertFalse(OverdueLoan.objects.filter(record_id=records[1].pk).exists())
+
+    def test_return_many_race(self):
+        record = BorrowRecord.objects.borrow_many(self.user, [1])[0]
+        stale = BorrowRecord.objects.in_bulk([record.pk])
+        BorrowRecord.objects.get(pk=record.pk).return_book()
+        in_bulk = QuerySet.in_bulk
+        reads = []
+
+        def read_stale(queryset, *args, **kwargs):
+            # the first read saw the record outstanding, before another request returned it
+            reads.append(queryset)
+            return stale if len(reads) == 1 else in_bulk(queryset, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, 'in_bulk', read_stale):
+            self.assertEqual([None], BorrowRecord.objects.return_many(self.user, [record.pk]))
+        # the copy is only put back once
+        self.assertEqual(5, Book.objects.get(pk=1).quantity)
+        self.assertEqual(0, BookStats.objects.get(book_id=1).active_loans)
+
+    def test_api(self):
+        Book.objects.filter(pk=2).update(quantity=0)
+        response = self.client.post(reverse('library:api-borrow-books'), {'books': [1, 2, 9999]},
+                                    content_type='application/json')
+        results = response.json()['results']
+        self.assertEqual('Django for Beginners', results[0]['record']['book__title'])
+        self.assertEqual([{'book': 2, 'error': 'Out of stock.'}, {'book': 9999, 'error': 'Not found.'}], results[1:])
+
+        record_ids = [results[0]['record']['id'], self.other_record.pk]
+        response = self.client.post(reverse('library:api-renew-books'), {'records': record_ids},
+                                    content_type='application/json')
+        results = response.json()['results']
+        self.assertEqual((timezone.now().date() + datetime.timedelta(days=28)).isoformat(),
+                         results[0]['record']['due_date'])
+        self.assertEqual('Not found or already returned.', results[1]['error'])
+        response = self.client.post(reverse('library:api-return-books'), {'records': record_ids},
+                                    content_type='application/json')
+        self.assertEqual(timezone.now().date().isoformat(), response.json()['results'][0]['record']['return_date'])
+
+        for data in ({}, {'books': []}, {'books': ['1']}, {'books': list(range(101))}):
+            response = self.client.post(reverse('library:api-borrow-books'), data, content_type='application/json')
+            self.assertEqual(400, response.status_code)
+
+    def test_batch_view(self):
+        records = BorrowRecord.objects.borrow_many(self.user, [1, 2])
+        url = reverse('library:batch-borrow-records')
+        data = {'action': 'return', 'records': [records[0].pk, self.other_record.pk]}
+        response = self.client.post(url, data, follow=True)
+        self.assertRedirects(response, reverse('library:borrow-records'))
+        self.assertContains(response, '1 of 2 books returned.')
+        self.assertIsNotNone(BorrowRecord.objects.get(pk=records[0].pk).return_date)
+
+        response = self.client.post(url, {'action': 'delete', 'records': [records[1].pk]}, follow=True)
+        self.assertContains(response, 'Select the books to renew or return.')
+        self.assertEqual(405, self.client.get(url).status_code)
+
+
+class HoldTest(QueryBudgetMixin, TestCase):
+    fixtures = ['books.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_users()
+        cls.user, cls.user2, cls.admin = User.objects.order_by('pk')
+        Book.objects.filter(pk=1).update(quantity=0)
+        cls.record = BorrowRecord.objects.create(user=cls.admin, book_id=1)
+
+    def setUp(self):
+        self.client.login(username='testuser', password='testpassword123')
+
+    def test_place_hold(self):
+        response = self.client.post(reverse('library:place-hold', args=(1,)), follow=True)
+        self.assertContains(response, 'You have been added to the hold queue of &quot;Django for Beginners&quot;.')
+        self.assertContains(response, 'Waiting, number 1 in the queue')
+        response = self.client.post(reverse('library:place-hold', args=(1,)), follow=True)
+        self.assertContains(response, 'You already hold &quot;Django for Beginners&quot;.')
+        response = self.client.post(reverse('library:place-hold', args=(2,)), follow=True)
+        self.assertContains(response, 'is in stock, you can borrow it.')
+        self.assertEqual(1, Hold.objects.count())
+
+    def test_return_hands_copy_to_queue_head(self):
+        first = Hold.objects.place(self.user, 1)
+        second = Hold.objects.place(self.user2, 1)
+        self.assertEqual([1, 2], [hold.position for hold in Hold.objects.with_position().order_by('pk')])
+        self.assertIsNone(BorrowRecord.objects.borrow(self.user2, 1))
+
+        with self.assertMaxNumQueries(10):
+            self.record.return_book()
+        first.refresh_from_db()
+        self.assertEqual(Hold.Status.READY, first.status)
+        self.assertEqual(timezone.now().date() + datetime.timedelta(days=7), first.ready_until)
+        self.assertEqual(0, Book.objects.get(pk=1).quantity)
+        self.assertEqual(Hold.Status.WAITING, Hold.objects.get(pk=second.pk).status)
+
+        # only the holder can borrow the copy set aside
+        self.assertIsNone(BorrowRecord.objects.borrow(self.user2, 1))
+        self.assertIsNotNone(BorrowRecord.objects.borrow(self.user, 1))
+        self.assertEqual(Hold.Status.FULFILLED, Hold.objects.get(pk=first.pk).status)
+        self.assertEqual(0, Book.objects.get(pk=1).quantity)
+
+    def test_batch(self):
+        records = [self.record, BorrowRecord.objects.create(user=self.admin, book_id=1)]
+        holds = [Hold.objects.place(user, 1) for user in (self.user, self.user2)]
+        BorrowRecord.objects.return_many(self.admin, [record.pk for record in records])
+        self.assertEqual({Hold.Status.READY}, {hold.status for hold in Hold.objects.all()})
+        self.assertEqual(0, Book.objects.get(pk=1).quantity)
+
+        records = BorrowRecord.objects.borrow_many(self.user, [1, 1, 2])
+        self.assertEqual([1, None, 2], [record and record.book_id for record in records])
+        self.assertEqual(Hold.Status.FULFILLED, Hold.objects.get(pk=holds[0].pk).status)
+        self.assertEqual([0, 2], [book.quantity for book in Book.objects.order_by('pk')])
+
+    def test_edit_hands_copies_to_queue(self):
+        holds = [Hold.objects.place(user, 1) for user in (self.user, self.user2)]
+        book = Book.objects.get(pk=1)
+        version = book.version
+        book.quantity = 3
+        self.assertTrue(book.compare_and_swap(version, ['quantity']))
+        self.assertEqual({Hold.Status.READY}, {Hold.objects.get(pk=hold.pk).status for hold in holds})
+        # the copies left after the queue go to the shelf
+        self.assertEqual(1, book.quantity)
+        self.assertEqual(book.quantity, Book.objects.get(pk=1).quantity)
+        self.assertEqual(book.version, Book.objects.get(pk=1).version)
+
+    def test_import_hands_copies_to_queue(self):
+        hold = Hold.objects.place(self.user, 1)
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write('title,author,isbn,quantity\nDjango for Beginners,William S. Vincent,9781735467269,2\n')
+        self.addCleanup(os.remove, f.name)
+        call_command('importbooks', f.name, update_quantity=True, stdout=StringIO())
+        self.assertEqual(Hold.Status.READY, Hold.objects.get(pk=hold.pk).status)
+        self.assertEqual(1, Book.objects.get(pk=1).quantity)
+
+    def test_cancel(self):
+        first = Hold.objects.place(self.user, 1)
+        second = Hold.objects.place(self.user2, 1)
+        self.record.return_book()
+        response = self.client.post(reverse('library:cancel-hold', args=(first.pk,)))
+        self.assertRedirects(response, reverse('library:holds'))
+        self.assertEqual(Hold.Status.CANCELLED, Hold.objects.get(pk=first.pk).status)
+        self.assertEqual(Hold.Status.READY, Hold.objects.get(pk=second.pk).status)
+
+        second.cancel()
+        self.assertEqual(Hold.Status.CANCELLED, Hold.objects.get(pk=second.pk).status)
+        self.assertEqual(1, Book.objects.get(pk=1).quantity)
+        response = self.client.post(reverse('library:cancel-hold', args=(second.pk,)))
+        self.assertEqual(404, response.status_code)
+
+    def test_expire_holds(self):
+        holds = [Hold.objects.place(user, 1) for user in (self.user, self.user2, self.admin)]
+        self.record.return_book()
+        BorrowRecord.objects.create(user=self.admin, book_id=1).return_book()
+        Hold.objects.filter(status=Hold.Status.READY).update(ready_until=timezone.now().date())
+
+        out = StringIO()
+        tomorrow = timezone.now().date() + datetime.timedelta(days=1)
+        call_command('expire_holds', date=tomorrow.isoformat(), batch_size=1, stdout=out)
+        self.assertIn('Expired 2 holds', out.getvalue())
+        self.assertEqual([Hold.Status.EXPIRED, Hold.Status.EXPIRED, Hold.Status.READY],
+                         [Hold.objects.get(pk=hold.pk).status for hold in holds])
+        self.assertEqual(1, Book.objects.get(pk=1).quantity)
+
+
 class AdminBorrowRecordListViewTest(TestCase):
     fixtures = ['books.json']
 
@@ -418,6 +1090,17 @@ class AdminBorrowRecordListViewTest(TestCase):
         values = [self.user1_django, self.user2_django]
         self.assertQuerySetEqual(response.context['borrow_record_list'], values, ordered=False)
 
+    def test_pagination(self):
+        BorrowRecord.objects.bulk_create(
+            BorrowRecord(user_id=2, book_id=2, due_date=timezone.now().date()) for _ in range(50)
+        )
+        response = self.client.get(reverse('library:admin-borrow-records'))
+        self.assertEqual(50, len(response.context['borrow_record_list']))
+        cursor = response.context['page_obj'].next_cursor
+        response = self.client.get(reverse('library:admin-borrow-records'), {'cursor': cursor})
+        self.assertEqual(3, len(response.context['borrow_record_list']))
+        self.assertFalse(response.context['page_obj'].has_next())
+
     def test_unauthenticated(self):
         self.client.logout()
         url = reverse('library:admin-borrow-records')
@@ -429,3 +1112,1205 @@ class AdminBorrowRecordListViewTest(TestCase):
         url = reverse('library:admin-borrow-records')
         response = self.client.get(url)
         self.assertEqual(403, response.status_code)
+
+
+class ExportBorrowRecordsTest(TestCase):
+    fixtures = ['books.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_users()
+        cls.user1_django = BorrowRecord.objects.create(user_id=1, book_id=1)
+        cls.user1_python = BorrowRecord.objects.create(user_id=1, book_id=2)
+        cls.user2_django = BorrowRecord.objects.create(user_id=2, book_id=1)
+
+    def setUp(self):
+        self.client.login(username='testadmin', password='testpassword789')
+
+    def test_csv(self):
+        response = self.client.get(reverse('library:export-borrow-records'), {'isbn': '9781735467269'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('text/csv', response['Content-Type'])
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual('id,username,isbn,title,borrow_date,due_date,return_date', lines[0])
+        today = timezone.now().date()
+        self.assertEqual(f'{self.user1_django.id},testuser,9781735467269,Django for Beginners,{today},'
+                         f'{self.user1_django.due_date},', lines[1])
+        self.assertEqual(3, len(lines))
+
+    def test_jsonl(self):
+        data = {'format': 'jsonl', 'username': 'testuser'}
+        response = self.client.get(reverse('library:export-borrow-records'), data)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([self.user1_django.id, self.user1_python.id], [row['id'] for row in rows])
+        self.assertEqual('Python Crash Course', rows[1]['title'])
+        self.assertIsNone(rows[1]['return_date'])
+
+    def test_unknown_format(self):
+        response = self.client.get(reverse('library:export-borrow-records'), {'format': 'xml'})
+        self.assertEqual(404, response.status_code)
+
+    def test_unauthorized(self):
+        self.client.login(username='testuser', password='testpassword123')
+        response = self.client.get(reverse('library:export-borrow-records'))
+        self.assertEqual(403, response.status_code)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('exportborrowrecords', username='testuser2', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertIn(f'{self.user2_django.id},testuser2,9781735467269', lines[1])
+
+
+class OverdueLoanTest(TestCase):
+    fixtures = ['books.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_users()
+        cls.today = timezone.now().date()
+        cls.records = [
+            BorrowRecord.objects.create(user_id=1, book_id=1, due_date=cls.today - datetime.timedelta(days=days))
+            for days in (3, 10, 100, 0, -5)
+        ]
+
+    def process_overdues(self, **options):
+        out = StringIO()
+        call_command('process_overdues', batch_size=2, stdout=out, **options)
+        return out.getvalue()
+
+    def test_fine_policy(self):
+        policy = FinePolicy('0.50', grace_days=2, max_fine='10')
+        due_date = datetime.date(2025, 1, 1)
+        self.assertEqual((0, 0), policy.compute(due_date, datetime.date(2024, 12, 1)))
+        self.assertEqual((2, 0), policy.compute(due_date, datetime.date(2025, 1, 3)))
+        self.assertEqual((5, Decimal('1.50')), policy.compute(due_date, datetime.date(2025, 1, 6)))
+        self.assertEqual((100, 10), policy.compute(due_date, datetime.date(2025, 4, 11)))
+
+    def test_process_overdues(self):
+        self.assertIn('Processed 3 overdue loans', self.process_overdues())
+        fines = dict(OverdueLoan.objects.values_list('record_id', 'fine'))
+        self.assertEqual({self.records[0].pk: Decimal('1.50'), self.records[1].pk: Decimal('5.00'),
+                          self.records[2].pk: Decimal('20.00')}, fines)
+        self.assertIn('Processed 0 overdue loans', self.process_overdues())
+        self.assertEqual(3, OverdueLoan.objects.count())
+
+    def test_next_day(self):
+        self.process_overdues()
+        tomorrow = self.today + datetime.timedelta(days=1)
+        self.assertIn('Processed 4 overdue loans', self.process_overdues(date=tomorrow))
+        self.assertEqual(Decimal('2.00'), OverdueLoan.objects.get(record=self.records[0]).fine)
+        self.assertEqual(Decimal('0.50'), OverdueLoan.objects.get(record=self.records[3]).fine)
+
+    def test_returned(self):
+        self.records[1].return_book()
+        self.assertEqual(Decimal('5.00'), OverdueLoan.objects.get(record=self.records[1]).fine)
+        self.process_overdues()
+        self.assertEqual(self.today, OverdueLoan.objects.get(record=self.records[1]).computed_on)
+        self.assertEqual(3, OverdueLoan.objects.count())
+
+    def test_borrow_records_page(self):
+        self.process_overdues()
+        self.client.login(username='testuser', password='testpassword123')
+        response = self.client.get(reverse('library:borrow-records'))
+        self.assertEqual(Decimal('26.50'), response.context['total_fine'])
+        self.assertContains(response, '<td>20.00</td>', html=True)
+
+
+class DueReminderTest(TestCase):
+    fixtures = ['books.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_users()
+        User.objects.filter(username='testuser').update(email='testuser@example.com', first_name='Alice')
+        User.objects.filter(username='testuser2').update(email='testuser2@example.com')
+        cls.today = timezone.now().date()
+        cls.records = [
+            BorrowRecord.objects.create(user=User.objects.get(username=username), book_id=book_id,
+                                        due_date=cls.today + datetime.timedelta(days=days))
+            for username, book_id, days in [('testuser', 1, 1), ('testuser2', 2, 3), ('testuser', 2, 0),
+                                            ('testuser', 1, 5), ('testuser', 2, -1), ('testadmin', 1, 1)]
+        ]
+        BorrowRecord.objects.create(user=User.objects.get(username='testuser'), book_id=1,
+                                    due_date=cls.today, return_date=cls.today)
+
+    def send_due_reminders(self, rate=0, **options):
+        out = StringIO()
+        call_command('send_due_reminders', batch_size=2, rate=rate, stdout=out, **options)
+        return out.getvalue()
+
+    def test_send(self):
+        self.assertIn('Sent 3 due date reminders', self.send_due_reminders())
+        self.assertEqual(['testuser2@example.com', 'testuser@example.com', 'testuser@example.com'],
+                         sorted(message.to[0] for message in mail.outbox))
+        message = next(message for message in mail.outbox if message.to == ['testuser2@example.com'])
+        self.assertEqual(f'"Python Crash Course" is due on {self.records[1].due_date}', message.subject)
+        self.assertIn('Hello testuser2,', message.body)
+        self.assertIn('Hello Alice,', mail.outbox[0].body)
+        self.assertEqual({self.records[0].pk, self.records[1].pk, self.records[2].pk},
+                         set(DueReminder.objects.values_list('record', flat=True)))
+
+        # re-runs only remind of renewed loans and loans newly due soon
+        self.assertIn('Sent 0 due date reminders', self.send_due_reminders())
+        self.records[2].renew()
+        self.assertIn('Sent 2 due date reminders', self.send_due_reminders(days=20))
+        self.assertEqual([self.records[3].due_date, self.records[2].due_date],
+                         [DueReminder.objects.get(record=record).due_date for record in self.records[3:1:-1]])
+
+    def test_send_failure(self):
+        send = mail.EmailMessage.send
+
+        def fail_second(message, *args, **kwargs):
+            if len(mail.outbox) == 1:
+                raise ConnectionError('connection lost')
+            return send(message, *args, **kwargs)
+
+        with mock.patch.object(mail.EmailMessage, 'send', fail_second):
+            with self.assertRaises(ConnectionError):
+                self.send_due_reminders()
+        # the message sent before the failure is not sent again
+        self.assertEqual(1, DueReminder.objects.count())
+        self.assertIn('Sent 2 due date reminders', self.send_due_reminders())
+        self.assertEqual(3, len(mail.outbox))
+
+    def test_connection_reuse(self):
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.open') as open_connection:
+            self.send_due_reminders()
+        self.assertEqual(1, open_connection.call_count)
+
+    def test_rate(self):
+        with mock.patch('time.sleep') as sleep:
+            self.send_due_reminders(rate=2)
+        self.assertEqual(3, sleep.call_count)
+        self.assertAlmostEqual(1.5, sleep.call_args.args[0], delta=0.5)
+
+
+class ArchiveLoansTest(TestCase):
+    fixtures = ['books.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_users()
+        cls.user = User.objects.get(username='testuser')
+        cls.today = timezone.now().date()
+        cls.old = []
+        for days, book_id in ((800, 1), (700, 2), (400, 1)):
+            borrow_date = cls.today - datetime.timedelta(days=days)
+            record = BorrowRecord.objects.create(user=cls.user, book_id=book_id, due_date=borrow_date)
+            BorrowRecord.objects.filter(pk=record.pk).update(borrow_date=borrow_date,
+                                                             return_date=borrow_date + datetime.timedelta(days=2))
+            cls.old.append(record)
+        OverdueLoan.objects.create(record=cls.old[0], days_overdue=2, fine=Decimal('1.00'),
+                                   computed_on=cls.today)
+        cls.recent = BorrowRecord.objects.create(user=cls.user, book_id=1, return_date=cls.today)
+        cls.outstanding = BorrowRecord.objects.create(user=cls.user, book_id=2)
+
+    def archive_loans(self, **options):
+        out = StringIO()
+        call_command('archive_loans', batch_size=2, stdout=out, **options)
+        return out.getvalue()
+
+    def test_archive(self):
+        self.assertIn('Archived 3 records returned before', self.archive_loans())
+        self.assertEqual({self.recent.pk, self.outstanding.pk}, set(BorrowRecord.objects.values_list('pk', flat=True)))
+        archived = ArchivedBorrowRecord.objects.get(pk=self.old[0].pk)
+        self.assertEqual((self.user.pk, 1, Decimal('1.00')), (archived.user_id, archived.book_id, archived.fine))
+        self.assertEqual(self.today - datetime.timedelta(days=800), archived.borrow_date)
+        self.assertFalse(OverdueLoan.objects.exists())
+        self.assertIn('Archived 0 records', self.archive_loans())
+        self.assertEqual(3, ArchivedBorrowRecord.objects.count())
+
+    def test_before(self):
+        self.archive_loans(before=self.today - datetime.timedelta(days=600))
+        self.assertEqual({self.old[0].pk, self.old[1].pk},
+                         set(ArchivedBorrowRecord.objects.values_list('pk', flat=True)))
+
+    def test_rebuild_stats(self):
+        self.archive_loans()
+        BookStats.objects.rebuild([1, 2])
+        self.assertEqual([(1, 3, 0, self.today), (2, 2, 1, self.today)],
+                         list(BookStats.objects.order_by('book')
+                              .values_list('book', 'total_loans', 'active_loans', 'last_borrowed')))
+
+    def test_borrow_records_page(self):
+        self.archive_loans()
+        self.client.login(username='testuser', password='testpassword123')
+        response = self.client.get(reverse('library:borrow-records'))
+        self.assertEqual([self.recent, self.outstanding], sorted(response.context['borrow_record_list'],
+                                                                 key=lambda record: record.pk))
+        response = self.client.get(reverse('library:borrow-records'), {'archived': '1'})
+        self.assertEqual([record.pk for record in self.old], [record.pk for record in response.context[
+            'borrow_record_list']][::-1])
+        self.assertEqual(Decimal('1.00'), response.context['total_fine'])
+        self.assertContains(response, '<td>1.00</td>', html=True)
+
+    def test_admin_borrow_records(self):
+        self.archive_loans()
+        self.client.login(username='testadmin', password='testpassword789')
+        url = reverse('library:admin-borrow-records')
+        self.assertEqual(2, len(self.client.get(url).context['borrow_record_list']))
+        response = self.client.get(url, {'archived': 'on', 'isbn': '9781718502703'})
+        self.assertEqual([self.old[1].pk], [record.pk for record in response.context['borrow_record_list']])
+        response = self.client.get(reverse('library:export-borrow-records'), {'archived': 'on'})
+        self.assertEqual(4, len(b''.join(response.streaming_content).splitlines()))
+        response = self.client.get(reverse('library:api-borrow-records'), {'archived': '1'})
+        self.assertEqual(3, len(response.json()['results']))
+
+
+class AdminTest(TestCase):
+    fixtures = ['books.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='testuser', password='testpassword123')
+        User.objects.create_superuser(username='superuser', password='superpassword', email='root@example.com')
+        BorrowRecord.objects.borrow(cls.user, 1)
+
+    def setUp(self):
+        self.client.login(username='superuser', password='superpassword')
+
+    def count_queries(self, url, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data)
+        self.assertEqual(200, response.status_code)
+        return len(queries)
+
+    def test_book_change_keeps_stock(self):
+        url = reverse('admin:library_book_change', args=(1,))
+        form = self.client.get(url).context['adminform'].form
+        BorrowRecord.objects.borrow(self.user, 1)
+        quantity = Book.objects.get(pk=1).quantity
+        response = self.client.post(url, get_form_data(form, description='Edited in the admin'))
+        self.assertRedirects(response, reverse('admin:library_book_changelist'))
+        book = Book.objects.get(pk=1)
+        self.assertEqual(('Edited in the admin', quantity), (book.description, book.quantity))
+
+    def test_book_change_conflict(self):
+        url = reverse('admin:library_book_change', args=(1,))
+        form = self.client.get(url).context['adminform'].form
+        Book.objects.filter(pk=1).update(quantity=20, version=F('version') + 1)
+        response = self.client.post(url, get_form_data(form, quantity=7))
+        self.assertContains(response, 'The book was changed by someone else while you edited it: Quantity is now 20.')
+        self.assertEqual(20, Book.objects.get(pk=1).quantity)
+
+    def test_book_change_conflict_on_save(self):
+        # a change let through between the form validation and the write, by a database without row locks
+        url = reverse('admin:library_book_change', args=(1,))
+        form = self.client.get(url).context['adminform'].form
+        current = Book.objects.get(pk=1)
+        current.quantity = 20
+        with mock.patch.object(BookForm, 'save_changes', return_value=(current, ['quantity'])):
+            response = self.client.post(url, get_form_data(form, quantity=7), follow=True)
+        self.assertRedirects(response, url)
+        self.assertContains(response, 'The book was changed by someone else while you edited it: Quantity is now 20.')
+        self.assertNotContains(response, 'was changed successfully')
+
+    def test_changelist_queries(self):
+        url = reverse('admin:library_borrowrecord_changelist')
+        num_queries = self.count_queries(url)
+        for i, book_id in enumerate([1, 2] * 5):
+            BorrowRecord.objects.borrow(User.objects.create_user(username=f'patron{i}'), book_id)
+        self.assertEqual(num_queries, self.count_queries(url))
+        filters = {'status': 'overdue', 'borrow_date__year': '2025'}
+        self.assertGreaterEqual(num_queries, self.count_queries(url, filters))
+
+    def test_autocomplete_widgets(self):
+        response = self.client.get(reverse('admin:library_borrowrecord_add'))
+        self.assertContains(response, 'class="admin-autocomplete"', count=2)
+        self.assertNotContains(response, '>testuser</option>')
+        response = self.client.get(reverse('admin:autocomplete'), {
+            'app_label': 'library', 'model_name': 'borrowrecord', 'field_name': 'book', 'term': 'Django'})
+        self.assertEqual(['Django for Beginners'], [result['text'] for result in response.json()['results']])
+
+    def test_book_search(self):
+        url = reverse('admin:library_book_changelist')
+        response = self.client.get(url, {'q': 'Python'})
+        self.assertEqual(['Python Crash Course'], [book.title for book in response.context['cl'].result_list])
+        response = self.client.get(url, {'q': '9781735467269'})
+        self.assertEqual(['Django for Beginners'], [book.title for book in response.context['cl'].result_list])
+
+    def test_user_search(self):
+        response = self.client.get(reverse('admin:library_user_changelist'), {'q': 'test'})
+        self.assertEqual(['testuser'], [user.username for user in response.context['cl'].result_list])
+
+    def test_estimated_count(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.assertEqual(1, estimate_count(BorrowRecord))
+        BorrowRecord.objects.borrow(self.user, 2)
+
+        class Paginator(EstimatedCountPaginator):
+            estimate_threshold = 1
+
+        # the statistics are only updated by the next ANALYZE
+        self.assertEqual(1, Paginator(BorrowRecord.objects.order_by('pk'), 10).count)
+        self.assertEqual(1, Paginator(BorrowRecord.objects.filter(book_id=2).order_by('pk'), 10).count)
+        self.assertEqual(2, EstimatedCountPaginator(BorrowRecord.objects.order_by('pk'), 10).count)
+
+
+class BookStatsTest(TestCase):
+    fixtures = ['books.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_users()
+        cls.user = User.objects.get(username='testuser')
+
+    def test_borrow_and_return(self):
+        record = BorrowRecord.objects.borrow(self.user, 1)
+        BorrowRecord.objects.borrow(self.user, 1)
+        stats = BookStats.objects.get(book_id=1)
+        self.assertEqual((2, 2, timezone.now().date()), (stats.total_loans, stats.active_loans, stats.last_borrowed))
+        record.return_book()
+        record.return_book()
+        stats.refresh_from_db()
+        self.assertEqual((2, 1), (stats.total_loans, stats.active_loans))
+
+    def test_out_of_stock(self):
+        Book.objects.filter(pk=1).update(quantity=0)
+        self.assertIsNone(BorrowRecord.objects.borrow(self.user, 1))
+        self.assertFalse(BookStats.objects.filter(book_id=1).exists())
+        self.assertFalse(Task.objects.exists())
+
+    def test_rebuild(self):
+        BorrowRecord.objects.borrow(self.user, 1)
+        BorrowRecord.objects.borrow(self.user, 2).return_book()
+        BorrowRecord.objects.create(user=self.user, book_id=2)
+        BookStats.objects.filter(book_id=1).update(total_loans=100)
+        out = StringIO()
+        call_command('rebuild_book_stats', batch_size=1, stdout=out)
+        self.assertIn('Rebuilt the stats of 2 books', out.getvalue())
+        self.assertEqual([(1, 1, 1), (2, 2, 1)],
+                         list(BookStats.objects.order_by('book').values_list('book', 'total_loans', 'active_loans')))
+
+    def test_popular_books(self):
+        for book_id in (2, 2, 1):
+            BorrowRecord.objects.borrow(self.user, book_id)
+        response = self.client.get(reverse('library:popular-books'))
+        self.assertEqual(200, response.status_code)
+        values = ['Python Crash Course', 'Django for Beginners']
+        self.assertQuerySetEqual(response.context['book_stats_list'], values, transform=lambda s: s.book.title)
+
+    def test_book_detail(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            BorrowRecord.objects.borrow(self.user, 1)
+        run_tasks()
+        response = self.client.get(reverse('library:book-detail', args=(1,)))
+        self.assertContains(response, 'Times Borrowed: 1')
+
+
+class DailyCirculationTest(TestCase):
+    fixtures = ['books.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_users()
+        cls.user = User.objects.get(username='testuser')
+        cls.book = Book.objects.create(title='Uncategorized', author='Someone', isbn='9780000000001', quantity=5)
+
+    def create_record(self, book_id, borrow_date, return_date=None, model=BorrowRecord):
+        if model is ArchivedBorrowRecord:
+            return ArchivedBorrowRecord.objects.create(id=1000 + model.objects.count(), user=self.user, book_id=book_id,
+                                                       borrow_date=borrow_date, due_date=borrow_date,
+                                                       return_date=return_date)
+        record = BorrowRecord.objects.create(user=self.user, book_id=book_id)
+        BorrowRecord.objects.filter(pk=record.pk).update(borrow_date=borrow_date, return_date=return_date)
+        return record
+
+    def rollups(self):
+        return list(DailyCirculation.objects.order_by('date', 'category').values_list('date', 'category', 'loans',
+                                                                                       'returns'))
+
+    def test_refreshed_on_borrow_and_return(self):
+        today = timezone.now().date()
+        with self.captureOnCommitCallbacks(execute=True):
+            record = BorrowRecord.objects.borrow(self.user, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            BorrowRecord.objects.borrow_many(self.user, [1, self.book.pk])
+        # the first refresh of the day to run covers both borrows
+        self.assertEqual(2, Task.objects.filter(name='refresh_daily_circulation').count())
+        with self.assertLogs('library.tasks', 'DEBUG') as logs:
+            run_tasks()
+        self.assertEqual(1, sum('task=refresh_daily_circulation' in line for line in logs.output))
+        self.assertEqual([(today, None, 1, 0), (today, 1, 2, 0)], self.rollups())
+        with self.captureOnCommitCallbacks(execute=True):
+            record.return_book()
+        run_tasks()
+        self.assertEqual([(today, None, 1, 0), (today, 1, 2, 1)], self.rollups())
+
+    def test_backfill(self):
+        day = datetime.date(2024, 3, 1)
+        self.create_record(1, day, day + datetime.timedelta(days=2), model=ArchivedBorrowRecord)
+        self.create_record(1, day + datetime.timedelta(days=1), day + datetime.timedelta(days=2))
+        self.create_record(self.book.pk, day + datetime.timedelta(days=2))
+        DailyCirculation.objects.create(date=day, category_id=1, loans=10)
+        out = StringIO()
+        call_command('backfill_circulation', until=day + datetime.timedelta(days=3), chunk_days=2, stdout=out)
+        self.assertIn('Backfilled the circulation of 4 days from 2024-03-01 to 2024-03-04', out.getvalue())
+        expected = [
+            (day, 1, 1, 0),
+            (day + datetime.timedelta(days=1), 1, 1, 0),
+            (day + datetime.timedelta(days=2), None, 1, 0),
+            (day + datetime.timedelta(days=2), 1, 0, 2),
+        ]
+        self.assertEqual(expected, self.rollups())
+        call_command('backfill_circulation', since=day, until=day + datetime.timedelta(days=3), stdout=StringIO())
+        self.assertEqual(expected, self.rollups())
+
+    def test_report(self):
+        day = datetime.date(2024, 3, 1)
+        before, after = day - datetime.timedelta(days=10), day + datetime.timedelta(days=2)
+        for return_date in [before, before, after, after, after]:
+            self.create_record(1, before, return_date)
+        for book_id, return_date in [(1, day), (1, after), (self.book.pk, None), (self.book.pk, None),
+                                     (self.book.pk, None)]:
+            self.create_record(book_id, day, return_date)
+        # refreshed out of order, the later balances are carried over
+        for dates in [[after], [day], [before]]:
+            DailyCirculation.objects.refresh(dates)
+        with self.assertNumQueries(3):
+            days, categories = DailyCirculation.objects.report(day, after)
+        self.assertEqual([(5, 1, 7), (0, 0, 7), (0, 4, 3)],
+                         [(row['loans'], row['returns'], row['active_loans']) for row in days])
+        self.assertEqual([(None, 3, 0), ('Programming', 2, 5)],
+                         [(row['category__name'], row['loans'], row['returns']) for row in categories])
+
+        DailyCirculation.objects.refresh([before + datetime.timedelta(days=offset) for offset in range(13)])
+        self.assertEqual(days, DailyCirculation.objects.report(day, after)[0])
+        BorrowRecord.objects.filter(borrow_date=before, return_date=after).update(return_date=None)
+        DailyCirculation.objects.refresh([after])
+        self.assertEqual(6, DailyCirculation.objects.report(after, after)[0][0]['active_loans'])
+
+    def test_dashboard(self):
+        today = timezone.now().date()
+        DailyCirculation.objects.create(date=today, category_id=1, loans=2)
+        CirculationDay.objects.create(date=today, loans=2, active_loans=2)
+        self.client.login(username='testadmin', password='testpassword789')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('library:circulation-dashboard'))
+        self.assertEqual(200, response.status_code)
+        self.assertTemplateUsed(response, 'library/circulation_dashboard.html')
+        self.assertEqual(30, len(response.context['days']))
+        self.assertEqual({'date': today, 'loans': 2, 'returns': 0, 'active_loans': 2}, response.context['days'][-1])
+        self.assertContains(response, 'Programming')
+        # only the rollups are read
+        self.assertFalse([query for query in queries if 'library_borrowrecord' in query['sql']])
+
+        start = today - datetime.timedelta(days=6)
+        response = self.client.get(reverse('library:circulation-dashboard'), {'start': start, 'end': today})
+        self.assertEqual(7, len(response.context['days']))
+        response = self.client.get(reverse('library:circulation-dashboard'), {'start': today, 'end': start})
+        self.assertFalse(response.context['form'].is_valid())
+        self.assertEqual(30, len(response.context['days']))
+
+    def test_dashboard_permission(self):
+        self.client.login(username='testuser', password='testpassword123')
+        response = self.client.get(reverse('library:circulation-dashboard'))
+        self.assertEqual(403, response.status_code)
+
+
+class APITest(TestCase):
+    fixtures = ['books.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_users()
+        for i in range(25):
+            Book.objects.create(title=f'Book {i}', author=f'Author {i}', isbn=str(i))
+        cls.record = BorrowRecord.objects.create(user_id=1, book_id=1)
+        BorrowRecord.objects.create(user_id=2, book_id=2)
+
+    def test_books(self):
+        response = self.client.get(reverse('library:api-books'), {'fields': 'title,quantity'})
+        self.assertEqual(200, response.status_code)
+        data = response.json()
+        self.assertEqual(20, len(data['results']))
+        self.assertEqual({'id': 1, 'title': 'Django for Beginners', 'quantity': 5}, data['results'][0])
+        self.assertIsNone(data['previous'])
+
+        response = self.client.get(reverse('library:api-books'), {'fields': 'title', 'cursor': data['next']})
+        data = response.json()
+        self.assertEqual(7, len(data['results']))
+        self.assertIsNone(data['next'])
+
+    def test_search(self):
+        response = self.client.get(reverse('library:api-books'), {'title': 'book', 'author': '8', 'limit': 1})
+        data = response.json()
+        self.assertEqual(['Book 8'], [book['title'] for book in data['results']])
+        response = self.client.get(reverse('library:api-books'), {'title': 'book', 'author': '8', 'cursor': data['next']})
+        self.assertEqual(['Book 18'], [book['title'] for book in response.json()['results']])
+
+    def test_invalid_parameters(self):
+        self.assertEqual(400, self.client.get(reverse('library:api-books'), {'fields': 'password'}).status_code)
+        self.assertEqual(400, self.client.get(reverse('library:api-books'), {'limit': 'all'}).status_code)
+        self.assertEqual(400, self.client.get(reverse('library:api-books'), {'cursor': 'invalid'}).status_code)
+
+    def test_book_detail(self):
+        response = self.client.get(reverse('library:api-book-detail', args=(1,)))
+        data = response.json()
+        self.assertEqual('9781735467269', data['isbn'])
+        self.assertEqual('2024-07-10', data['pub_date'])
+        self.assertEqual(1, data['category'])
+        self.assertEqual(404, self.client.get(reverse('library:api-book-detail', args=(9999,))).status_code)
+
+    def test_create_book(self):
+        data = {'title': 'Fluent Python', 'author': 'Luciano Ramalho', 'isbn': '9781492056355', 'quantity': 2}
+        url = reverse('library:api-books')
+        self.assertEqual(401, self.client.post(url, data, content_type='application/json').status_code)
+        self.client.login(username='testuser', password='testpassword123')
+        self.assertEqual(403, self.client.post(url, data, content_type='application/json').status_code)
+        self.client.login(username='testadmin', password='testpassword789')
+        response = self.client.post(url, data, content_type='application/json')
+        self.assertEqual(201, response.status_code)
+        self.assertEqual('Fluent Python', response.json()['title'])
+        response = self.client.post(url, data, content_type='application/json')
+        self.assertEqual(400, response.status_code)
+        self.assertIn('isbn', response.json()['errors'])
+
+    def test_categories(self):
+        response = self.client.get(reverse('library:api-categories'))
+        self.assertEqual([{'id': 1, 'name': 'Programming'}], response.json()['results'])
+        self.client.login(username='testadmin', password='testpassword789')
+        response = self.client.post(reverse('library:api-categories'), {'name': 'Fiction'},
+                                    content_type='application/json')
+        self.assertEqual(201, response.status_code)
+
+    def test_borrow_records(self):
+        url = reverse('library:api-borrow-records')
+        self.assertEqual(401, self.client.get(url).status_code)
+        self.client.login(username='testuser', password='testpassword123')
+        response = self.client.get(url, {'fields': 'book__title,return_date'})
+        self.assertEqual([{'id': self.record.id, 'book__title': 'Django for Beginners', 'return_date': None}],
+                         response.json()['results'])
+        self.client.login(username='testadmin', password='testpassword789')
+        self.assertEqual(2, len(self.client.get(url).json()['results']))
+        self.assertEqual(1, len(self.client.get(url, {'username': 'testuser2'}).json()['results']))
+
+    def test_circulation(self):
+        self.client.login(username='testuser', password='testpassword123')
+        response = self.client.post(reverse('library:api-borrow-book', args=(2,)))
+        self.assertEqual(201, response.status_code)
+        record_id = response.json()['id']
+        self.assertEqual(2, Book.objects.get(pk=2).quantity)
+
+        response = self.client.post(reverse('library:api-renew-book', args=(record_id,)))
+        self.assertEqual(200, response.status_code)
+        response = self.client.post(reverse('library:api-return-book', args=(record_id,)))
+        self.assertEqual(timezone.now().date().isoformat(), response.json()['return_date'])
+        self.assertEqual(3, Book.objects.get(pk=2).quantity)
+
+        Book.objects.filter(pk=2).update(quantity=0)
+        self.assertEqual(409, self.client.post(reverse('library:api-borrow-book', args=(2,))).status_code)
+        self.assertEqual(404, self.client.post(reverse('library:api-borrow-book', args=(9999,))).status_code)
+        self.assertEqual(405, self.client.get(reverse('library:api-borrow-book', args=(2,))).status_code)
+
+    def test_gzip(self):
+        response = self.client.get(reverse('library:api-books'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual('gzip', response['Content-Encoding'])
+        self.assertEqual(20, len(json.loads(gzip.decompress(response.content))['results']))
+
+
+class AsyncViewTest(TestCase):
+    fixtures = ['books.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_users()
+        for i in range(25):
+            Book.objects.create(title=f'Book {i}', author=f'Author {i}', isbn=str(i))
+        BorrowRecord.objects.create(user_id=1, book_id=1)
+
+    def setUp(self):
+        cache.clear()
+
+    async def get(self, view, path, user=None, headers=None, **kwargs):
+        request = AsyncRequestFactory().get(path, headers=headers)
+        request.user = user or AnonymousUser()
+        return await view(request, **kwargs)
+
+    async def test_book_list(self):
+        url = reverse('library:book-list')
+        response = await self.get(async_views.book_list, url)
+        self.assertEqual(200, response.status_code)
+        page = response.context_data['page_obj']
+        self.assertEqual(list(range(1, 21)), [book.id for book in page])
+        self.assertTrue(response.context_data['cursor_pagination'])
+
+        response = await self.get(async_views.book_list, f'{url}?cursor={page.next_cursor}')
+        self.assertEqual(list(range(21, 28)), [book.id for book in response.context_data['page_obj']])
+        response = await self.get(async_views.book_list, f'{url}?page=2')
+        self.assertEqual(list(range(21, 28)), [book.id for book in response.context_data['page_obj']])
+        self.assertEqual(2, response.context_data['paginator'].num_pages)
+        response = await self.get(async_views.book_list, f'{url}?title=book&author=8&category=1')
+        self.assertEqual([], response.context_data['book_list'])
+        with self.assertRaises(Http404):
+            await self.get(async_views.book_list, f'{url}?page=3')
+
+        user = await User.objects.aget(username='testadmin')
+        response = await self.get(async_views.book_list, f'{url}?title=django', user=user)
+        await sync_to_async(response.render)()
+        self.assertContains(response, 'Django for Beginners')
+        self.assertContains(response, 'Add Book')
+
+    async def test_not_modified(self):
+        url = reverse('library:book-detail', args=(1,))
+        response = await self.get(async_views.book_detail, url, pk=1)
+        self.assertEqual('Django for Beginners', response.context_data['book'].title)
+        await sync_to_async(response.render)()
+        response = await self.get(async_views.book_detail, url, headers={'If-None-Match': response['ETag']}, pk=1)
+        self.assertEqual(304, response.status_code)
+        with self.assertRaises(Http404):
+            await self.get(async_views.book_detail, reverse('library:book-detail', args=(9999,)), pk=9999)
+
+    async def test_borrow_records(self):
+        url = reverse('library:borrow-records')
+        response = await self.get(async_views.borrow_records, url)
+        self.assertRedirects(response, f"{reverse('library:login')}?next={url}", fetch_redirect_response=False)
+        user = await User.objects.aget(username='testuser')
+        response = await self.get(async_views.borrow_records, url, user=user)
+        self.assertEqual(['Django for Beginners'],
+                         [record.book.title for record in response.context_data['borrow_record_list']])
+        self.assertIsNone(response.context_data['total_fine'])
+
+
+@override_settings(LIBRARY_READ_REPLICAS=['replica'], LIBRARY_REPLICA_PIN_SECONDS=5)
+class ReplicaRouterTest(SimpleTestCase):
+    router = ReplicaRouter()
+
+    def test_routing(self):
+        pinned = is_pinned()
+        with pinning():
+            self.assertEqual('replica', self.router.db_for_read(Book))
+            self.assertEqual('default', self.router.db_for_write(Book))
+            # reads after a write see it
+            self.assertEqual('default', self.router.db_for_read(Book))
+        self.assertEqual(pinned, is_pinned())
+
+    @override_settings(LIBRARY_READ_REPLICAS=[])
+    def test_no_replicas(self):
+        with pinning():
+            self.assertEqual('default', self.router.db_for_read(Book))
+
+    def test_pinned(self):
+        with pinning(True):
+            self.assertEqual('default', self.router.db_for_read(Book))
+
+    def request(self, cookies=None, write=False):
+        def get_response(request):
+            if write:
+                self.router.db_for_write(BorrowRecord)
+            return HttpResponse(self.router.db_for_read(Book))
+
+        request = RequestFactory().get('/')
+        request.COOKIES.update(cookies or {})
+        return ReplicaPinningMiddleware(get_response)(request)
+
+    def test_middleware(self):
+        response = self.request()
+        self.assertEqual(b'replica', response.content)
+        self.assertNotIn('library_primary', response.cookies)
+
+        response = self.request(write=True)
+        self.assertEqual(b'default', response.content)
+        cookie = response.cookies['library_primary']
+        self.assertEqual(5, cookie['max-age'])
+
+        # the next requests of the client read from the primary until the cookie expires
+        response = self.request({'library_primary': cookie.value})
+        self.assertEqual(b'default', response.content)
+        self.assertNotIn('library_primary', response.cookies)
+        self.assertEqual(b'replica', self.request({'library_primary': str(time.time() - 1)}).content)
+        self.assertEqual(b'replica', self.request({'library_primary': 'x'}).content)
+
+
+@override_settings(LIBRARY_READ_REPLICAS=['replica'])
+class ReplicaPinningTest(TestCase):
+    fixtures = ['books.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_users()
+
+    def setUp(self):
+        self.client.login(username='testuser', password='testpassword123')
+
+    def test_borrow_pins_primary(self):
+        response = self.client.get(reverse('library:book-detail', args=(1,)))
+        self.assertNotIn('library_primary', response.cookies)
+        response = self.client.post(reverse('library:borrow-book', args=(1,)))
+        self.assertIn('library_primary', response.cookies)
+
+
+class PerformanceMiddlewareTest(TestCase):
+    fixtures = ['books.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_users()
+
+    def setUp(self):
+        cache.clear()
+        self.client.login(username='testadmin', password='testpassword789')
+        self.async_client.force_login(User.objects.get(username='testadmin'))
+
+    def test_server_timing(self):
+        with self.assertLogs('library.performance', 'DEBUG') as logs:
+            response = self.client.get(reverse('library:book-list'))
+        self.assertRegex(response['Server-Timing'],
+                         r'^sql;dur=[\d.]+;desc="6 queries", template;dur=[\d.]+, total;dur=[\d.]+$')
+        self.assertEqual(1, len(logs.records))
+        self.assertIn('method=GET path=/library/books/ status=200', logs.output[0])
+        self.assertEqual(6, logs.records[0].performance['sql_count'])
+        self.assertGreater(logs.records[0].performance['template_ms'], 0)
+
+    @override_settings(LIBRARY_PERFORMANCE={'SAMPLE_RATE': 0})
+    def test_not_sampled(self):
+        with self.assertNoLogs('library.performance'):
+            response = self.client.get(reverse('library:book-list'))
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    @override_settings(LIBRARY_PERFORMANCE={'SLOW_REQUEST_MS': 0, 'SERVER_TIMING': False})
+    def test_slow_request(self):
+        with self.assertLogs('library.performance', 'WARNING') as logs:
+            response = self.client.get(reverse('library:book-detail', args=(1,)))
+        self.assertFalse(response.has_header('Server-Timing'))
+        self.assertIn('slow request method=GET path=/library/book/1/', logs.output[0])
+        self.assertIn('[default]', logs.output[0])
+        self.assertIn('FROM "library_book"', logs.output[0])
+
+    def test_render(self):
+        # the templates of function-based views, which render them within the view, are timed as well
+        with self.assertLogs('library.performance', 'DEBUG') as logs:
+            self.client.get(reverse('library:borrow-records'))
+        self.assertGreater(logs.records[0].performance['sql_count'], 0)
+        self.assertGreater(logs.records[0].performance['template_ms'], 0)
+
+    async def test_async(self):
+        response = await self.async_client.get(reverse('library:book-list'))
+        self.assertIn('template;dur=', response['Server-Timing'])
+
+    async def test_async_queries(self):
+        # the queries run in the sync_to_async thread, not in the thread of the middleware
+        with self.assertLogs('library.performance', 'DEBUG') as logs:
+            response = await self.async_client.get(reverse('library:borrow-records'))
+        self.assertEqual(200, response.status_code)
+        self.assertGreater(logs.records[0].performance['sql_count'], 0)
+        self.assertGreater(logs.records[0].performance['template_ms'], 0)
+
+
+task_calls = []
+
+
+@task(name='test_record_call')
+def record_call(value):
+    task_calls.append(value)
+
+
+@task(name='test_record_coalesced_call', coalesce=True)
+def record_coalesced_call(value):
+    task_calls.append(value)
+
+
+@task(name='test_fail', max_attempts=2)
+def fail():
+    raise ValueError('failed')
+
+
+class TaskQueueTest(TestCase):
+
+    def setUp(self):
+        task_calls.clear()
+
+    def test_enqueue_in_transaction(self):
+        with transaction.atomic():
+            record_call.delay(value=1)
+        try:
+            with transaction.atomic():
+                record_call.delay(value=2)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual([{'value': 1}], [task.kwargs for task in Task.objects.all()])
+
+    def test_coalesce(self):
+        for value in [1, 1, 2, 1]:
+            record_coalesced_call.delay(value=value)
+        run_tasks()
+        self.assertEqual([1, 2], task_calls)
+
+    def test_run(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            record_call.delay(value=1)
+            record_call.delay(value=2)
+        with self.assertLogs('library.tasks', 'DEBUG') as logs:
+            run_tasks()
+        self.assertEqual([1, 2], task_calls)
+        self.assertFalse(Task.objects.exists())
+        self.assertIn('task task=test_record_call', logs.output[0])
+        self.assertIn('status=done attempt=1 wait_ms=', logs.output[0])
+
+    def test_claim(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            record_call.delay(value=1)
+        task = Task.objects.claim()
+        self.assertEqual((Task.Status.RUNNING, 1), (task.status, task.attempts))
+        self.assertIsNone(Task.objects.claim())
+
+    def test_retry(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            fail.delay()
+        with self.assertLogs('library.tasks', 'WARNING') as logs:
+            run_tasks()
+        self.assertIn('status=retry attempt=1', logs.output[0])
+        self.assertIn('ValueError: failed', logs.output[0])
+        task = Task.objects.get()
+        self.assertEqual(Task.Status.QUEUED, task.status)
+        self.assertGreater(task.run_at, timezone.now() + datetime.timedelta(seconds=5))
+        self.assertEqual({'due': 0, 'delayed': 1, 'running': 0, 'failed': 0, 'oldest_due_seconds': 0.0},
+                         Task.objects.metrics())
+
+        Task.objects.update(run_at=timezone.now())
+        with self.assertLogs('library.tasks', 'WARNING'):
+            run_tasks()
+        task.refresh_from_db()
+        self.assertEqual((Task.Status.FAILED, 2), (task.status, task.attempts))
+        self.assertIn('ValueError: failed', task.last_error)
+
+    def test_unknown_task(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Task.objects.enqueue('missing')
+        with self.assertLogs('library.tasks', 'WARNING'):
+            run_tasks()
+        self.assertEqual(Task.Status.FAILED, Task.objects.get().status)
+
+    def test_requeue_stale(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            record_call.delay(value=1)
+        Task.objects.claim()
+        self.assertEqual(0, Task.objects.requeue_stale(timezone.now() - datetime.timedelta(minutes=10)))
+        self.assertEqual(1, Task.objects.requeue_stale(timezone.now() + datetime.timedelta(seconds=1)))
+        self.assertEqual(Task.Status.QUEUED, Task.objects.get().status)
+
+    def test_metrics(self):
+        Task.objects.create(name='test_record_call', kwargs={'value': 1},
+                            run_at=timezone.now() - datetime.timedelta(seconds=30))
+        Task.objects.create(name='test_fail', status=Task.Status.FAILED)
+        out = StringIO()
+        call_command('runworker', metrics=True, stdout=out)
+        self.assertRegex(out.getvalue(), r'^due=1 delayed=0 running=0 failed=1 oldest_due_seconds=3\d\.\d+')
+
+
+class RunWorkerTest(TransactionTestCase):
+
+    def test_burst(self):
+        task_calls.clear()
+        for value in range(5):
+            record_call.delay(value=value)
+        out = StringIO()
+        with self.assertLogs('library.tasks', 'DEBUG'):
+            call_command('runworker', threads=2, burst=True, stdout=out)
+        self.assertIn('Running tasks with 2 threads', out.getvalue())
+        self.assertIn('Ran 5 tasks, 0 failed, queue wait p50', out.getvalue())
+        self.assertEqual(list(range(5)), sorted(task_calls))
+        self.assertFalse(Task.objects.exists())
+
+
+class BorrowConcurrencyTest(TransactionTestCase):
+
+    def test_no_oversell(self):
+        out = StringIO()
+        call_command('benchmark_borrow', threads=4, attempts=20, stock=10, stdout=out)
+        self.assertIn('0 oversold, 0 lost updates', out.getvalue())
+
+
+class BenchmarkAsgiTest(TransactionTestCase):
+    # the requests run outside the test transaction, so they may read from a replica
+    databases = '__all__'
+
+    def test_benchmark(self):
+        for interface in ('wsgi', 'asgi'):
+            out = StringIO()
+            call_command('benchmark_asgi', interface=interface, requests=20, concurrency=4, stdout=out)
+            self.assertRegex(out.getvalue(), rf'^{interface.upper()} \((a)?sync views\) /library/books/: 20 requests')
+
+
+class QueryBudgetTest(QueryBudgetMixin, TestCase):
+    """Pin the maximum number of queries of every view, with enough rows to expose N+1 queries."""
+    fixtures = ['books.json']
+    # url name: (method, username, maximum number of queries)
+    budgets = {
+        'register': ('get', None, 0),
+        'login': ('get', None, 0),
+        'logout': ('get', 'testuser', 4),
+        'profile': ('get', 'testuser', 3),
+        'book-list': ('get', 'testadmin', 6),
+        'popular-books': ('get', 'testuser', 5),
+        'book-detail': ('get', 'testuser', 5),
+        'add-book': ('get', 'testadmin', 6),
+        'edit-book': ('get', 'testadmin', 7),
+        'delete-book': ('get', 'testadmin', 6),
+        'borrow-book': ('post', 'testuser', 9),
+        'renew-book': ('post', 'testuser', 6),
+        'return-book': ('post', 'testuser', 10),
+        'borrow-records': ('get', 'testuser', 5),
+        'admin-borrow-records': ('get', 'testadmin', 6),
+        'export-borrow-records': ('get', 'testadmin', 4),
+        'circulation-dashboard': ('get', 'testadmin', 8),
+        'api-books': ('get', None, 2),
+        'api-book-detail': ('get', None, 1),
+        'api-borrow-book': ('post', 'testuser', 10),
+        'api-categories': ('get', None, 1),
+        'api-borrow-records': ('get', 'testuser', 5),
+        'api-renew-book': ('post', 'testuser', 7),
+        'api-return-book': ('post', 'testuser', 11),
+        'batch-borrow-records': ('post', 'testuser', 13),
+        'place-hold': ('post', 'testuser', 6),
+        'holds': ('get', 'testuser', 4),
+        'cancel-hold': ('post', 'testuser', 7),
+        'api-borrow-books': ('post', 'testuser', 12),
+        'api-renew-books': ('post', 'testuser', 7),
+        'api-return-books': ('post', 'testuser', 13),
+    }
+    passwords = {'testuser': 'testpassword123', 'testadmin': 'testpassword789'}
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_users()
+        for i in range(30):
+            Book.objects.create(title=f'Book {i}', author=f'Author {i}', isbn=str(i))
+        for book in Book.objects.all():
+            BorrowRecord.objects.create(user_id=1, book=book)
+            BorrowRecord.objects.create(user_id=2, book=book)
+        call_command('rebuild_book_stats', stdout=StringIO())
+        for book in Book.objects.order_by('-pk')[:10]:
+            Hold.objects.create(user_id=1, book=book)
+
+    def get_args(self, name):
+        if name in ('book-detail', 'edit-book', 'delete-book', 'borrow-book', 'api-book-detail', 'api-borrow-book',
+                    'place-hold'):
+            return 1,
+        if name == 'cancel-hold':
+            return Hold.objects.filter(user_id=1).first().pk,
+        if name in ('renew-book', 'return-book', 'api-renew-book', 'api-return-book'):
+            return BorrowRecord.objects.filter(user_id=1, return_date=None).first().pk,
+        return ()
+
+    def get_data(self, name):
+        # the batch views process ten items, their budget must not depend on the number of items
+        if name == 'api-borrow-books':
+            return {'data': {'books': list(range(1, 11))}, 'content_type': 'application/json'}
+        record_ids = list(BorrowRecord.objects.filter(user_id=1, return_date=None).values_list('pk', flat=True)[:10])
+        if name == 'batch-borrow-records':
+            return {'data': {'action': 'return', 'records': record_ids}}
+        if name in ('api-renew-books', 'api-return-books'):
+            return {'data': {'records': record_ids}, 'content_type': 'application/json'}
+        return {}
+
+    def test_all_views_have_budget(self):
+        names = {pattern.name for pattern in urls.urlpatterns}
+        self.assertEqual(names, set(self.budgets))
+
+    def test_budgets(self):
+        for name, (method, username, budget) in self.budgets.items():
+            with self.subTest(name):
+                self.client.logout()
+                if username:
+                    self.client.login(username=username, password=self.passwords[username])
+                url = reverse(f'library:{name}', args=self.get_args(name))
+                data = self.get_data(name)
+                with self.assertMaxNumQueries(budget):
+                    response = getattr(self.client, method)(url, **data)
+                self.assertLess(response.status_code, 400)
+
+
+class BenchmarkIndexesTest(TestCase):
+
+    def test_benchmark(self):
+        out = StringIO()
+        call_command('benchmark_indexes', seed=True, users=5, books=10, records=100, repeat=1, stdout=out)
+        self.assertIn('Seeded 100 rows into library_borrowrecord', out.getvalue())
+        self.assertIn('== overdue loans', out.getvalue())
+        self.assertIn('borrow_outstanding_due_idx', out.getvalue())
+        self.assertEqual(100, BorrowRecord.objects.count())
+
+
+class BenchmarkIndexesNoRollbackTest(TransactionTestCase):
+    # the SQLite schema editor cannot run in the transaction of a TestCase
+
+    def get_indexes(self, model):
+        with connection.cursor() as cursor:
+            return set(connection.introspection.get_constraints(cursor, model._meta.db_table))
+
+    def test_recreate_indexes(self):
+        indexes = {model: self.get_indexes(model) for model in (Book, BorrowRecord)}
+        dropped = []
+        drop_indexes = BenchmarkIndexes.drop_indexes
+
+        def record_drop(command, model_indexes):
+            dropped.extend(index.name for model, index in model_indexes)
+            drop_indexes(command, model_indexes)
+
+        with mock.patch.object(connection.features, 'can_rollback_ddl', False):
+            with mock.patch.object(BenchmarkIndexes, 'drop_indexes', record_drop):
+                call_command('benchmark_indexes', seed=True, users=5, books=10, records=100, repeat=1,
+                             stdout=StringIO())
+        # only the benchmarked indexes are dropped, and they are created again
+        self.assertCountEqual(['book_title_idx', 'book_author_idx', 'borrow_user_date_idx', 'borrow_date_idx',
+                               'borrow_outstanding_due_idx'], dropped)
+        self.assertEqual(indexes, {model: self.get_indexes(model) for model in (Book, BorrowRecord)})
+
+
+class SeedLibraryTest(TestCase):
+
+    def test_seed(self):
+        out = StringIO()
+        call_command('seed_library', users=5, categories=3, books=20, records=200, batch_size=50, random_seed=1,
+                     stdout=out)
+        self.assertIn('Seeded 200 rows into library_borrowrecord', out.getvalue())
+        self.assertEqual(5, User.objects.count())
+        self.assertEqual(3, Category.objects.count())
+        self.assertEqual(20, Book.objects.count())
+        self.assertEqual(200, BorrowRecord.objects.count())
+        self.assertEqual(200, sum(BookStats.objects.values_list('total_loans', flat=True)))
+        book = Book.objects.order_by('pk').first()
+        self.assertIn(book, get_search_backend().search(Book.objects.all(), {'title': book.title}))
+
+
+class SeedLibraryDeferIndexesTest(TransactionTestCase):
+    # the SQLite schema editor cannot run in the transaction of a TestCase
+
+    def test_defer_indexes(self):
+        out = StringIO()
+        call_command('seed_library', users=2, books=5, records=10, defer_indexes=True, skip_rebuild=True,
+                     stdout=out)
+        self.assertIn('Created the indexes', out.getvalue())
+        self.assertEqual(10, BorrowRecord.objects.count())
+        self.assertFalse(BookStats.objects.exists())
+        self.assertIn('borrow_outstanding_due_idx', [index.name for index in BorrowRecord._meta.indexes])
+        with connection.cursor() as cursor:
+            indexes = connection.introspection.get_constraints(cursor, BorrowRecord._meta.db_table)
+        self.assertIn('borrow_outstanding_due_idx', indexes)
+
+
+class BenchmarkEndpointsTest(TestCase):
+
+    def setUp(self):
+        call_command('loadgroupperms', stdout=StringIO())
+        call_command('seed_library', users=5, books=20, records=50, random_seed=1, stdout=StringIO())
+
+    def benchmark(self, **options):
+        out = StringIO()
+        call_command('benchmark_endpoints', requests=3, warmup=1, stdout=out, **options)
+        return out.getvalue()
+
+    def test_benchmark(self):
+        stock = sum(Book.objects.values_list('quantity', flat=True))
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+            pass
+        self.addCleanup(os.remove, f.name)
+        out = self.benchmark(output=f.name)
+        self.assertRegex(out, r'book-detail +3 +0 ')
+        self.assertRegex(out, r'return +3 +0 ')
+        with open(f.name) as f:
+            report = json.load(f)
+        self.assertEqual(20, report['books'])
+        self.assertEqual({'requests', 'errors', 'throughput', 'p50_ms', 'p95_ms', 'p99_ms'},
+                         set(report['endpoints']['search']))
+        # the benchmark users and their loans are removed
+        self.assertEqual(5, User.objects.count())
+        self.assertEqual(50, BorrowRecord.objects.count())
+        self.assertEqual(stock, sum(Book.objects.values_list('quantity', flat=True)))
+        self.assertEqual(50, sum(BookStats.objects.values_list('total_loans', flat=True)))
+        self.assertEqual(BorrowRecord.objects.filter(return_date=None).count(),
+                         sum(BookStats.objects.values_list('active_loans', flat=True)))
+
+    def test_sample_once(self):
+        with mock.patch.object(BenchmarkEndpoints, 'sample_books', autospec=True,
+                               side_effect=BenchmarkEndpoints.sample_books) as sample:
+            out = self.benchmark(endpoints=['search', 'admin-borrow-records'])
+        self.assertEqual(2, sample.call_count)
+        self.assertRegex(out, r'search +3 +0 ')
+        self.assertRegex(out, r'admin-borrow-records +3 +0 ')
+
+    def test_baseline(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump({'endpoints': {'book-list': {'p95_ms': 60000}, 'book-detail': {'p95_ms': 0.001}}}, f)
+        self.addCleanup(os.remove, f.name)
+        self.assertIn('book-list: p95', self.benchmark(endpoints=['book-list'], baseline=f.name))
+        with self.assertRaisesMessage(CommandError, 'p95 latency regressed by more than 20%: book-detail'):
+            self.benchmark(endpoints=['book-detail'], baseline=f.name)
+
+
+class ImportBooksTest(TestCase):
+    fixtures = ['books.json']
+
+    def import_books(self, content, suffix, **options):
+        with tempfile.NamedTemporaryFile('w', suffix=suffix, delete=False) as f:
+            f.write(content)
+        self.addCleanup(os.remove, f.name)
+        out = StringIO()
+        call_command('importbooks', f.name, batch_size=2, stdout=out, stderr=StringIO(), **options)
+        return out.getvalue()
+
+    def test_csv(self):
+        out = self.import_books(
+            'title,author,isbn,publisher,pub_date,quantity,category,description\n'
+            'Fluent Python,Luciano Ramalho,9781492056355,O\'Reilly,2022-04-01,2,Programming,\n'
+            'Dune,Frank Herbert,9780441172719,,,,Fiction,A desert planet\n'
+            'Django for Beginners,William S. Vincent,9781735467269,WelcomeToCode,2024-07-10,8,Programming,\n',
+            '.csv'
+        )
+        self.assertIn('Imported 3 books', out)
+        self.assertEqual(4, Book.objects.count())
+        fluent = Book.objects.get(isbn='9781492056355')
+        self.assertEqual(datetime.date(2022, 4, 1), fluent.pub_date)
+        self.assertEqual('Programming', fluent.category.name)
+        dune = Book.objects.get(isbn='9780441172719')
+        self.assertEqual(1, dune.quantity)
+        self.assertIsNone(dune.pub_date)
+        self.assertEqual('Fiction', dune.category.name)
+        self.assertEqual(2, Category.objects.count())
+        # the stock of an existing book is kept
+        book = Book.objects.get(pk=1)
+        self.assertEqual(5, book.quantity)
+        self.assertEqual(2, book.version)
+        self.assertEqual(1, fluent.version)
+        books = get_search_backend().search(Book.objects.all(), {'author': 'herbert'})
+        self.assertQuerySetEqual(books, ['Dune'], transform=lambda b: b.title)
+
+    def test_update_quantity(self):
+        content = 'title,author,isbn,quantity\nDjango for Beginners,William S. Vincent,9781735467269,8\n'
+        self.import_books(content, '.csv')
+        self.assertEqual(5, Book.objects.get(pk=1).quantity)
+        self.import_books(content, '.csv', update_quantity=True)
+        self.assertEqual(8, Book.objects.get(pk=1).quantity)
+
+    def test_stdin(self):
+        stdin = StringIO('{"title": "Fluent Python", "author": "Luciano Ramalho", "isbn": "9781492056355"}\n'
+                         '{"title": "Dune", "author": "Frank Herbert", "isbn": "9780441172719"}\n'
+                         '{"title": "Dune Messiah", "author": "Frank Herbert", "isbn": "9780593098233"}\n')
+        with mock.patch('library.management.commands.importbooks.bump_catalog_version') as bump:
+            with mock.patch('sys.stdin', stdin):
+                call_command('importbooks', '-', format='jsonl', batch_size=2, stdout=StringIO())
+        self.assertFalse(stdin.closed)
+        self.assertEqual(5, Book.objects.count())
+        # the catalog cache is invalidated once, not per batch
+        bump.assert_called_once_with()
+
+    def test_jsonl(self):
+        out = self.import_books(
+            '{"title": "Fluent Python", "author": "Luciano Ramalho", "isbn": "9781492056355", "quantity": 3}\n'
+            '\n'
+            '{"title": "Missing ISBN", "author": "Nobody"}\n'
+            '{"title": "Bad Date", "author": "Nobody", "isbn": "1", "pub_date": "yesterday"}\n',
+            '.jsonl'
+        )
+        self.assertIn('Imported 1 books', out)
+        self.assertIn('skipped 2 invalid rows', out)
+        self.assertEqual(3, Book.objects.get(isbn='9781492056355').quantity)
+
+    def test_unknown_format(self):
+        with self.assertRaises(CommandError):
+            call_command('importbooks', 'books.xml')
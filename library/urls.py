@@ -1,5 +1,12 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import api, async_views, views
+
+if getattr(settings, 'LIBRARY_ASYNC_VIEWS', False):
+    book_list, book_detail, borrow_records = async_views.book_list, async_views.book_detail, async_views.borrow_records
+else:
+    book_list, book_detail = views.SearchBookView.as_view(), views.BookDetailView.as_view()
+    borrow_records = views.borrow_records
 
 app_name = 'library'
 urlpatterns = [
@@ -7,14 +14,31 @@ urlpatterns = [
     path('login/', views.user_login, name='login'),
     path('logout/', views.user_logout, name='logout'),
     path('profile/', views.UserProfileView.as_view(), name='profile'),
-    path('books/', views.SearchBookView.as_view(), name='book-list'),
-    path('book/<int:pk>/', views.BookDetailView.as_view(), name='book-detail'),
+    path('books/', book_list, name='book-list'),
+    path('books/popular/', views.PopularBookView.as_view(), name='popular-books'),
+    path('book/<int:pk>/', book_detail, name='book-detail'),
     path('book/add/', views.BookCreateView.as_view(), name='add-book'),
     path('book/<int:pk>/edit/', views.BookUpdateView.as_view(), name='edit-book'),
     path('book/<int:pk>/delete/', views.BookDeleteView.as_view(), name='delete-book'),
     path('borrow/<int:book_id>/', views.borrow_book, name='borrow-book'),
+    path('hold/<int:book_id>/', views.place_hold, name='place-hold'),
+    path('holds/', views.holds, name='holds'),
+    path('holds/<int:hold_id>/cancel/', views.cancel_hold, name='cancel-hold'),
     path('renew/<int:record_id>/', views.renew_book, name='renew-book'),
     path('return/<int:record_id>/', views.return_book, name='return-book'),
-    path('borrow-records/', views.borrow_records, name='borrow-records'),
+    path('borrow-records/', borrow_records, name='borrow-records'),
+    path('borrow-records/batch/', views.batch_borrow_records, name='batch-borrow-records'),
     path('admin-borrow-records/', views.AdminBorrowRecordListView.as_view(), name='admin-borrow-records'),
+    path('admin-borrow-records/export/', views.ExportBorrowRecordView.as_view(), name='export-borrow-records'),
+    path('reports/circulation/', views.CirculationDashboardView.as_view(), name='circulation-dashboard'),
+    path('api/books/', api.books, name='api-books'),
+    path('api/books/<int:pk>/', api.book_detail, name='api-book-detail'),
+    path('api/books/<int:pk>/borrow/', api.borrow_book, name='api-borrow-book'),
+    path('api/books/borrow/', api.borrow_books, name='api-borrow-books'),
+    path('api/categories/', api.categories, name='api-categories'),
+    path('api/borrow-records/', api.borrow_records, name='api-borrow-records'),
+    path('api/borrow-records/<int:pk>/renew/', api.renew_book, name='api-renew-book'),
+    path('api/borrow-records/<int:pk>/return/', api.return_book, name='api-return-book'),
+    path('api/borrow-records/renew/', api.renew_books, name='api-renew-books'),
+    path('api/borrow-records/return/', api.return_books, name='api-return-books'),
 ]
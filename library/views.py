@@ -1,16 +1,23 @@
-from urllib.parse import urlencode
+import hashlib
 
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import PermissionRequiredMixin, LoginRequiredMixin
+from django.db.models import Sum, Max
+from django.http import StreamingHttpResponse, Http404
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse_lazy
-from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition, require_POST
+from django.views.generic import View, ListView, DetailView, CreateView, UpdateView, DeleteView, TemplateView
 from django.views.generic.edit import FormMixin
 
-from .forms import UserRegisterForm, BookSearchForm, UserProfileForm, BorrowRecordSearchForm
-from .models import Book, BorrowRecord
+from . import cache as catalog_cache, export
+from .forms import (UserRegisterForm, BookForm, BookSearchForm, UserProfileForm, BorrowRecordSearchForm,
+                    CirculationReportForm)
+from .models import Book, BorrowRecord, ArchivedBorrowRecord, OverdueLoan, BookStats, Hold, DailyCirculation
+from .pagination import CursorPaginationMixin
 
 
 def user_register(request):
@@ -51,7 +58,40 @@ class UserProfileView(LoginRequiredMixin, UpdateView):
         return self.request.user
 
 
-class SearchBookView(FormMixin, ListView):
+def book_validators(request, pk=None):
+    """Return the ETag and Last-Modified time of a book page, or of the book list if pk is None.
+
+    They are computed with a single aggregate over the indexed Book.updated_at, which is cached under the
+    catalog version, and memoized on the request. The ETag also covers what the timestamp misses: deletions
+    and category changes (through the catalog version), the query string and the user the page is rendered for.
+    """
+    if not hasattr(request, '_book_validators'):
+        books = Book.objects.filter(pk=pk) if pk is not None else Book.objects.all()
+        last_modified = None
+        # a page showing pending messages must always be rendered
+        if not len(messages.get_messages(request)):
+            last_modified = catalog_cache.get_or_set(
+                ['last-modified', pk], lambda: books.aggregate(last_modified=Max('updated_at'))['last_modified']
+            )
+        etag = None
+        if last_modified is not None:
+            user = request.user
+            parts = [request.get_full_path(), last_modified.isoformat(), catalog_cache.get_catalog_version(),
+                     user.pk, user.is_authenticated and user.is_admin()]
+            etag = hashlib.md5(repr(parts).encode()).hexdigest()
+        request._book_validators = etag, last_modified
+    return request._book_validators
+
+
+book_list_condition = condition(etag_func=lambda request: book_validators(request)[0],
+                                last_modified_func=lambda request: book_validators(request)[1])
+book_detail_condition = condition(etag_func=lambda request, pk: book_validators(request, pk)[0],
+                                  last_modified_func=lambda request, pk: book_validators(request, pk)[1])
+
+
+@method_decorator(book_list_condition, name='dispatch')
+@method_decorator(catalog_cache.cache_catalog_page, name='dispatch')
+class SearchBookView(CursorPaginationMixin, FormMixin, ListView):
     form_class = BookSearchForm
     model = Book
     ordering = ['pk']
@@ -61,29 +101,26 @@ class SearchBookView(FormMixin, ListView):
         return {'data': self.request.GET}
 
     def get_queryset(self):
-        form = self.get_form()
-        books = super().get_queryset()
-        if form.is_valid():
-            if title := form.cleaned_data.get('title'):
-                books = books.filter(title__icontains=title)
-            if author := form.cleaned_data.get('author'):
-                books = books.filter(author__icontains=author)
-            if isbn := form.cleaned_data.get('isbn'):
-                books = books.filter(isbn__icontains=isbn)
-            if category := form.cleaned_data.get('category'):
-                books = books.filter(category=category)
-        return books
-
-    def get_context_data(self, **kwargs):
-        query_params = self.request.GET.copy()
-        if 'page' in query_params:
-            del query_params['page']
-        kwargs['querystring'] = urlencode(query_params)
-        return super().get_context_data(**kwargs)
+        books = super().get_queryset().select_related('stats').defer('description')
+        return self.get_form().filter(books)
 
 
+@method_decorator(book_detail_condition, name='dispatch')
+@method_decorator(catalog_cache.cache_catalog_page, name='dispatch')
 class BookDetailView(DetailView):
-    model = Book
+    queryset = Book.objects.select_related('category', 'stats')
+
+    def get_object(self, queryset=None):
+        return catalog_cache.get_or_set(['book', self.kwargs['pk']], super().get_object)
+
+
+class PopularBookView(ListView):
+    queryset = (BookStats.objects.filter(total_loans__gt=0).select_related('book')
+                .only('total_loans', 'active_loans', 'last_borrowed', 'book__title', 'book__author')
+                .order_by('-total_loans', 'book'))
+    context_object_name = 'book_stats_list'
+    template_name = 'library/popular_book_list.html'
+    paginate_by = 20
 
 
 class BookCreateView(PermissionRequiredMixin, CreateView):
@@ -96,9 +133,23 @@ class BookCreateView(PermissionRequiredMixin, CreateView):
 class BookUpdateView(PermissionRequiredMixin, UpdateView):
     permission_required = 'library.change_book'
     model = Book
-    fields = '__all__'
+    form_class = BookForm
     success_url = reverse_lazy('library:book-list')
 
+    def form_valid(self, form):
+        try:
+            current, conflicts = form.save_changes()
+        except Book.DoesNotExist:
+            raise Http404('The book was deleted.')
+        if conflicts:
+            changes = form.describe_conflicts(current, conflicts)
+            form = form.rebase(current)
+            form.add_error(None, f'The book was changed by someone else while you edited it: {changes}. '
+                                 f'Save again to overwrite it with your values.')
+            self.object = current
+            return self.form_invalid(form)
+        return redirect(self.get_success_url())
+
 
 class BookDeleteView(PermissionRequiredMixin, DeleteView):
     permission_required = 'library.delete_book'
@@ -108,14 +159,39 @@ class BookDeleteView(PermissionRequiredMixin, DeleteView):
 
 @login_required
 def borrow_book(request, book_id):
-    book = get_object_or_404(Book, pk=book_id)
-    if book.quantity > 0:
-        BorrowRecord.objects.create(user=request.user, book=book)
-        book.quantity -= 1
-        book.save()
+    if BorrowRecord.objects.borrow(request.user, book_id) is None:
+        book = get_object_or_404(Book, pk=book_id)
+        messages.error(request, f'"{book.title}" is out of stock, place a hold to get the next returned copy.')
     return redirect('library:book-list')
 
 
+@login_required
+def place_hold(request, book_id):
+    book = get_object_or_404(Book.objects.only('title', 'quantity'), pk=book_id)
+    if book.quantity > 0:
+        messages.error(request, f'"{book.title}" is in stock, you can borrow it.')
+    elif Hold.objects.place(request.user, book_id) is None:
+        messages.error(request, f'You already hold "{book.title}".')
+    else:
+        messages.success(request, f'You have been added to the hold queue of "{book.title}".')
+    return redirect('library:holds')
+
+
+@login_required
+def cancel_hold(request, hold_id):
+    hold = get_object_or_404(Hold, pk=hold_id, user=request.user)
+    hold.cancel()
+    return redirect('library:holds')
+
+
+@login_required
+def holds(request):
+    hold_list = (Hold.objects.with_position().filter(user=request.user, status__in=Hold.ACTIVE_STATUSES)
+                 .select_related('book').only('status', 'created_at', 'ready_until', 'book__title')
+                 .order_by('-created_at'))
+    return render(request, 'library/hold_list.html', {'hold_list': hold_list})
+
+
 @login_required
 def renew_book(request, record_id):
     record = get_object_or_404(BorrowRecord, pk=record_id, user=request.user)
@@ -130,17 +206,52 @@ def return_book(request, record_id):
     return redirect('library:borrow-records')
 
 
+def get_borrow_history(request):
+    """Return the borrow records of the user's history page and the fines to sum, archived ones if asked for."""
+    if request.GET.get('archived') == '1':
+        records = (ArchivedBorrowRecord.objects.filter(user=request.user).select_related('book')
+                   .only('borrow_date', 'due_date', 'return_date', 'book__title', 'fine'))
+        fines = ArchivedBorrowRecord.objects.filter(user=request.user)
+    else:
+        records = (BorrowRecord.objects.filter(user=request.user).select_related('book', 'overdue')
+                   .only('borrow_date', 'due_date', 'return_date', 'book__title', 'overdue__fine'))
+        fines = OverdueLoan.objects.filter(record__user=request.user)
+    return records.order_by('-borrow_date'), fines
+
+
 @login_required
 def borrow_records(request):
-    borrow_record_list = BorrowRecord.objects.filter(user=request.user).order_by('-borrow_date')
-    return render(request, 'library/borrow_record_list.html', {'borrow_record_list': borrow_record_list})
+    borrow_record_list, fines = get_borrow_history(request)
+    total_fine = fines.aggregate(total=Sum('fine'))['total']
+    context = {'borrow_record_list': borrow_record_list, 'total_fine': total_fine,
+               'archived': request.GET.get('archived') == '1'}
+    return render(request, 'library/borrow_record_list.html', context)
 
 
-class AdminBorrowRecordListView(PermissionRequiredMixin, FormMixin, ListView):
+@login_required
+@require_POST
+def batch_borrow_records(request):
+    """Renew or return the borrow records selected on the borrow records page in one transaction."""
+    action = request.POST.get('action')
+    record_ids = [int(record_id) for record_id in request.POST.getlist('records') if record_id.isdigit()]
+    if action not in ('renew', 'return') or not record_ids:
+        messages.error(request, 'Select the books to renew or return.')
+        return redirect('library:borrow-records')
+    if action == 'renew':
+        records = BorrowRecord.objects.renew_many(request.user, record_ids)
+    else:
+        records = BorrowRecord.objects.return_many(request.user, record_ids)
+    done = sum(record is not None for record in records)
+    messages.success(request, f'{done} of {len(record_ids)} books {action}ed.')
+    return redirect('library:borrow-records')
+
+
+class AdminBorrowRecordListView(PermissionRequiredMixin, CursorPaginationMixin, FormMixin, ListView):
     permission_required = 'library.view_borrowrecord'
     form_class = BorrowRecordSearchForm
     model = BorrowRecord
-    ordering = ['-borrow_date']
+    ordering = ['-borrow_date', '-pk']
+    paginate_by = 50
     context_object_name = 'borrow_record_list'
     template_name = 'library/admin_borrow_record_list.html'
 
@@ -149,10 +260,42 @@ class AdminBorrowRecordListView(PermissionRequiredMixin, FormMixin, ListView):
 
     def get_queryset(self):
         form = self.get_form()
-        records = super().get_queryset()
-        if form.is_valid():
-            if username := form.cleaned_data.get('username'):
-                records = records.filter(user__username=username)
-            if isbn := form.cleaned_data.get('isbn'):
-                records = records.filter(book__isbn=isbn)
-        return records
+        if form.get_model() is ArchivedBorrowRecord:
+            records = (ArchivedBorrowRecord.objects.select_related('user', 'book')
+                       .only('borrow_date', 'due_date', 'return_date', 'user__username', 'book__title', 'fine'))
+        else:
+            records = (BorrowRecord.objects.select_related('user', 'book', 'overdue')
+                       .only('borrow_date', 'due_date', 'return_date', 'user__username', 'book__title',
+                             'overdue__fine'))
+        return form.filter(records.order_by(*self.ordering))
+
+    def get_context_data(self, **kwargs):
+        return super().get_context_data(archived=self.get_form().get_model() is ArchivedBorrowRecord, **kwargs)
+
+
+class ExportBorrowRecordView(PermissionRequiredMixin, View):
+    permission_required = 'library.view_borrowrecord'
+
+    def get(self, request):
+        file_format = request.GET.get('format', 'csv')
+        if file_format not in export.FORMATS:
+            raise Http404(f'Unknown export format: {file_format}')
+        form = BorrowRecordSearchForm(data=request.GET)
+        records = form.filter(form.get_model().objects.all())
+        response = StreamingHttpResponse(export.export(records, file_format), content_type=export.FORMATS[file_format])
+        response['Content-Disposition'] = f'attachment; filename="borrow_records.{file_format}"'
+        return response
+
+
+class CirculationDashboardView(PermissionRequiredMixin, TemplateView):
+    """Loans per day and per category, and active loans, read from the daily rollups only."""
+    permission_required = 'library.view_borrowrecord'
+    template_name = 'library/circulation_dashboard.html'
+
+    def get_context_data(self, **kwargs):
+        form = CirculationReportForm(data=self.request.GET or None)
+        start, end = form.get_period()
+        days, categories = DailyCirculation.objects.report(start, end)
+        return super().get_context_data(form=form, start=start, end=end, days=days, categories=categories,
+                                        total_loans=sum(day['loans'] for day in days),
+                                        total_returns=sum(day['returns'] for day in days), **kwargs)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,6 +42,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'library.middleware.PerformanceMiddleware',
+    'library.middleware.ReplicaPinningMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -54,7 +57,8 @@ ROOT_URLCONF = 'library_management.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # times the templates of the requests, see library.middleware
+        'BACKEND': 'library.middleware.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -81,6 +85,26 @@ DATABASES = {
     }
 }
 
+# A read replica, e.g. a copy of db.sqlite3 to try the replica routing locally
+if os.environ.get('LIBRARY_REPLICA_DATABASE'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ['LIBRARY_REPLICA_DATABASE'],
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['library.routers.ReplicaRouter']
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -114,3 +138,72 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 AUTH_USER_MODEL = 'library.User'
 
 LOGIN_URL = 'library:login'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        # the library logs, e.g. the slow requests and the failed tasks, are kept when DEBUG is off
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        # the requests and the tasks are logged at the DEBUG level, only the slow and the failed ones at WARNING
+        'library': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
+
+# Library
+
+# Fine of overdue loans, see library.fines
+LIBRARY_FINE_POLICY = {
+    'DAILY_RATE': '0.50',
+    'GRACE_DAYS': 0,
+    'MAX_FINE': '20.00',
+}
+
+# Seconds a cached catalog page or book may be served before it is re-read, see library.cache
+LIBRARY_CATALOG_CACHE_TIMEOUT = 60
+
+# Days a copy set aside for a hold waits to be picked up, see library.models.Hold
+LIBRARY_HOLD_PICKUP_DAYS = 7
+
+# Due date reminders sent by the send_due_reminders command: days before the due date, and messages per
+# second at most
+LIBRARY_REMINDER_DAYS = 3
+LIBRARY_REMINDER_RATE = 10
+
+# Days after their return that borrow records are moved to the archive by the archive_loans command
+LIBRARY_ARCHIVE_AFTER_DAYS = 365
+
+# Background task worker run by the runworker command, see library.tasks
+LIBRARY_TASKS = {
+    'THREADS': 4,
+    'POLL_INTERVAL': 1.0,
+    'MAX_ATTEMPTS': 3,
+    'RETRY_DELAY': 10,
+    'STALE_AFTER': 600,
+}
+
+# Request timing of library.middleware.PerformanceMiddleware
+LIBRARY_PERFORMANCE = {
+    'SAMPLE_RATE': 1.0,
+    'SLOW_REQUEST_MS': 500,
+    'SERVER_TIMING': DEBUG,
+}
+
+# Serve the catalog and borrow record pages with the async views, see library.async_views (set by asgi.py)
+LIBRARY_ASYNC_VIEWS = os.environ.get('LIBRARY_ASYNC_VIEWS', '') == '1'
+
+# Aliases of the read replicas of the default database, see library.routers
+LIBRARY_READ_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+
+# Seconds the reads of a client stay on the primary after it wrote, to hide the replica lag
+LIBRARY_REPLICA_PIN_SECONDS = 5